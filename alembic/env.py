@@ -3,8 +3,7 @@ import asyncio
 from pathlib import Path
 from logging.config import fileConfig
 
-from sqlalchemy import pool, text # Добавлен text
-from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import pool
 
 from alembic import context
 
@@ -13,6 +12,7 @@ sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
 
 from database.models import Base # Импорт Base
 from core.config import settings # Импорт Pydantic settings
+from database.database import create_db_engine
 
 config = context.config
 
@@ -43,10 +43,8 @@ def do_run_migrations(connection):
 
 async def run_async_migrations():
     # Используем async URL из настроек
-    connectable = create_async_engine(settings.database_url, poolclass=pool.NullPool)
+    connectable = create_db_engine(settings.database_url, poolclass=pool.NullPool) # PRAGMA SQLite (в т.ч. foreign_keys) из профиля
     async with connectable.connect() as connection:
-        # Включаем FK для SQLite
-        if connection.dialect.name == "sqlite": await connection.execute(text("PRAGMA foreign_keys=ON"))
         await connection.run_sync(do_run_migrations)
     await connectable.dispose()
 
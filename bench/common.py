@@ -0,0 +1,22 @@
+"""
+Общее для бенчмарков bench/: окружение по умолчанию (настройки читаются при импорте core.config)
+и сводка задержек. Запуск из корня репозитория: python -m bench.<имя>.
+"""
+import os
+import statistics
+import tempfile
+from typing import List
+
+_db_dir = tempfile.mkdtemp(prefix="astro_bot_bench_")
+for _name, _value in {
+    "TELEGRAM_BOT_TOKEN": "123456:BENCH", "WEBHOOK_DOMAIN": "example.com", "OPENAI_API_KEY": "bench",
+    "DATABASE_URL": f"sqlite+aiosqlite:///{_db_dir}/bench.db", "LOG_TO_DB": "false",
+}.items(): os.environ.setdefault(_name, _value)
+
+BENCH_DIR = _db_dir
+
+
+def percentiles(samples: List[float]) -> str:
+    """ p50/p95/p99 в миллисекундах по списку длительностей в секундах. """
+    ordered = sorted(samples); pick = lambda q: ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000
+    return f"p50 {statistics.median(ordered) * 1000:.2f}ms p95 {pick(0.95):.2f}ms p99 {pick(0.99):.2f}ms"
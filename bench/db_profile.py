@@ -0,0 +1,74 @@
+"""
+Профиль движка БД под нагрузкой хендлеров (user-039): create_db_engine (WAL, synchronous=NORMAL, пул, PRAGMA
+на каждое соединение) против прежнего create_async_engine с настройками по умолчанию (rollback journal).
+Нагрузка - платный хендлер: статус пользователя, списание кредита, чтение баланса; CONCURRENCY одновременно.
+С BENCH_PG_URL=postgresql+asyncpg://... то же сравнение для PostgreSQL (профиль asyncpg против умолчаний).
+Запуск: python -m bench.db_profile [N]
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+from typing import List, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+from bench.common import BENCH_DIR, percentiles
+from database import crud
+from database.database import Base, create_db_engine
+from database.models import CreditReason, User
+from database.user_cache import user_cache
+
+USERS = 200
+CONCURRENCY = 50
+
+
+async def run_workload(db_engine: AsyncEngine, n: int) -> Tuple[List[float], float, int]:
+    """ Длительности хендлеров, общее время и число неудачных списаний (например, "database is locked"). """
+    async with db_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all); await conn.run_sync(Base.metadata.create_all)
+    session_factory = async_sessionmaker(db_engine, expire_on_commit=False, class_=AsyncSession)
+    async with session_factory() as session:
+        session.add_all([User(id=i, first_name="bench", referral_code=f"bench{i}", credits=n) for i in range(1, USERS + 1)])
+        await session.commit()
+    user_cache.clear()
+    semaphore = asyncio.Semaphore(CONCURRENCY); samples: List[float] = []; failed = 0
+
+    async def handler(i: int):
+        nonlocal failed
+        user_id = i % USERS + 1
+        async with semaphore:
+            started = time.perf_counter()
+            async with session_factory() as session:
+                await crud.get_user_status(session, user_id)
+                if await crud.update_user_credits(session, user_id, -1, CreditReason.SERVICE, "bench") is None: failed += 1
+                await crud.get_user_credits(session, user_id)
+            samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(handler(i) for i in range(n)))
+    return samples, time.perf_counter() - started, failed
+
+
+async def compare(label: str, profile: AsyncEngine, baseline: AsyncEngine, n: int):
+    for name, db_engine in ((f"{label} профиль", profile), (f"{label} по умолчанию", baseline)):
+        try:
+            samples, elapsed, failed = await run_workload(db_engine, n)
+            print(f"{name:<24} {n / elapsed:7.0f} хендлеров/с, {percentiles(samples)}, ошибок списания: {failed}")
+        finally: await db_engine.dispose()
+
+
+async def main(n: int):
+    logging.disable(logging.ERROR) # Ошибки списания считаются, а не печатаются трейсбеками crud
+    profile_url, baseline_url = f"sqlite+aiosqlite:///{BENCH_DIR}/profile.db", f"sqlite+aiosqlite:///{BENCH_DIR}/baseline.db"
+    baseline = create_async_engine(baseline_url, connect_args={"check_same_thread": False}) # Прежний database.py
+    async with baseline.connect() as conn: await conn.execute(text("PRAGMA journal_mode=DELETE"))
+    await compare("SQLite", create_db_engine(profile_url), baseline, n)
+    if pg_url := os.environ.get("BENCH_PG_URL"):
+        await compare("PostgreSQL", create_db_engine(pg_url), create_async_engine(pg_url), n)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
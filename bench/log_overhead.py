@@ -0,0 +1,54 @@
+"""
+Цена вызова logger.info() в потоке event loop (user-030): обработчики консоли и файла прямо на root-логгере
+("до") против setup_logging() с QueueHandler/QueueListener ("после"). Консоль уходит в /dev/null, файл - во
+временный каталог с той же ротацией 5 МБ. Отдельно - "шумный" логгер aiogram с семплированием.
+Запуск: python -m bench.log_overhead [N]
+"""
+import contextlib
+import logging
+import os
+import sys
+import time
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+from bench.common import BENCH_DIR
+from core.config import settings
+from utils import logging_config
+
+
+def direct_logging():
+    """ Прежняя настройка: StreamHandler и RotatingFileHandler пишут синхронно в потоке автора записи. """
+    root = logging.getLogger(); root.setLevel(logging.INFO)
+    for handler in root.handlers[:]: root.removeHandler(handler)
+    formatter = logging.Formatter(settings.log_format)
+    for handler in (logging.StreamHandler(sys.stderr),
+                    RotatingFileHandler(settings.log_file, maxBytes=5*1024*1024, backupCount=5, encoding='utf-8')):
+        handler.setFormatter(formatter); handler.addFilter(logging_config._context_filter); root.addHandler(handler)
+
+
+def measure(label: str, logger: logging.Logger, n: int, drain=None):
+    token = logging_config.bind_log_context(user_id=42, handler_name="bench")
+    started = time.perf_counter()
+    for i in range(n): logger.info("Пользователь %s открыл меню %d", "bench", i)
+    elapsed = time.perf_counter() - started
+    if drain: drain() # Дописать очередь - время потока логирования, не вызывающего
+    total = time.perf_counter() - started
+    logging_config.reset_log_context(token)
+    print(f"{label:<34} {elapsed / n * 1e6:7.2f} мкс/вызов (вместе с записью в поток: {total / n * 1e6:.2f})")
+
+
+def main(n: int):
+    settings.log_file = Path(BENCH_DIR) / "bench.log"; settings.log_to_db = False
+    app, noisy = logging.getLogger("bench.handlers"), logging.getLogger("aiogram.event")
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull): # Консоль - в /dev/null, сводка - в stdout
+        direct_logging()
+        measure("до: обработчики на root", app, n); measure("до: aiogram.event", noisy, n)
+        for json_format in (False, True):
+            settings.log_json = json_format; suffix = " (JSON)" if json_format else ""
+            logging_config.setup_logging(); measure(f"после: QueueHandler{suffix}", app, n, drain=logging_config.stop_log_listener)
+            logging_config.setup_logging(); measure(f"после: aiogram.event, семпл.{suffix}", noisy, n, drain=logging_config.stop_log_listener)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,63 @@
+"""
+Цена троттлинга на одно событие (user-032): прежний путь через FSM storage (StorageKey + get_data/set_data
+в MemoryStorage на каждое сообщение) против MemoryRateLimiter - голый hit_nowait и полный ThrottlingMiddleware.
+События идут по кругу от USERS пользователей. Запуск: python -m bench.rate_limiter [N]
+"""
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import bench.common # noqa: F401 - окружение до импорта core.config
+from core.config import settings
+from middlewares.throttling import ThrottlingMiddleware
+from utils.rate_limiter import MemoryRateLimiter, default_limits
+
+USERS = 5000
+BOT_ID = 1
+
+
+def report(label: str, elapsed: float, n: int): print(f"{label:<38} {elapsed / n * 1e9:8.0f} нс/событие")
+
+
+async def fsm_storage(n: int) -> float:
+    """ Тело прежнего ThrottlingMiddleware без вызова хендлера. """
+    storage = MemoryStorage()
+    started = time.perf_counter()
+    for i in range(n):
+        user_id = i % USERS; now = time.time()
+        key = StorageKey(bot_id=BOT_ID, chat_id=user_id, user_id=user_id, destiny="throttle") # В старом коде key= (в aiogram 3 - destiny)
+        data = await storage.get_data(key=key)
+        if now - (data.get("last_time", 0) if data else 0) < settings.throttling_rate_limit: continue
+        await storage.set_data(key=key, data={"last_time": now})
+    return time.perf_counter() - started
+
+
+def limiter_nowait(n: int) -> float:
+    limiter = MemoryRateLimiter(default_limits())
+    started = time.perf_counter()
+    for i in range(n): limiter.hit_nowait('default', i % USERS)
+    return time.perf_counter() - started
+
+
+async def middleware(n: int) -> float:
+    throttling = ThrottlingMiddleware(MemoryRateLimiter(default_limits()))
+    async def handler(event, data): return None
+    events = [{"event_from_user": SimpleNamespace(id=user_id)} for user_id in range(USERS)]
+    event = SimpleNamespace()
+    started = time.perf_counter()
+    for i in range(n): await throttling(handler, event, events[i % USERS])
+    return time.perf_counter() - started
+
+
+async def main(n: int):
+    report("до: FSM storage get_data/set_data", await fsm_storage(n), n)
+    report("после: MemoryRateLimiter.hit_nowait", limiter_nowait(n), n)
+    report("после: ThrottlingMiddleware целиком", await middleware(n), n)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000))
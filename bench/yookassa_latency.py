@@ -0,0 +1,51 @@
+"""
+Задержка создания платежа через YooKassaClient (httpx, пул keep-alive) против мока ЮKassa (tests/yookassa_mock.py).
+Если установлен SDK yookassa, для сравнения меряется старый путь: Payment.create в asyncio.to_thread
+(синхронный requests, соединение на каждый вызов). Запуск: python -m bench.yookassa_latency [N]
+"""
+import asyncio
+import sys
+import time
+from typing import List
+
+from bench.common import percentiles
+from services.yookassa_client import YooKassaClient
+from tests.yookassa_mock import MockYooKassa
+
+PAYMENT_DATA = {"amount": {"value": "99.00", "currency": "RUB"}, "confirmation": {"type": "redirect", "return_url": "https://t.me/"},
+                "capture": True, "metadata": {"user_id": "1"}}
+
+
+async def bench_client(base_url: str, n: int) -> List[float]:
+    client = YooKassaClient("shop", "secret", base_url, timeout=10.0, max_connections=10, max_retries=2)
+    samples = []
+    try:
+        for i in range(n):
+            started = time.perf_counter(); await client.create_payment(PAYMENT_DATA, f"client-{i}"); samples.append(time.perf_counter() - started)
+    finally: await client.close()
+    return samples
+
+
+async def bench_sdk(base_url: str, n: int) -> List[float]:
+    from yookassa import Configuration, Payment
+    Configuration.configure("shop", "secret"); Configuration.api_url = base_url
+    samples = []
+    for i in range(n):
+        started = time.perf_counter(); await asyncio.to_thread(Payment.create, PAYMENT_DATA, f"sdk-{i}"); samples.append(time.perf_counter() - started)
+    return samples
+
+
+async def main(n: int):
+    mock = MockYooKassa(); base_url = await mock.start()
+    try:
+        samples = await bench_client(base_url, n)
+        print(f"YooKassaClient (httpx pool): {percentiles(samples)}, соединений: {len(mock.connections)}")
+        try: import yookassa # noqa: F401
+        except ImportError: print("SDK yookassa не установлен - сравнение пропущено"); return
+        mock.connections.clear(); samples = await bench_sdk(base_url, n)
+        print(f"SDK yookassa + to_thread:    {percentiles(samples)}, соединений: {len(mock.connections)}")
+    finally: await mock.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 300))
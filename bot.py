@@ -1,13 +1,19 @@
 import asyncio
 import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import time
 import ssl
-import ipaddress
 from typing import Dict, Any, Callable, Awaitable, Optional # Добавлены Optional, Any
 
 from aiogram import Bot, Dispatcher, F, BaseMiddleware
+from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.fsm.context import FSMContext # Импорт FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+
 from aiogram.utils.callback_answer import CallbackAnswerMiddleware
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import Update, BotCommand, BotCommandScopeDefault
@@ -19,14 +25,23 @@ from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
 from core.config import settings
 
 # Импорт базы данных и middleware
-from database.database import init_models, async_session_factory
+from database.database import init_models, async_session_factory, engine
+from database.user_cache import user_cache
 from middlewares.db import DbSessionMiddleware
-from middlewares.logging import LoggingContextMiddleware
+from middlewares.logging import LoggingContextMiddleware, HandlerNameMiddleware
 from middlewares.throttling import ThrottlingMiddleware
+from middlewares.dedup import UpdateDeduplicationMiddleware
+from middlewares.activity import ActivityMiddleware, activity_tracker
 
 # Импорт утилит и сервисов
-from utils.logging_config import setup_logging
+from utils.logging_config import setup_logging, start_db_log_writer, stop_db_log_writer
+from utils.fsm_storage import create_fsm_storage
+from utils.http_metrics import latency_middleware, metrics_handler
+from utils.send_scheduler import send_scheduler
 from services import scheduler_service, payment_service # Импорт payment_service
+from services.job_queue import job_queue
+from services.broadcast_service import broadcast_runner
+from services.payment_inbox import payment_inbox_worker
 
 # Импорт роутеров
 from handlers import (
@@ -57,39 +72,40 @@ if settings.sentry_dsn:
 
 # --- Обработчик вебхука ЮKassa ---
 async def handle_yookassa_webhook(request: web.Request):
-    bot = request.app['bot']
-    session_factory = request.app['session_factory']
-    remote_ip_str = request.remote
+    """ Проверка IP и запись в payment_inbox; начисление и сообщение пользователю - в payment_inbox_worker, после ответа 200. """
     logger = logging.getLogger(__name__)
-    logger.debug(f"[Webhook YooKassa] Запрос от {remote_ip_str} на {settings.yookassa_webhook_path}")
-    try: # Проверка IP
-        remote_ip = ipaddress.ip_address(remote_ip_str)
-        if not any(remote_ip in ipaddress.ip_network(net) for net in settings.yookassa_ips):
-            logger.warning(f"[Webhook YooKassa] Недоверенный IP: {remote_ip_str}. Отказ."); return web.Response(status=403)
-    except ValueError: logger.warning(f"[Webhook YooKassa] Не распознан IP: {remote_ip_str}. Отказ."); return web.Response(status=400)
-    try: # Обработка данных
-        data = await request.json(); logger.info(f"[Webhook YooKassa] Данные: {str(data)[:500]}...")
-        async with session_factory() as session: # Создаем сессию
-            success = await payment_service.process_yookassa_notification(session=session, bot=bot, notification_data=data)
-        if success: logger.info(f"[Webhook YooKassa] Успешно обработано."); return web.Response(status=200)
-        else: logger.error(f"[Webhook YooKassa] Ошибка обработки."); return web.Response(status=500)
+    trusted = payment_service.is_yookassa_ip(request.remote)
+    if trusted is None: logger.warning(f"[Webhook YooKassa] Не распознан IP: {request.remote}. Отказ."); return web.Response(status=400)
+    if not trusted: logger.warning(f"[Webhook YooKassa] Недоверенный IP: {request.remote}. Отказ."); return web.Response(status=403)
+    try: data = await request.json()
+    except ValueError: logger.warning("[Webhook YooKassa] Тело не JSON."); return web.Response(status=400)
+    try:
+        async with request.app['session_factory']() as session: saved = await payment_service.ingest_yookassa_notification(session, data)
+        return web.Response(status=200 if saved else 500) # 500 - ЮKassa повторит
     except Exception as e: logger.exception(f"[Webhook YooKassa] Непредвиденная ошибка: {e}"); return web.Response(status=500)
 
 
 # --- Функции жизненного цикла ---
-async def on_startup(bot: Bot, dp: Dispatcher):
+async def on_startup(bot: Bot, dispatcher: Dispatcher, is_primary: bool):
+    """ Общие ресурсы - в каждом воркере; вебхук, команды и планировщик - только в основном (worker 0). """
     logger = logging.getLogger(__name__)
-    logger.info("Выполняется on_startup...")
+    logger.info(f"Выполняется on_startup (pid {os.getpid()}, основной: {is_primary})...")
     try: await init_models() # Проверка соединения с БД
     except Exception as e: logger.critical(f"Критическая ошибка БД: {e}.", exc_info=True); raise
-    #if not settings.webhook_domain: logger.critical("WEBHOOK_DOMAIN не задан!"); raise ValueError("WEBHOOK_DOMAIN не сконфигурирован")
-    #webhook_url = f"{settings.base_webhook_url}{settings.telegram_webhook_path}"
-    #try:
-        #await bot.set_webhook( url=webhook_url, secret_token=settings.telegram_webhook_secret.get_secret_value(),
-            #allowed_updates=dp.resolve_used_update_types() )
-        #logger.info(f"Вебхук Telegram установлен: {webhook_url}")
-    #except Exception as e: logger.error(f"Ошибка установки вебхука Telegram: {e}", exc_info=True); raise
+    start_db_log_writer() # Фоновая пакетная запись логов в БД
+    activity_tracker.start() # Пакетная запись last_activity_date
+    user_cache.start() # Сброс кэша пользователей между воркерами (при REDIS_URL)
+    job_queue.start(bot) # Очередь платных услуг (в каждом воркере, задачи забираются атомарно)
+    if not is_primary: logger.info("Воркер готов к работе!"); return
+    webhook_url = f"{settings.base_webhook_url}{settings.telegram_webhook_path}"
+    try:
+        await bot.set_webhook( url=webhook_url, secret_token=settings.telegram_webhook_secret.get_secret_value(),
+            allowed_updates=dispatcher.resolve_used_update_types() )
+        logger.info(f"Вебхук Telegram установлен: {settings.base_webhook_url}/webhook/telegram/***")
+    except Exception as e: logger.error(f"Ошибка установки вебхука Telegram: {e}", exc_info=True); raise
     scheduler_service.setup_scheduler_jobs(bot); scheduler_service.start_scheduler()
+    broadcast_runner.start(bot) # Рассылки (в т.ч. прерванные рестартом) - только в главном процессе
+    payment_inbox_worker.start(bot) # Уведомления ЮKassa, принятые любым воркером
     commands = [ BotCommand(command="start", description="🚀 Запустить/Перезапустить бота"),
                  BotCommand(command="help", description="ℹ️ Помощь и описание команд"),
                  BotCommand(command="menu", description="🏠 Показать главное меню"), ]
@@ -97,47 +113,43 @@ async def on_startup(bot: Bot, dp: Dispatcher):
     except Exception as e: logger.warning(f"Не удалось установить команды меню: {e}")
     logger.info("Бот готов к работе!")
 
-async def on_shutdown(bot: Bot):
-    #logger = logging.getLogger(__name__)
-    #logger.info("Выполняется on_shutdown...")
-    #scheduler_service.shutdown_scheduler()
-    #logger.info("Удаление вебхука Telegram...")
-    #try:
-    #    if bot.token: await bot.delete_webhook(drop_pending_updates=True) # Сбрасываем обновления при остановке
-    #    else: logger.warning("Токен бота отсутствует, пропуск удаления вебхука.")
-    #except Exception as e: logger.error(f"Ошибка удаления вебхука: {e}", exc_info=True)
-    #logger.info("Закрытие сессии бота...")
-    #try:
-    #    if bot.session and not bot.session.closed: await bot.session.close()
-    #except Exception as e: logger.error(f"Ошибка закрытия сессии бота: {e}", exc_info=True)
-    #logger.info("Ресурсы освобождены.")
-
-
-# --- Основная точка входа ---
-    def main():
-    # Настройка логирования
-        setup_logging() # Использует настройки из Pydantic
+async def on_shutdown(dispatcher: Dispatcher, is_primary: bool):
+    """
+    Вебхук не удаляется: при перезапуске Telegram копит апдейты и доставит их новым воркерам.
+    Сессию бота закрывает SimpleRequestHandler, здесь - планировщик, активность, буфер логов, FSM storage и движок БД.
+    """
     logger = logging.getLogger(__name__)
-    logger.info(f"Запуск бота в режиме вебхука (Порт: {settings.webhook_server_port})...")
+    logger.info("Выполняется on_shutdown...")
+    if is_primary: scheduler_service.shutdown_scheduler(); await broadcast_runner.stop(); await payment_inbox_worker.stop() # Курсор и inbox в БД - продолжатся после старта
+    await job_queue.stop() # Незавершенные задачи вернутся в очередь
+    await activity_tracker.stop() # Сбрасываем накопленную активность
+    await user_cache.stop()
+    await payment_service.close() # Пул соединений с ЮKassa
+    await stop_db_log_writer() # Сбрасываем буфер логов в БД
+    try: await dispatcher.storage.close()
+    except Exception as e: logger.error(f"Ошибка закрытия FSM storage: {e}", exc_info=True)
+    await engine.dispose()
+    logger.info("Ресурсы освобождены.")
 
-    if not settings.webhook_domain or not settings.telegram_webhook_path:
-        logger.critical("WEBHOOK_DOMAIN или TELEGRAM_WEBHOOK_PATH не задан! Запуск невозможен.")
-        return
 
-    # Инициализация Aiogram
-    storage = MemoryStorage() # Для FSM (можно заменить на RedisStorage для масштабирования)
-    bot = Bot(token=settings.telegram_bot_token.get_secret_value(), parse_mode=ParseMode.HTML)
-    dp = Dispatcher(storage=storage)
+# --- Сборка приложения ---
+def create_dispatcher(is_primary: bool) -> Dispatcher:
+    storage = create_fsm_storage() # FSM_STORAGE: memory | redis | sql (общий для нескольких воркеров)
+    dp = Dispatcher(storage=storage, is_primary=is_primary)
 
     # Регистрация Middleware (порядок важен!)
     dp.update.outer_middleware(LoggingContextMiddleware())
+    dp.update.outer_middleware(UpdateDeduplicationMiddleware()) # До сессии БД: повтор апдейта не доходит до хендлеров
+    dp.update.outer_middleware(ActivityMiddleware()) # Только в память, в БД - пакетно
     dp.update.outer_middleware(DbSessionMiddleware(session_factory=async_session_factory))
-    dp.message.middleware(ThrottlingMiddleware(storage=storage)) # Передаем storage в троттлинг
-    dp.callback_query.middleware(ThrottlingMiddleware(storage=storage))
+    dp.message.middleware(HandlerNameMiddleware())
+    dp.callback_query.middleware(HandlerNameMiddleware())
+    throttling = ThrottlingMiddleware() # Один limiter на сообщения и колбеки
+    dp.message.middleware(throttling)
+    dp.callback_query.middleware(throttling)
     dp.callback_query.middleware(CallbackAnswerMiddleware())
 
     # Регистрация роутеров
-    logger.info("Регистрация роутеров...")
     dp.include_router(admin.admin_router) # Админский роутер первым
     dp.include_router(common.common_router)
     dp.include_router(astrology.astrology_router)
@@ -148,44 +160,103 @@ async def on_shutdown(bot: Bot):
     dp.include_router(referral.referral_router)
 
     # Регистрация хуков startup/shutdown
-    dp.startup.register(lambda dispatcher=dp: on_startup(bot, dispatcher))
-    dp.shutdown.register(lambda: on_shutdown(bot))
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    return dp
 
-    # Настройка и запуск веб-приложения aiohttp
-    #app = web.Application()
-    #app['bot'] = bot
-    #app['session_factory'] = async_session_factory
+def create_app(is_primary: bool) -> web.Application:
+    """ Одно aiohttp-приложение: вебхуки Telegram и ЮKassa (+ метрики задержки по маршрутам). """
+    bot = Bot(token=settings.telegram_bot_token.get_secret_value(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot.session.middleware(send_scheduler) # Все запросы к Bot API: лимиты общий/на чат, приоритеты, повтор после 429
+    dp = create_dispatcher(is_primary)
+
+    app = web.Application(middlewares=[latency_middleware(settings.web_slow_request_seconds)])
+    app['bot'] = bot
+    app['session_factory'] = async_session_factory
 
     # Роут для вебхука ЮKassa
-    #app.router.add_post(settings.yookassa_webhook_path, handle_yookassa_webhook)
+    app.router.add_post(settings.yookassa_webhook_path, handle_yookassa_webhook, name='yookassa_webhook')
 
-    # Роут для вебхука Telegram
-    #webhook_requests_handler = SimpleRequestHandler(
-    #    dispatcher=dp,
-    #    bot=bot,
-    #    secret_token=settings.telegram_webhook_secret.get_secret_value()
-    #)
-    #webhook_requests_handler.register(app, path=settings.telegram_webhook_path)
+    # Роут для вебхука Telegram (name - чтобы секрет из пути не попадал в метрики и логи)
+    webhook_requests_handler = SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=settings.telegram_webhook_secret.get_secret_value(),
+        handle_in_background=True, # Сразу 200 для Telegram; долгие услуги уходят в job_queue
+    )
+    webhook_requests_handler.register(app, path=settings.telegram_webhook_path, name='telegram_webhook')
+    if settings.metrics_path: app.router.add_get(settings.metrics_path, metrics_handler, name='metrics')
 
     # Связываем жизненный цикл Aiogram и aiohttp
-    #setup_application(app, dp, bot=bot)
+    setup_application(app, dp, bot=bot)
+    return app
+
 
-    # Запуск веб-сервера
+# --- Запуск ---
+def run_worker(worker_index: int, sock: Optional[socket.socket] = None):
+    """ Один процесс-воркер. sock - общий сокет от мастера (pre-fork), иначе слушаем host:port сами. """
+    if sock is not None: # После fork: свои соединения с БД и поток логирования
+        engine.sync_engine.dispose(close=False)
+        setup_logging(session_factory=async_session_factory)
+    logger = logging.getLogger(__name__)
+    app = create_app(is_primary=worker_index == 0)
     # Настройки SSL должны быть здесь, если НЕ используется обратный прокси
     # ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     # ssl_context.load_cert_chain('path/to/fullchain.pem', 'path/to/privkey.pem')
-    #logger.info(f"Запуск веб-сервера на http://{settings.webhook_server_listen_host}:{settings.webhook_server_port}")
-    #web.run_app(
-    #    app,
-    #    host=settings.webhook_server_listen_host,
-    #    port=settings.webhook_server_port,
+    if sock is not None: web.run_app(app, sock=sock, print=None)
+    else:
+        logger.info(f"Запуск веб-сервера на http://{settings.webhook_server_listen_host}:{settings.webhook_server_port}")
+        web.run_app(app, host=settings.webhook_server_listen_host, port=settings.webhook_server_port, print=None)
         # ssl_context=ssl_context # Раскомментировать для HTTPS напрямую
-    #)
-
-    if __name__ == "__main__":
-        try:
-            main()
-        except (KeyboardInterrupt, SystemExit):
-            logging.getLogger(__name__).info("Бот остановлен.")
-        except Exception as e:
-            logging.getLogger(__name__).critical(f"Критическая ошибка запуска: {e}", exc_info=True)
\ No newline at end of file
+
+def run_prefork(workers: int):
+    """ Мастер: открывает сокет, форкает воркеров, перезапускает упавших, по SIGTERM/SIGINT гасит всех. """
+    logger = logging.getLogger(__name__)
+    sock = socket.socket(socket.AF_INET6 if ':' in settings.webhook_server_listen_host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((settings.webhook_server_listen_host, settings.webhook_server_port)); sock.listen(1024); sock.set_inheritable(True)
+    logger.info(f"Запуск {workers} воркеров на http://{settings.webhook_server_listen_host}:{settings.webhook_server_port}")
+
+    ctx = multiprocessing.get_context('fork')
+    procs: Dict[int, multiprocessing.Process] = {}
+    stopping = False
+    def spawn(index: int):
+        p = ctx.Process(target=run_worker, args=(index, sock), name=f"bot-worker-{index}", daemon=False); p.start(); procs[index] = p
+    def stop(signum, frame):
+        nonlocal stopping; stopping = True
+        for p in procs.values():
+            if p.is_alive(): p.terminate() # SIGTERM -> graceful shutdown aiohttp в воркере
+    signal.signal(signal.SIGTERM, stop); signal.signal(signal.SIGINT, stop)
+
+    for i in range(workers): spawn(i)
+    while procs:
+        multiprocessing.connection.wait([p.sentinel for p in procs.values()], timeout=1.0)
+        for index, p in list(procs.items()):
+            if p.is_alive(): continue
+            del procs[index]
+            if not stopping:
+                logger.error(f"Воркер {index} завершился (код {p.exitcode}), перезапуск..."); time.sleep(1); spawn(index)
+    sock.close(); logger.info("Все воркеры остановлены.")
+
+def main():
+    # Настройка логирования
+    # Мастер pre-fork в БД не пишет: там нет event loop для писателя логов, воркеры настроят свое
+    setup_logging(session_factory=async_session_factory if settings.web_workers <= 1 else None) # Использует настройки из Pydantic
+    logger = logging.getLogger(__name__)
+    logger.info(f"Запуск бота в режиме вебхука (Порт: {settings.webhook_server_port}, воркеров: {settings.web_workers})...")
+
+    if not settings.webhook_domain or not settings.telegram_webhook_path:
+        logger.critical("WEBHOOK_DOMAIN или TELEGRAM_WEBHOOK_PATH не задан! Запуск невозможен.")
+        return
+
+    if settings.web_workers > 1: run_prefork(settings.web_workers)
+    else: run_worker(0)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except (KeyboardInterrupt, SystemExit):
+        logging.getLogger(__name__).info("Бот остановлен.")
+    except Exception as e:
+        logging.getLogger(__name__).critical(f"Критическая ошибка запуска: {e}", exc_info=True)
@@ -22,6 +22,9 @@ class Settings(BaseSettings):
     yookassa_webhook_path: str = Field("/webhook/yookassa", validation_alias='YOOKASSA_WEBHOOK_PATH')
     base_webhook_url: Optional[str] = None # Вычисляется ниже
     telegram_webhook_path: Optional[str] = None # Вычисляется ниже
+    web_workers: int = Field(1, validation_alias='WEB_WORKERS') # >1 - pre-fork: N процессов на одном сокете
+    web_slow_request_seconds: float = Field(1.0, validation_alias='WEB_SLOW_REQUEST_SECONDS') # Порог WARNING о медленном запросе
+    metrics_path: Optional[str] = Field(None, validation_alias='METRICS_PATH') # Напр. /metrics (закрыть на прокси!)
 
     # --- OpenAI ---
     openai_api_key: SecretStr = Field(..., validation_alias='OPENAI_API_KEY')
@@ -31,6 +34,10 @@ class Settings(BaseSettings):
     # --- YooKassa ---
     yookassa_shop_id: Optional[str] = Field(None, validation_alias='YOOKASSA_SHOP_ID')
     yookassa_secret_key: Optional[SecretStr] = Field(None, validation_alias='YOOKASSA_SECRET_KEY')
+    yookassa_api_url: str = Field("https://api.yookassa.ru/v3", validation_alias='YOOKASSA_API_URL') # Для тестов - адрес мок-сервера
+    yookassa_timeout: float = Field(10.0, validation_alias='YOOKASSA_TIMEOUT') # Сек на запрос (соединение - не дольше 5)
+    yookassa_max_connections: int = Field(10, validation_alias='YOOKASSA_MAX_CONNECTIONS') # Пул keep-alive соединений на процесс
+    yookassa_max_retries: int = Field(2, validation_alias='YOOKASSA_MAX_RETRIES') # Повторы при 5xx/429/202/сетевых ошибках (с тем же ключом идемпотентности)
 
     # --- Администраторы ---
     admin_ids: List[int] = Field(default_factory=list, validation_alias='ADMIN_IDS')
@@ -38,6 +45,16 @@ class Settings(BaseSettings):
     # --- База данных ---
     database_url: str = Field("sqlite+aiosqlite:///astro_bot.db", validation_alias='DATABASE_URL')
     sync_database_url: Optional[str] = None # Вычисляется ниже
+    # PostgreSQL (postgresql+asyncpg://...): пул и кэш подготовленных выражений
+    db_pool_size: int = Field(10, validation_alias='DB_POOL_SIZE')
+    db_max_overflow: int = Field(10, validation_alias='DB_MAX_OVERFLOW')
+    db_pool_timeout: float = Field(10.0, validation_alias='DB_POOL_TIMEOUT') # Ожидание свободного соединения (сек)
+    db_pool_recycle: int = Field(1800, validation_alias='DB_POOL_RECYCLE') # Пересоздавать соединения старше (сек)
+    db_statement_cache_size: int = Field(500, validation_alias='DB_STATEMENT_CACHE_SIZE') # 0 - за PgBouncer в режиме transaction
+    # SQLite: применяется к каждому новому соединению
+    sqlite_busy_timeout_ms: int = Field(5000, validation_alias='SQLITE_BUSY_TIMEOUT_MS') # Ожидание блокировки записи
+    sqlite_mmap_size: int = Field(256 * 1024 * 1024, validation_alias='SQLITE_MMAP_SIZE') # Байт memory-mapped I/O (0 - выкл.)
+    sqlite_cache_size_kib: int = Field(20000, validation_alias='SQLITE_CACHE_SIZE_KIB') # Кэш страниц на соединение
 
     # --- Контакты и Ссылки ---
     refund_contact_email: EmailStr = Field("admin@example.com", validation_alias='REFUND_CONTACT_EMAIL')
@@ -55,14 +72,28 @@ class Settings(BaseSettings):
     service_cost: int = Field(1, validation_alias='SERVICE_COST')
     first_service_free: bool = Field(True, validation_alias='FIRST_SERVICE_FREE')
 
+    # --- Ежедневный гороскоп ---
+    horoscope_lookahead_minutes: int = Field(15, validation_alias='HOROSCOPE_LOOKAHEAD_MINUTES') # Генерация заранее
+    horoscope_max_attempts: int = Field(3, validation_alias='HOROSCOPE_MAX_ATTEMPTS')
+    horoscope_concurrency: int = Field(5, validation_alias='HOROSCOPE_CONCURRENCY') # Параллельные запросы к OpenAI
+    horoscope_send_concurrency: int = Field(10, validation_alias='HOROSCOPE_SEND_CONCURRENCY') # Одновременных отправок (темп задает TELEGRAM_SEND_RATE)
+    horoscope_send_batch_size: int = Field(100, validation_alias='HOROSCOPE_SEND_BATCH_SIZE') # Записей на пачку (одно обновление статусов)
+
     # --- Настройки Логирования ---
     log_level: str = Field("INFO", validation_alias='LOG_LEVEL')
     log_to_db: bool = Field(True, validation_alias='LOG_TO_DB')
+    log_db_batch_size: int = Field(100, validation_alias='LOG_DB_BATCH_SIZE') # Записей в одном INSERT
+    log_db_flush_interval: float = Field(1.0, validation_alias='LOG_DB_FLUSH_INTERVAL') # Секунд между сбросами
+    log_db_buffer_size: int = Field(10000, validation_alias='LOG_DB_BUFFER_SIZE') # Сверх лимита записи отбрасываются
+    log_db_retention_days: int = Field(30, validation_alias='LOG_DB_RETENTION_DAYS') # Логи в БД старше удаляются (0 - хранить все)
     log_format: str = Field(
         '%(asctime)s - %(name)s - %(levelname)s - [%(funcName)s:%(lineno)d] - (%(user_id)s) - %(message)s',
         validation_alias='LOG_FORMAT'
     )
     log_file: Optional[Path] = None # Вычисляется ниже
+    log_json: bool = Field(False, validation_alias='LOG_JSON') # Структурированный JSON в консоль/файл
+    log_noisy_loggers: str = Field("aiogram,httpx", validation_alias='LOG_NOISY_LOGGERS') # Префиксы через запятую
+    log_noisy_sample_rate: float = Field(0.1, validation_alias='LOG_NOISY_SAMPLE_RATE') # Доля DEBUG/INFO "шумных" логгеров (1.0 - все)
 
     # --- Мониторинг ---
     sentry_dsn: Optional[str] = Field(None, validation_alias='SENTRY_DSN')
@@ -76,7 +107,57 @@ class Settings(BaseSettings):
 
     # --- Throttling ---
     throttling_rate_limit: float = Field(0.7, validation_alias='THROTTLING_RATE_LIMIT')
-    throttling_rate_period: float = Field(1.0, validation_alias='THROTTLING_RATE_PERIOD')
+    throttling_rate_period: float = Field(1.0, validation_alias='THROTTLING_RATE_PERIOD') # Окно всплеска: подряд до rate_period/rate_limit событий
+    throttling_paid_rate_limit: float = Field(5.0, validation_alias='THROTTLING_PAID_RATE_LIMIT') # Платные услуги (flags={"throttling_key": "paid"})
+    throttling_backend: str = Field("memory", validation_alias='THROTTLING_BACKEND') # memory | redis
+
+    # --- Redis (общее состояние нескольких реплик) ---
+    redis_url: Optional[str] = Field(None, validation_alias='REDIS_URL')
+
+    # --- Дедупликация апдейтов (ретраи вебхука) ---
+    dedup_backend: str = Field("memory", validation_alias='DEDUP_BACKEND') # memory | redis
+    dedup_window_seconds: float = Field(600.0, validation_alias='DEDUP_WINDOW_SECONDS')
+    dedup_max_updates: int = Field(10000, validation_alias='DEDUP_MAX_UPDATES')
+
+    # --- Исходящие запросы к Telegram (общий планировщик отправки) ---
+    telegram_send_rate: float = Field(30.0, validation_alias='TELEGRAM_SEND_RATE') # Запросов в секунду на процесс (лимит Telegram ~30/с)
+    telegram_send_min_rate: float = Field(5.0, validation_alias='TELEGRAM_SEND_MIN_RATE') # Нижняя граница темпа после 429
+    telegram_send_recovery_seconds: float = Field(60.0, validation_alias='TELEGRAM_SEND_RECOVERY_SECONDS') # За сколько темп возвращается к максимуму
+    telegram_chat_interval: float = Field(1.0, validation_alias='TELEGRAM_CHAT_INTERVAL') # Сек между сообщениями в один чат
+    telegram_chat_burst: int = Field(3, validation_alias='TELEGRAM_CHAT_BURST') # Подряд в один чат без ожидания (ответ + меню)
+    telegram_send_max_retries: int = Field(3, validation_alias='TELEGRAM_SEND_MAX_RETRIES') # Повторов после 429 (RetryAfter)
+    telegram_flood_window_seconds: float = Field(10.0, validation_alias='TELEGRAM_FLOOD_WINDOW_SECONDS') # 429 в течение окна после паузы другого - общая пауза и снижение темпа
+
+    # --- Уведомления ЮKassa: inbox (вебхук только сохраняет) и outbox сообщений пользователям ---
+    payment_inbox_batch_size: int = Field(100, validation_alias='PAYMENT_INBOX_BATCH_SIZE') # Уведомлений на транзакцию
+    payment_inbox_poll_interval: float = Field(2.0, validation_alias='PAYMENT_INBOX_POLL_INTERVAL') # Сек (вебхук в главном воркере будит сразу)
+    payment_inbox_max_attempts: int = Field(5, validation_alias='PAYMENT_INBOX_MAX_ATTEMPTS') # Для обработки и для отправки сообщения
+    payment_reconcile_interval_minutes: int = Field(10, validation_alias='PAYMENT_RECONCILE_INTERVAL_MINUTES') # Сверка платежей без уведомления
+    payment_reconcile_min_age_minutes: int = Field(15, validation_alias='PAYMENT_RECONCILE_MIN_AGE_MINUTES') # Моложе - еще ждем вебхук
+    payment_reconcile_max_age_hours: int = Field(72, validation_alias='PAYMENT_RECONCILE_MAX_AGE_HOURS') # Старше - только ручная проверка
+    payment_reconcile_concurrency: int = Field(5, validation_alias='PAYMENT_RECONCILE_CONCURRENCY') # Одновременных запросов к ЮKassa (не больше пула)
+
+    # --- Рассылки ---
+    broadcast_concurrency: int = Field(10, validation_alias='BROADCAST_CONCURRENCY') # Одновременных запросов send_message (темп задает TELEGRAM_SEND_RATE)
+    broadcast_page_size: int = Field(100, validation_alias='BROADCAST_PAGE_SIZE') # Получателей на страницу (между сохранениями курсора)
+    broadcast_progress_interval: float = Field(10.0, validation_alias='BROADCAST_PROGRESS_INTERVAL') # Сек между обновлениями прогресса
+
+    # --- Кэш горячих полей пользователя (баланс, флаги) ---
+    user_cache_ttl: float = Field(30.0, validation_alias='USER_CACHE_TTL') # Сек; 0 - выключить
+    user_cache_size: int = Field(10000, validation_alias='USER_CACHE_SIZE')
+
+    # --- Активность пользователей ---
+    activity_flush_interval: float = Field(60.0, validation_alias='ACTIVITY_FLUSH_INTERVAL') # Сек между пакетными UPDATE last_activity_date
+
+    # --- Фоновая очередь платных услуг ---
+    job_workers: int = Field(4, validation_alias='JOB_WORKERS') # Одновременных задач на процесс
+    job_timeout_seconds: float = Field(300.0, validation_alias='JOB_TIMEOUT_SECONDS')
+    job_max_attempts: int = Field(2, validation_alias='JOB_MAX_ATTEMPTS') # Повтор только после падения воркера
+    job_poll_interval: float = Field(5.0, validation_alias='JOB_POLL_INTERVAL')
+
+    # --- FSM ---
+    fsm_storage: str = Field("memory", validation_alias='FSM_STORAGE') # memory | redis | sql
+    fsm_ttl_seconds: int = Field(86400, validation_alias='FSM_TTL_SECONDS') # Брошенный сценарий живет сутки
 
     model_config = SettingsConfigDict(
         env_file=BASE_DIR / '.env',
@@ -112,7 +193,8 @@ class Settings(BaseSettings):
         if self.webhook_domain:
             self.base_webhook_url = f"https://{self.webhook_domain}"
             self.telegram_webhook_path = f"/webhook/telegram/{self.telegram_webhook_secret.get_secret_value()}"
-        self.sync_database_url = self.database_url.replace("sqlite+aiosqlite", "sqlite")
+        # Синхронный URL для APScheduler и offline-миграций Alembic
+        self.sync_database_url = self.database_url.replace("sqlite+aiosqlite", "sqlite").replace("postgresql+asyncpg", "postgresql+psycopg")
         self.log_file = self.log_dir / "bot.log"
         for path in [self.static_dir, self.pdf_dir, self.temp_dir, self.log_dir, self.prompt_dir]:
             try: path.mkdir(parents=True, exist_ok=True)
@@ -1,170 +1,713 @@
 import logging
-import secrets
-from typing import List, Optional, Dict, Any, Set
-from pathlib import Path
-
-from pydantic import Field, SecretStr, AnyHttpUrl, EmailStr, field_validator, ValidationInfo, HttpUrl
-from pydantic_settings import BaseSettings, SettingsConfigDict
-
-# Определяем базовую директорию относительно этого файла
-BASE_DIR = Path(__file__).resolve().parent.parent
-
-class Settings(BaseSettings):
-    """ Основные настройки приложения, загружаемые из .env """
-    # --- Telegram ---
-    telegram_bot_token: SecretStr = Field(..., validation_alias='TELEGRAM_BOT_TOKEN')
-
-    # --- Webhook ---
-    webhook_domain: str = Field(..., validation_alias='WEBHOOK_DOMAIN')
-    webhook_server_port: int = Field(8443, validation_alias='WEB_SERVER_PORT')
-    webhook_server_listen_host: str = Field("0.0.0.0", validation_alias='WEB_SERVER_LISTEN_HOST')
-    telegram_webhook_secret: SecretStr = Field(default_factory=lambda: secrets.token_urlsafe(32), validation_alias='TELEGRAM_WEBHOOK_SECRET')
-    yookassa_webhook_path: str = Field("/webhook/yookassa", validation_alias='YOOKASSA_WEBHOOK_PATH')
-    base_webhook_url: Optional[str] = None # Вычисляется ниже
-    telegram_webhook_path: Optional[str] = None # Вычисляется ниже
-
-    # --- OpenAI ---
-    openai_api_key: SecretStr = Field(..., validation_alias='OPENAI_API_KEY')
-    openai_model: str = Field("gpt-4o-mini-2024-07-18", validation_alias='OPENAI_MODEL')
-    openai_timeout: int = Field(120, validation_alias='OPENAI_TIMEOUT')
-
-    # --- YooKassa ---
-    yookassa_shop_id: Optional[str] = Field(None, validation_alias='YOOKASSA_SHOP_ID')
-    yookassa_secret_key: Optional[SecretStr] = Field(None, validation_alias='YOOKASSA_SECRET_KEY')
-
-    # --- Администраторы ---
-    admin_ids: List[int] = Field(default_factory=list, validation_alias='ADMIN_IDS')
-
-    # --- База данных ---
-    database_url: str = Field("sqlite+aiosqlite:///astro_bot.db", validation_alias='DATABASE_URL')
-    sync_database_url: Optional[str] = None # Вычисляется ниже
-
-    # --- Контакты и Ссылки ---
-    refund_contact_email: EmailStr = Field("admin@example.com", validation_alias='REFUND_CONTACT_EMAIL')
-    legal_notice_url_terms: HttpUrl = Field("https://example.com/terms", validation_alias='LEGAL_NOTICE_URL_TERMS')
-    legal_notice_url_privacy: HttpUrl = Field("https://example.com/privacy", validation_alias='LEGAL_NOTICE_URL_PRIVACY')
-
-    # --- Пути (относительно BASE_DIR) ---
-    static_dir: Path = Field(BASE_DIR / "static")
-    pdf_dir: Path = Field(BASE_DIR / "static" / "pdf")
-    temp_dir: Path = Field(BASE_DIR / "temp")
-    log_dir: Path = Field(BASE_DIR / "logs")
-    prompt_dir: Path = Field(BASE_DIR / "prompts")
-
-    # --- Настройки Услуг ---
-    service_cost: int = Field(1, validation_alias='SERVICE_COST')
-    first_service_free: bool = Field(True, validation_alias='FIRST_SERVICE_FREE')
-
-    # --- Настройки Логирования ---
-    log_level: str = Field("INFO", validation_alias='LOG_LEVEL')
-    log_to_db: bool = Field(True, validation_alias='LOG_TO_DB')
-    log_format: str = Field(
-        '%(asctime)s - %(name)s - %(levelname)s - [%(funcName)s:%(lineno)d] - (%(user_id)s) - %(message)s',
-        validation_alias='LOG_FORMAT'
-    )
-    log_file: Optional[Path] = None # Вычисляется ниже
-
-    # --- Мониторинг ---
-    sentry_dsn: Optional[str] = Field(None, validation_alias='SENTRY_DSN')
-
-    # --- Безопасность (IP ЮKassa) ---
-    yookassa_ips: Set[str] = Field(default={
-        "185.71.76.0/27", "185.71.77.0/27", "77.75.153.0/25",
-        "77.75.154.128/25", "2a02:5180:0:1509::/64", "2a02:5180:0:2655::/64",
-        "2a02:5180:0:1536::/64", "2a02:5180:0:2669::/64",
-    })
-
-    # --- Throttling ---
-    throttling_rate_limit: float = Field(0.7, validation_alias='THROTTLING_RATE_LIMIT')
-    throttling_rate_period: float = Field(1.0, validation_alias='THROTTLING_RATE_PERIOD')
-
-    model_config = SettingsConfigDict(
-        env_file=BASE_DIR / '.env',
-        env_file_encoding='utf-8',
-        extra='ignore',
-        case_sensitive=False
-    )
-
-    # --- Валидаторы и вычисляемые поля ---
-    @field_validator('admin_ids', mode='before')
-    @classmethod
-    def assemble_admin_ids(cls, v: Any) -> List[int]:
-        if isinstance(v, str):
-            try: return [int(admin_id.strip()) for admin_id in v.split(',') if admin_id.strip()]
-            except ValueError: raise ValueError(f"Неверный формат ADMIN_IDS: '{v}'.")
-        return v if isinstance(v, list) else []
-
-    @field_validator('log_level', mode='before')
-    @classmethod
-    def assemble_log_level(cls, v: str) -> str:
-        level = v.strip().upper()
-        if level not in ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]: raise ValueError(f"Неверный уровень логирования: {v}")
-        return level
-
-    @field_validator('yookassa_webhook_path', mode='before')
-    @classmethod
-    def assemble_yookassa_path(cls, v: str) -> str:
-        path = v.strip()
-        if not path.startswith('/'): raise ValueError(f"YOOKASSA_WEBHOOK_PATH должен начинаться с '/': {path}")
-        return path
-
-    def model_post_init(self, __context: Any) -> None:
-        if self.webhook_domain:
-            self.base_webhook_url = f"https://{self.webhook_domain}"
-            self.telegram_webhook_path = f"/webhook/telegram/{self.telegram_webhook_secret.get_secret_value()}"
-        self.sync_database_url = self.database_url.replace("sqlite+aiosqlite", "sqlite")
-        self.log_file = self.log_dir / "bot.log"
-        for path in [self.static_dir, self.pdf_dir, self.temp_dir, self.log_dir, self.prompt_dir]:
-            try: path.mkdir(parents=True, exist_ok=True)
-            except OSError as e: logging.error(f"Ошибка создания директории {path}: {e}")
-
-
-try:
-    settings = Settings()
-    # Логируем после настройки logging в bot.py
-except Exception as e:
-     print(f"CRITICAL: Ошибка загрузки настроек: {e}")
-     raise ValueError(f"Ошибка конфигурации: {e}")
-
-# --- Константы для удобства ---
-SERVICE_NATAL_CHART = "natal_chart"
-SERVICE_FORECAST = "forecast"
-SERVICE_COMPATIBILITY = "compatibility"
-SERVICE_DREAM = "dream"
-SERVICE_SIGNS = "signs"
-SERVICE_PALMISTRY = "palmistry"
-
-PAID_SERVICES = {
-    SERVICE_NATAL_CHART: "Персональная натальная карта",
-    SERVICE_FORECAST: "Персональный прогноз на год",
-    SERVICE_COMPATIBILITY: "Проверка совместимости",
-    SERVICE_DREAM: "Толкование сна",
-    SERVICE_SIGNS: "Значение приметы",
-    SERVICE_PALMISTRY: "Хиромантия по фото рук",
-}
-
-PAYMENT_OPTIONS = {
-    "buy_1": {"price": 9900, "credits": 1, "description": "1 услуга (99 ₽)"},
-    "buy_3": {"price": 27900, "credits": 3, "description": "3 услуги (93 ₽/шт)"},
-    "buy_5": {"price": 44900, "credits": 5, "description": "5 услуг (90 ₽/шт)"},
-    "buy_10": {"price": 84900, "credits": 10, "description": "10 услуг (85 ₽/шт)"},
-    "buy_20": {"price": 149900, "credits": 20, "description": "20 услуг (75 ₽/шт)"},
-}
-
-# Дисклеймеры (можно вынести в отдельный файл или оставить здесь)
-ACCEPT_TERMS_PROMPT = "Пожалуйста, ознакомьтесь с условиями и примите их для продолжения."
-PALMISTRY_DISCLAIMER = "Помните, что анализ ладони с помощью ИИ носит общий и развлекательный характер и не является профессиональной хиромантией."
-ASTROLOGY_DISCLAIMER = "Астрологические интерпретации, сгенерированные ИИ, носят информационно-развлекательный характер и не заменяют консультацию профессионального астролога."
-GEOCODING_DISCLAIMER = "Координаты определяются автоматически по названию города. Для большей точности используйте ближайший крупный город или проверьте данные." # Вернули дисклеймер для Geopy
-PAYMENT_THANK_YOU = "Спасибо за покупку! Ваши кредиты ({credits}) были успешно зачислены."
-PAYMENT_ERROR = "Произошла ошибка во время обработки платежа. Пожалуйста, попробуйте позже или свяжитесь с поддержкой."
-PAYMENT_PENDING = "Ваш платеж находится в обработке. Кредиты будут зачислены после подтверждения оплаты ЮKassa."
-
-# Формируем текст LEGAL_NOTICE здесь, используя URL из settings
-LEGAL_NOTICE = (
-    f"Нажимая 'Принять', вы подтверждаете, что ознакомились и согласны с "
-    f"<a href='{settings.legal_notice_url_terms}'>Пользовательским соглашением</a> и "
-    f"<a href='{settings.legal_notice_url_privacy}'>Политикой конфиденциальности</a>. "
-    "Вы также понимаете, что предоставляемые ботом услуги носят "
-    "информационно-развлекательный характер."
-)
\ No newline at end of file
+import json
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from sqlalchemy import select, update, delete, func, tuple_, table, column, literal_column, Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+from sqlalchemy.exc import SQLAlchemyError
+
+from database.models import (
+    User, NatalData, Payment, Log, PaymentStatus, LogLevel, HoroscopeOutbox, HoroscopeStatus, UndeliverableReason,
+    ServiceJob, JobStatus, CreditLedger, CreditReason, DailyStats, DailyServiceStats, Broadcast, BroadcastStatus, TelegramAsset,
+    PaymentNotification, NotificationOutbox, NotificationStatus, log_search_document
+)
+from database.database import insert_for
+from database.user_cache import user_cache
+from utils.referral_utils import generate_unique_referral_code # Реэкспорт для хендлеров
+
+logger = logging.getLogger(__name__)
+
+# --- Пользователи ---
+async def get_user(session: AsyncSession, user_id: int) -> Optional[User]:
+    return await session.get(User, user_id)
+
+class UserStatus(NamedTuple):
+    """ Легкая проекция User для частых проверок (баланс, бесплатная услуга, условия). """
+    id: int; credits: int; first_service_used: bool; accepted_terms: bool
+    daily_horoscope_time: Optional[str]; referrer_id: Optional[int]
+
+USER_STATUS_COLUMNS = (User.id, User.credits, User.first_service_used, User.accepted_terms,
+                       User.daily_horoscope_time, User.referrer_id)
+
+async def get_user_status(session: AsyncSession, user_id: int) -> Optional[UserStatus]:
+    """ Только горячие поля пользователя, без загрузки ORM-объекта и связей. Читается через user_cache. """
+    status = user_cache.get(user_id)
+    if status is not None: return status
+    version = user_cache.version
+    row = (await session.execute(select(*USER_STATUS_COLUMNS).where(User.id == user_id))).first()
+    if row is None: return None
+    status = UserStatus(*row); user_cache.put(user_id, status, version)
+    return status
+
+async def get_user_by_username(session: AsyncSession, username: str) -> Optional[User]:
+    return await session.scalar(select(User).where(func.lower(User.username) == username.lower()).limit(1))
+
+async def get_user_by_referral_code(session: AsyncSession, referral_code: str) -> Optional[User]:
+    return await session.scalar(select(User).where(User.referral_code == referral_code).limit(1))
+
+async def create_or_update_user(
+    session: AsyncSession, user_id: int, username: Optional[str], first_name: str,
+    last_name: Optional[str], language_code: Optional[str], referrer_id: Optional[int] = None
+) -> Optional[User]:
+    """ Создает пользователя или обновляет его профиль. Реферер сохраняется только при создании. """
+    try:
+        user = await session.get(User, user_id)
+        if user is None:
+            user = User(id=user_id, username=username, first_name=first_name or "", last_name=last_name,
+                        language_code=language_code, referrer_id=referrer_id)
+            session.add(user); logger.info(f"Новый пользователь {user_id} (referrer: {referrer_id})")
+            await _bump_daily_stats(session, new_users=1)
+        else:
+            user.username = username; user.first_name = first_name or user.first_name
+            user.last_name = last_name; user.language_code = language_code
+            if not user.is_deliverable: # Пишет боту - значит, снова доступен для рассылок и гороскопов
+                logger.info(f"User {user_id} is deliverable again (was {user.undeliverable_reason.name if user.undeliverable_reason else '?'}).")
+                user.is_deliverable = True; user.undeliverable_reason = None; user.undeliverable_since = None
+        await session.commit(); await session.refresh(user); await user_cache.invalidate(user_id)
+        return user
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error create_or_update_user {user_id}: {e}"); await session.rollback(); return None
+
+async def set_user_accepted_terms(session: AsyncSession, user_id: int) -> bool:
+    try:
+        result = await session.execute(update(User).where(User.id == user_id).values(accepted_terms=True))
+        await session.commit(); await user_cache.invalidate(user_id); return result.rowcount > 0
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error set_user_accepted_terms {user_id}: {e}"); await session.rollback(); return False
+
+async def deactivate_user(session: AsyncSession, user_id: int, reason: UndeliverableReason) -> bool:
+    """ Отмечает чат недоставляемым (403/404 при отправке). True - если пользователь был доставляемым. """
+    try:
+        result = await session.execute(
+            update(User).where(User.id == user_id, User.is_deliverable.is_(True))
+            .values(is_deliverable=False, undeliverable_reason=reason, undeliverable_since=datetime.now(timezone.utc)))
+        await session.commit(); return result.rowcount > 0
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error deactivate_user {user_id}: {e}"); await session.rollback(); return False
+
+async def get_user_credits(session: AsyncSession, user_id: int) -> int:
+    status = await get_user_status(session, user_id)
+    return status.credits if status else 0
+
+# --- Кредиты ---
+# Баланс меняется только одним UPDATE ... SET credits = credits + :n WHERE credits + :n >= 0 RETURNING credits:
+# без чтения перед записью, поэтому параллельные нажатия не теряют списания. Каждое изменение пишется в credit_ledger
+# в той же транзакции.
+async def _change_credits(session: AsyncSession, user_id: int, amount: int, reason: CreditReason, ref: Optional[str] = None) -> Optional[int]:
+    """ Без commit. Новый баланс или None (нет юзера / недостаточно кредитов). """
+    new_balance = await session.scalar(
+        update(User).where(User.id == user_id, User.credits + amount >= 0)
+        .values(credits=User.credits + amount).returning(User.credits))
+    if new_balance is None: return None
+    session.add(CreditLedger(user_id=user_id, delta=amount, balance_after=new_balance, reason=reason, ref=ref))
+    if ref and reason in (CreditReason.SERVICE, CreditReason.REFUND): await _bump_service_stats(session, ref, uses=1 if reason == CreditReason.SERVICE else -1)
+    return new_balance
+
+async def update_user_credits(
+    session: AsyncSession, user_id: int, amount: int, reason: CreditReason = CreditReason.ADMIN, ref: Optional[str] = None
+) -> Optional[int]:
+    """ Изменяет баланс на amount. Возвращает новый баланс или None (нет юзера / недостаточно кредитов / ошибка). """
+    try:
+        new_balance = await _change_credits(session, user_id, amount, reason, ref)
+        if new_balance is None:
+            logger.warning(f"update_user_credits: user {user_id} не найден или недостаточно кредитов ({amount:+})."); await session.rollback(); return None
+        await session.commit(); await user_cache.invalidate(user_id); return new_balance
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error update_user_credits {user_id}: {e}"); await session.rollback(); return None
+
+async def mark_first_service_used(session: AsyncSession, user_id: int, service_id: Optional[str] = None) -> bool:
+    """ Бесплатная услуга: флаг ставится только один раз (WHERE first_service_used = false), в журнал - строка с delta 0. """
+    try:
+        balance = await session.scalar(
+            update(User).where(User.id == user_id, User.first_service_used.is_(False))
+            .values(first_service_used=True).returning(User.credits))
+        if balance is None: await session.rollback(); return False
+        session.add(CreditLedger(user_id=user_id, delta=0, balance_after=balance, reason=CreditReason.FREE_SERVICE, ref=service_id))
+        if service_id: await _bump_service_stats(session, service_id, free_uses=1)
+        await session.commit(); await user_cache.invalidate(user_id); return True
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error mark_first_service_used {user_id}: {e}"); await session.rollback(); return False
+
+async def award_referral_bonus(session: AsyncSession, referred_user_id: int, bonus: int) -> Optional[Tuple[int, int]]:
+    """ Начисляет бонус рефереру пользователя одним UPDATE (реферер ищется подзапросом). (referrer_id, новый баланс) или None. """
+    referred = aliased(User)
+    referrer_id = select(referred.referrer_id).where(referred.id == referred_user_id).scalar_subquery()
+    try:
+        row = (await session.execute(
+            update(User).where(User.id == referrer_id).values(credits=User.credits + bonus)
+            .returning(User.id, User.credits).execution_options(synchronize_session=False))).first()
+        if row is None: await session.rollback(); return None
+        session.add(CreditLedger(user_id=row.id, delta=bonus, balance_after=row.credits, reason=CreditReason.REFERRAL, ref=str(referred_user_id)))
+        await session.commit(); await user_cache.invalidate(row.id); return row.id, row.credits
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error award_referral_bonus for referred {referred_user_id}: {e}"); await session.rollback(); return None
+
+async def get_credit_history(
+    session: AsyncSession, user_id: Optional[int] = None, before_id: Optional[int] = None, limit: int = 10
+) -> List[CreditLedger]:
+    """ Журнал кредитов от новых к старым, постранично по id (before_id - id последней строки предыдущей страницы). """
+    stmt = select(CreditLedger)
+    if user_id is not None: stmt = stmt.where(CreditLedger.user_id == user_id)
+    if before_id is not None: stmt = stmt.where(CreditLedger.id < before_id)
+    return list((await session.scalars(stmt.order_by(CreditLedger.id.desc()).limit(limit))).all())
+
+async def set_daily_horoscope_time(session: AsyncSession, user_id: int, time_str: Optional[str]) -> bool:
+    try:
+        result = await session.execute(update(User).where(User.id == user_id).values(daily_horoscope_time=time_str))
+        await session.commit(); await user_cache.invalidate(user_id); return result.rowcount > 0
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error set_daily_horoscope_time {user_id}: {e}"); await session.rollback(); return False
+
+ACTIVITY_UPDATE_CHUNK = 500 # id в одном IN (...) - лимит переменных SQLite
+
+async def touch_users_activity(session: AsyncSession, user_ids: Sequence[int], at: datetime) -> int:
+    """ last_activity_date = at для всех user_ids: один UPDATE ... WHERE id IN (...) на пачку. """
+    ids = sorted(user_ids); updated = 0 # Порядок id - одинаковый порядок блокировок строк у разных воркеров
+    try:
+        for i in range(0, len(ids), ACTIVITY_UPDATE_CHUNK):
+            result = await session.execute(
+                update(User).where(User.id.in_(ids[i:i + ACTIVITY_UPDATE_CHUNK])).values(last_activity_date=at)
+                .execution_options(synchronize_session=False))
+            updated += result.rowcount
+        await session.commit(); return updated
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error touch_users_activity ({len(ids)} users): {e}"); await session.rollback(); return -1
+
+async def count_referrals(session: AsyncSession, user_id: int) -> int:
+    return await session.scalar(select(func.count(User.id)).where(User.referrer_id == user_id)) or 0
+
+# --- Рассылки ---
+BROADCAST_RECIPIENTS = (User.accepted_terms.is_(True), User.is_deliverable.is_(True)) # Условие частичного индекса ix_users_broadcast_recipients
+
+async def count_broadcast_recipients(session: AsyncSession) -> int:
+    return await session.scalar(select(func.count(User.id)).where(*BROADCAST_RECIPIENTS)) or 0
+
+async def get_broadcast_recipient_ids(session: AsyncSession, after_id: int, limit: int) -> List[int]:
+    """ Следующая страница получателей: WHERE id > after_id ORDER BY id LIMIT (keyset по первичному ключу, без OFFSET). """
+    stmt = select(User.id).where(*BROADCAST_RECIPIENTS, User.id > after_id).order_by(User.id).limit(limit)
+    return list((await session.scalars(stmt)).all())
+
+async def create_broadcast(session: AsyncSession, admin_id: int, admin_chat_id: int, text: str, total: int) -> Optional[Broadcast]:
+    try:
+        broadcast = Broadcast(admin_id=admin_id, admin_chat_id=admin_chat_id, text=text, total=total, status=BroadcastStatus.RUNNING)
+        session.add(broadcast); await session.commit(); return broadcast
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error create_broadcast admin {admin_id}: {e}"); await session.rollback(); return None
+
+async def get_broadcast(session: AsyncSession, broadcast_id: int) -> Optional[Broadcast]:
+    return await session.get(Broadcast, broadcast_id, populate_existing=True)
+
+async def get_next_running_broadcast(session: AsyncSession) -> Optional[Broadcast]:
+    return await session.scalar(select(Broadcast).where(Broadcast.status == BroadcastStatus.RUNNING).order_by(Broadcast.id).limit(1))
+
+async def update_broadcast(session: AsyncSession, broadcast_id: int, only_if: Optional[Sequence[BroadcastStatus]] = None, **values: Any) -> bool:
+    """ Прогресс (cursor_user_id/sent/failed), статус, progress_message_id. only_if - менять только из этих статусов. """
+    stmt = update(Broadcast).where(Broadcast.id == broadcast_id)
+    if only_if: stmt = stmt.where(Broadcast.status.in_(list(only_if)))
+    if values.get("status") in (BroadcastStatus.DONE, BroadcastStatus.CANCELED): values["finished_at"] = datetime.now(timezone.utc)
+    try:
+        result = await session.execute(stmt.values(**values)); await session.commit(); return result.rowcount > 0
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error update_broadcast {broadcast_id}: {e}"); await session.rollback(); return False
+
+# --- Загруженные в Telegram файлы ---
+async def get_asset_file_id(session: AsyncSession, content_hash: str, kind: str) -> Optional[str]:
+    return await session.scalar(select(TelegramAsset.file_id).where(TelegramAsset.content_hash == content_hash, TelegramAsset.kind == kind))
+
+async def save_asset_file_id(session: AsyncSession, content_hash: str, kind: str, file_id: str, filename: Optional[str] = None) -> bool:
+    try:
+        await _upsert(session, TelegramAsset, {"content_hash": content_hash, "kind": kind}, {"file_id": file_id, "filename": filename}, increment=False)
+        await session.commit(); return True
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error save_asset_file_id {filename} ({content_hash[:12]}): {e}"); await session.rollback(); return False
+
+async def delete_asset_file_id(session: AsyncSession, content_hash: str, kind: str) -> bool:
+    try:
+        await session.execute(delete(TelegramAsset).where(TelegramAsset.content_hash == content_hash, TelegramAsset.kind == kind))
+        await session.commit(); return True
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error delete_asset_file_id {content_hash[:12]}: {e}"); await session.rollback(); return False
+
+# --- Натальные данные ---
+async def get_natal_data(session: AsyncSession, user_id: int) -> Optional[NatalData]:
+    return await session.scalar(select(NatalData).where(NatalData.user_id == user_id))
+
+async def save_or_update_natal_data(
+    session: AsyncSession, user_id: int, birth_date: str, birth_time: str, birth_city: str,
+    latitude: float, longitude: float, timezone: str
+) -> Optional[NatalData]:
+    try:
+        natal = await get_natal_data(session, user_id)
+        if natal is None: natal = NatalData(user_id=user_id); session.add(natal)
+        natal.birth_date = birth_date; natal.birth_time = birth_time; natal.birth_city = birth_city
+        natal.latitude = latitude; natal.longitude = longitude; natal.timezone = timezone
+        await session.commit(); return natal
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error save_or_update_natal_data {user_id}: {e}"); await session.rollback(); return None
+
+# Колонки для планировщика: только то, что нужно для расчета и отправки (без загрузки User целиком)
+HOROSCOPE_RECIPIENT_COLUMNS = (
+    User.id, User.first_name, User.accepted_terms, User.daily_horoscope_time,
+    NatalData.birth_date, NatalData.birth_time, NatalData.birth_city,
+    NatalData.latitude, NatalData.longitude, NatalData.timezone,
+)
+HOROSCOPE_STREAM_BATCH = 1000 # yield_per для больших слотов
+
+async def stream_horoscope_recipients(session: AsyncSession, time_strs: Sequence[str]) -> AsyncIterator[Row]:
+    """ Потоково отдает легкие строки подписчиков на время HH:MM (UTC) одним запросом. JOIN гарантирует наличие натальных данных. """
+    stmt = (select(*HOROSCOPE_RECIPIENT_COLUMNS).join(NatalData, NatalData.user_id == User.id)
+            .where(User.daily_horoscope_time.in_(list(time_strs)), User.accepted_terms.is_(True), User.is_deliverable.is_(True))
+            .execution_options(yield_per=HOROSCOPE_STREAM_BATCH))
+    result = await session.stream(stmt)
+    async for partition in result.partitions():
+        for row in partition: yield row
+
+# --- Очередь ежедневных гороскопов ---
+HOROSCOPE_ENQUEUE_CHUNK = 500 # Строк на INSERT (параметров ~5 на строку - в пределах лимита SQLite)
+
+async def enqueue_horoscope_slots(session: AsyncSession, slots: Sequence[Tuple[int, datetime]]) -> int:
+    """
+    Создает PENDING записи для пар (user_id, scheduled_for): INSERT ... ON CONFLICT DO NOTHING
+    по uq_horoscope_outbox_user_slot, пачками по HOROSCOPE_ENQUEUE_CHUNK. Возвращает число новых записей.
+    """
+    added = 0
+    try:
+        for start in range(0, len(slots), HOROSCOPE_ENQUEUE_CHUNK):
+            rows = [{"user_id": uid, "scheduled_for": slot, "status": HoroscopeStatus.PENDING, "attempts": 0}
+                    for uid, slot in slots[start:start + HOROSCOPE_ENQUEUE_CHUNK]]
+            stmt = (insert_for(session.bind.dialect.name)(HoroscopeOutbox).values(rows)
+                    .on_conflict_do_nothing(index_elements=['user_id', 'scheduled_for']).returning(HoroscopeOutbox.id))
+            added += len((await session.scalars(stmt)).all()); await session.commit()
+        return added
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error enqueue_horoscope_slots: {e}"); await session.rollback(); return added
+
+async def get_outbox_for_generation(
+    session: AsyncSession, since: datetime, until: datetime, max_attempts: int
+) -> List[Row]:
+    """ PENDING записи в окне [since, until] с оставшимися попытками, вместе с именем и натальными данными (один запрос). """
+    stmt = (select(HoroscopeOutbox.id.label("outbox_id"), HoroscopeOutbox.attempts, *HOROSCOPE_RECIPIENT_COLUMNS)
+            .join(User, User.id == HoroscopeOutbox.user_id).join(NatalData, NatalData.user_id == HoroscopeOutbox.user_id)
+            .where(HoroscopeOutbox.status == HoroscopeStatus.PENDING, HoroscopeOutbox.attempts < max_attempts, User.is_deliverable.is_(True),
+                   HoroscopeOutbox.scheduled_for >= since, HoroscopeOutbox.scheduled_for <= until)
+            .order_by(HoroscopeOutbox.scheduled_for))
+    return list((await session.execute(stmt)).all())
+
+async def save_outbox_results(session: AsyncSession, results: Sequence[Dict[str, Any]]) -> bool:
+    """ Пакетное обновление записей очереди по id (один executemany вместо UPDATE на строку). """
+    if not results: return True
+    try:
+        await session.execute(update(HoroscopeOutbox), list(results)); await session.commit(); return True
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error save_outbox_results: {e}"); await session.rollback(); return False
+
+async def get_due_outbox(session: AsyncSession, since: datetime, until: datetime, limit: int) -> List[Row]:
+    """ Готовые (READY) записи (id, user_id, text), время отправки которых наступило. Отправленные уходят из READY - следующий вызов вернет следующую пачку. """
+    stmt = (select(HoroscopeOutbox.id, HoroscopeOutbox.user_id, HoroscopeOutbox.text)
+            .where(HoroscopeOutbox.status == HoroscopeStatus.READY,
+                   HoroscopeOutbox.scheduled_for >= since, HoroscopeOutbox.scheduled_for <= until)
+            .order_by(HoroscopeOutbox.scheduled_for, HoroscopeOutbox.id).limit(limit))
+    return list((await session.execute(stmt)).all())
+
+async def fail_stale_outbox(session: AsyncSession, before: datetime, max_attempts: int) -> int:
+    """ Помечает FAILED записи, не отправленные вовремя или исчерпавшие попытки. """
+    try:
+        result = await session.execute(
+            update(HoroscopeOutbox)
+            .where(HoroscopeOutbox.status.in_([HoroscopeStatus.PENDING, HoroscopeStatus.READY]),
+                   (HoroscopeOutbox.scheduled_for < before) |
+                   ((HoroscopeOutbox.status == HoroscopeStatus.PENDING) & (HoroscopeOutbox.attempts >= max_attempts)))
+            .values(status=HoroscopeStatus.FAILED))
+        await session.commit(); return result.rowcount
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error fail_stale_outbox: {e}"); await session.rollback(); return 0
+
+async def purge_outbox(session: AsyncSession, before: datetime) -> int:
+    """ Удаляет обработанные (SENT/FAILED) записи старше before. """
+    try:
+        result = await session.execute(
+            delete(HoroscopeOutbox)
+            .where(HoroscopeOutbox.status.in_([HoroscopeStatus.SENT, HoroscopeStatus.FAILED]),
+                   HoroscopeOutbox.scheduled_for < before))
+        await session.commit(); return result.rowcount
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error purge_outbox: {e}"); await session.rollback(); return 0
+
+# --- Очередь фоновых услуг ---
+async def create_service_job(
+    session: AsyncSession, user_id: int, chat_id: int, service_id: str, payload: Dict[str, Any], is_free: bool = False
+) -> Optional[int]:
+    try:
+        job = ServiceJob(user_id=user_id, chat_id=chat_id, service_id=service_id, is_free=is_free,
+                         payload=json.dumps(payload, separators=(',', ':'), ensure_ascii=False))
+        session.add(job); await session.commit()
+        return job.id
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error create_service_job user {user_id}: {e}"); await session.rollback(); return None
+
+async def claim_service_jobs(session: AsyncSession, limit: int) -> List[ServiceJob]:
+    """
+    Забирает до limit задач QUEUED -> RUNNING одним UPDATE ... RETURNING.
+    Повторная проверка status в WHERE не дает двум воркерам взять одну задачу.
+    """
+    if limit <= 0: return []
+    try:
+        candidates = (select(ServiceJob.id).where(ServiceJob.status == JobStatus.QUEUED)
+                      .order_by(ServiceJob.id).limit(limit).scalar_subquery())
+        result = await session.scalars(
+            update(ServiceJob)
+            .where(ServiceJob.id.in_(candidates), ServiceJob.status == JobStatus.QUEUED)
+            .values(status=JobStatus.RUNNING, attempts=ServiceJob.attempts + 1, started_at=datetime.now(timezone.utc))
+            .returning(ServiceJob)
+            .execution_options(synchronize_session=False))
+        jobs = sorted(result.all(), key=lambda job: job.id); await session.commit()
+        return jobs
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error claim_service_jobs: {e}"); await session.rollback(); return []
+
+async def finish_service_job(session: AsyncSession, job_id: int, status: JobStatus, error: Optional[str] = None) -> bool:
+    """
+    Итог задачи. QUEUED - вернуть в очередь (остановка воркера), попытка при этом не засчитывается.
+    Только для RUNNING: False - задачу уже завершил другой (например, сочли зависшей), исход и возврат кредита - там.
+    """
+    values: Dict[str, Any] = {"status": status, "last_error": error[:500] if error else None}
+    if status == JobStatus.QUEUED: values["attempts"] = ServiceJob.attempts - 1
+    else: values["finished_at"] = datetime.now(timezone.utc)
+    try:
+        result = await session.execute(update(ServiceJob).where(ServiceJob.id == job_id, ServiceJob.status == JobStatus.RUNNING).values(**values))
+        await session.commit(); return result.rowcount > 0
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error finish_service_job {job_id}: {e}"); await session.rollback(); return False
+
+async def requeue_stale_service_jobs(session: AsyncSession, before: datetime, max_attempts: int) -> Tuple[int, List[ServiceJob]]:
+    """
+    RUNNING задачи, начатые раньше before (процесс упал посреди работы): с оставшимися попытками -> QUEUED,
+    остальные -> FAILED. Возвращает (сколько перезапущено, список проваленных - чтобы уведомить пользователей).
+    """
+    stale = (ServiceJob.status == JobStatus.RUNNING, ServiceJob.started_at < before)
+    try:
+        requeued = await session.execute(
+            update(ServiceJob).where(*stale, ServiceJob.attempts < max_attempts).values(status=JobStatus.QUEUED))
+        failed = await session.scalars(
+            update(ServiceJob).where(*stale)
+            .values(status=JobStatus.FAILED, last_error="stale", finished_at=datetime.now(timezone.utc))
+            .returning(ServiceJob).execution_options(synchronize_session=False))
+        failed_jobs = list(failed.all()); await session.commit()
+        return requeued.rowcount, failed_jobs
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error requeue_stale_service_jobs: {e}"); await session.rollback(); return 0, []
+
+async def get_service_job(session: AsyncSession, job_id: int) -> Optional[ServiceJob]:
+    """ Для /job_<номер>: владельца (user_id) проверяет хендлер. """
+    return await session.get(ServiceJob, job_id)
+
+async def purge_service_jobs(session: AsyncSession, before: datetime) -> int:
+    """ Удаляет завершенные (DONE/FAILED) задачи старше before. """
+    try:
+        result = await session.execute(
+            delete(ServiceJob).where(ServiceJob.status.in_([JobStatus.DONE, JobStatus.FAILED]), ServiceJob.finished_at < before))
+        await session.commit(); return result.rowcount
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error purge_service_jobs: {e}"); await session.rollback(); return 0
+
+# --- Платежи ---
+async def create_payment(
+    session: AsyncSession, user_id: int, yookassa_payment_id: str, amount: int, credits: int, description: Optional[str] = None
+) -> Optional[Payment]:
+    try:
+        payment = Payment(user_id=user_id, yookassa_payment_id=yookassa_payment_id, amount=amount,
+                          credits_purchased=credits, description=description, status=PaymentStatus.PENDING)
+        session.add(payment); await session.commit(); return payment
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error create_payment {yookassa_payment_id}: {e}"); await session.rollback(); return None
+
+async def get_payment_by_yookassa_id(session: AsyncSession, yookassa_payment_id: str) -> Optional[Payment]:
+    return await session.scalar(select(Payment).where(Payment.yookassa_payment_id == yookassa_payment_id))
+
+class PaymentAward(NamedTuple):
+    user_id: int; credits: int; balance: int
+
+async def _apply_payment_status(session: AsyncSession, yookassa_payment_id: str, status: PaymentStatus) -> Optional[PaymentAward]:
+    """
+    Без commit. SUCCEEDED: статус + credits_awarded условным UPDATE (credits_awarded = false), начисление и журнал -
+    повторное уведомление ничего не начислит. Прочие статусы только меняют status и не откатывают уже успешный платеж.
+    PaymentAward - если кредиты начислены сейчас. LookupError - платеж есть, а пользователя нет.
+    """
+    if status != PaymentStatus.SUCCEEDED:
+        await session.execute(update(Payment).where(
+            Payment.yookassa_payment_id == yookassa_payment_id, Payment.status != status, Payment.status != PaymentStatus.SUCCEEDED).values(status=status))
+        return None
+    row = (await session.execute(
+        update(Payment).where(Payment.yookassa_payment_id == yookassa_payment_id, Payment.credits_awarded.is_(False))
+        .values(status=PaymentStatus.SUCCEEDED, credits_awarded=True)
+        .returning(Payment.user_id, Payment.credits_purchased, Payment.amount))).first()
+    if row is None: return None
+    user_id, credits, amount = row
+    balance = await _change_credits(session, user_id, credits, CreditReason.PAYMENT, yookassa_payment_id)
+    if balance is None: raise LookupError(f"user {user_id} not found for payment {yookassa_payment_id}")
+    await _bump_daily_stats(session, payments_count=1, payments_amount=amount, credits_sold=credits)
+    return PaymentAward(user_id, credits, balance)
+
+RECONCILE_STATUSES = (PaymentStatus.PENDING, PaymentStatus.WAITING_FOR_CAPTURE) # Ждут уведомления ЮKassa
+
+async def get_stale_payments(
+    session: AsyncSession, created_from: datetime, created_to: datetime, after: Optional[Tuple[datetime, int]], limit: int
+) -> List[Row]:
+    """ Страница незавершенных платежей (id, yookassa_payment_id, status, created_at), созданных в [from, to), по ix_payments_status_created_at.
+    Keyset по (created_at, id): after - последняя строка предыдущей страницы. """
+    stmt = (select(Payment.id, Payment.yookassa_payment_id, Payment.status, Payment.created_at)
+            .where(Payment.status.in_(RECONCILE_STATUSES), Payment.created_at >= created_from, Payment.created_at < created_to)
+            .order_by(Payment.created_at, Payment.id).limit(limit))
+    if after: stmt = stmt.where(tuple_(Payment.created_at, Payment.id) > tuple_(*after))
+    return list((await session.execute(stmt)).all())
+
+async def get_user_payments(session: AsyncSession, user_id: int, limit: int = 10) -> List[Payment]:
+    stmt = select(Payment).where(Payment.user_id == user_id).order_by(Payment.created_at.desc()).limit(limit)
+    return list((await session.scalars(stmt)).all())
+
+# --- Входящие уведомления ЮKassa (inbox) и исходящие сообщения (outbox) ---
+async def save_payment_notification(session: AsyncSession, payment_id: str, status: str, event: Optional[str], payload: str) -> Optional[bool]:
+    """ INSERT ... ON CONFLICT (payment_id, status) DO NOTHING. True - новое, False - повтор, None - ошибка БД. """
+    try:
+        stmt = (insert_for(session.bind.dialect.name)(PaymentNotification)
+                .values(payment_id=payment_id, status=status, event=event, payload=payload)
+                .on_conflict_do_nothing(index_elements=['payment_id', 'status']).returning(PaymentNotification.id))
+        new_id = await session.scalar(stmt); await session.commit(); return new_id is not None
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error save_payment_notification {payment_id}/{status}: {e}"); await session.rollback(); return None
+
+async def save_payment_notifications(session: AsyncSession, notifications: Sequence[Tuple[str, str, str]], event: str) -> Optional[int]:
+    """ Пакетный save_payment_notification: (payment_id, status, payload) одной вставкой. Число новых, None - ошибка БД. """
+    if not notifications: return 0
+    try:
+        stmt = (insert_for(session.bind.dialect.name)(PaymentNotification)
+                .values([dict(payment_id=pid, status=status, event=event, payload=payload) for pid, status, payload in notifications])
+                .on_conflict_do_nothing(index_elements=['payment_id', 'status']).returning(PaymentNotification.id))
+        new_ids = (await session.scalars(stmt)).all(); await session.commit(); return len(new_ids)
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error save_payment_notifications ({len(notifications)}): {e}"); await session.rollback(); return None
+
+async def get_unprocessed_payment_notifications(session: AsyncSession, limit: int) -> List[Row]:
+    """ Строки (id, payment_id, status), а не ORM-объекты: после rollback пачки они остаются читаемыми. """
+    stmt = (select(PaymentNotification.id, PaymentNotification.payment_id, PaymentNotification.status)
+            .where(PaymentNotification.processed_at.is_(None)).order_by(PaymentNotification.id).limit(limit))
+    return list((await session.execute(stmt)).all())
+
+async def apply_payment_notifications(
+    session: AsyncSession, notifications: Sequence[Row], success_text: str
+) -> Optional[List[PaymentAward]]:
+    """
+    Пачка уведомлений одной транзакцией: статусы платежей, начисления, сообщения об оплате в notification_outbox
+    (success_text - шаблон с {credits}) и отметка processed_at. Начисления в порядке id уведомлений. None - ошибка, пачка откатана.
+    """
+    awards: List[PaymentAward] = []
+    try:
+        for n in notifications:
+            try: status = PaymentStatus(n.status)
+            except ValueError: status = PaymentStatus.PENDING
+            award = await _apply_payment_status(session, n.payment_id, status)
+            if award:
+                awards.append(award); session.add(NotificationOutbox(user_id=award.user_id, text=success_text.format(credits=award.credits)))
+        await session.execute(update(PaymentNotification).where(PaymentNotification.id.in_([n.id for n in notifications]))
+                              .values(processed_at=datetime.now(timezone.utc), attempts=PaymentNotification.attempts + 1, last_error=None))
+        await session.commit()
+    except (SQLAlchemyError, LookupError) as e:
+        logger.exception(f"DB error apply_payment_notifications ({len(notifications)}): {e}"); await session.rollback(); return None
+    for award in awards: await user_cache.invalidate(award.user_id)
+    return awards
+
+async def fail_payment_notification(session: AsyncSession, notification_id: int, error: str, max_attempts: int) -> bool:
+    """ Ошибка обработки: attempts + 1; после max_attempts уведомление снимается с обработки (processed_at) с last_error. """
+    try:
+        stmt = update(PaymentNotification).where(PaymentNotification.id == notification_id)
+        await session.execute(stmt.values(attempts=PaymentNotification.attempts + 1, last_error=error[:500]))
+        await session.execute(stmt.where(PaymentNotification.attempts >= max_attempts).values(processed_at=datetime.now(timezone.utc)))
+        await session.commit(); return True
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error fail_payment_notification {notification_id}: {e}"); await session.rollback(); return False
+
+async def get_pending_notifications(session: AsyncSession, limit: int) -> List[NotificationOutbox]:
+    stmt = select(NotificationOutbox).where(NotificationOutbox.status == NotificationStatus.PENDING).order_by(NotificationOutbox.id).limit(limit)
+    return list((await session.scalars(stmt)).all())
+
+async def finish_notifications(session: AsyncSession, sent_ids: Sequence[int], failed_ids: Sequence[int], max_attempts: int) -> bool:
+    """ Итог отправки пачки: отправленные - SENT; неудачные остаются PENDING до max_attempts, затем FAILED. """
+    try:
+        now = datetime.now(timezone.utc); attempts = NotificationOutbox.attempts + 1
+        if sent_ids:
+            await session.execute(update(NotificationOutbox).where(NotificationOutbox.id.in_(list(sent_ids)))
+                                  .values(status=NotificationStatus.SENT, sent_at=now, attempts=attempts))
+        if failed_ids:
+            stmt = update(NotificationOutbox).where(NotificationOutbox.id.in_(list(failed_ids)))
+            await session.execute(stmt.values(attempts=attempts))
+            await session.execute(stmt.where(NotificationOutbox.attempts >= max_attempts).values(status=NotificationStatus.FAILED))
+        await session.commit(); return True
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error finish_notifications: {e}"); await session.rollback(); return False
+
+async def purge_payment_inbox(session: AsyncSession, before: datetime) -> int:
+    """ Удаляет обработанные уведомления и завершенные сообщения старше before. """
+    try:
+        inbox = await session.execute(delete(PaymentNotification).where(PaymentNotification.processed_at < before))
+        outbox = await session.execute(delete(NotificationOutbox).where(
+            NotificationOutbox.status != NotificationStatus.PENDING, NotificationOutbox.created_at < before))
+        await session.commit(); return inbox.rowcount + outbox.rowcount
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error purge_payment_inbox: {e}"); await session.rollback(); return 0
+
+# --- Логи ---
+async def add_log_entry(
+    session: AsyncSession, level: LogLevel, message: str, user_id: Optional[int] = None, handler: Optional[str] = None
+) -> bool:
+    try:
+        session.add(Log(level=level, message=message, user_id=user_id, handler=handler))
+        await session.commit(); return True
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error add_log_entry: {e}"); await session.rollback(); return False
+
+async def get_user_logs(session: AsyncSession, user_id: Optional[int] = None, limit: int = 50) -> List[Log]:
+    stmt = select(Log)
+    if user_id is not None: stmt = stmt.where(Log.user_id == user_id)
+    stmt = stmt.order_by(Log.timestamp.desc(), Log.id.desc()).limit(limit)
+    return list((await session.scalars(stmt)).all())
+
+logs_fts = table('logs_fts', column('rowid'), column('logs_fts')) # FTS5 над logs (SQLite), см. LOGS_FTS_DDL
+
+def _log_search(dialect_name: str, query: str):
+    """ Условие полнотекстового поиска: все слова запроса (GIN по tsvector в PostgreSQL, FTS5 в SQLite). """
+    if dialect_name == 'postgresql':
+        return log_search_document(Log.message, Log.exception_info).op('@@')(func.plainto_tsquery(literal_column("'simple'"), query))
+    match = " ".join('"' + word.replace('"', '""') + '"' for word in query.split()) # Слова как фразы: без синтаксиса FTS5
+    return Log.id.in_(select(logs_fts.c.rowid).where(logs_fts.c.logs_fts.op('MATCH')(match)))
+
+async def get_logs_page(
+    session: AsyncSession, limit: int, level: Optional[LogLevel] = None, handler: Optional[str] = None,
+    user_id: Optional[int] = None, search: Optional[str] = None, before_id: Optional[int] = None, after_id: Optional[int] = None
+) -> List[Log]:
+    """
+    Страница логов от новых к старым, keyset по (timestamp, id) без OFFSET (по уровню - ix_logs_level_timestamp).
+    before_id - последняя строка текущей страницы (старее), after_id - первая (новее). Строки курсора нет - пустой список.
+    """
+    stmt = select(Log)
+    if level is not None: stmt = stmt.where(Log.level == level)
+    if handler: stmt = stmt.where(Log.handler == handler)
+    if user_id is not None: stmt = stmt.where(Log.user_id == user_id)
+    if search: stmt = stmt.where(_log_search(session.bind.dialect.name, search))
+    cursor_id = after_id if after_id is not None else before_id
+    if cursor_id is None: return list((await session.scalars(stmt.order_by(Log.timestamp.desc(), Log.id.desc()).limit(limit))).all())
+    cursor = (await session.execute(select(Log.timestamp, Log.id).where(Log.id == cursor_id))).first()
+    if cursor is None: return []
+    if after_id is None:
+        stmt = stmt.where(tuple_(Log.timestamp, Log.id) < tuple_(*cursor)).order_by(Log.timestamp.desc(), Log.id.desc())
+        return list((await session.scalars(stmt.limit(limit))).all())
+    stmt = stmt.where(tuple_(Log.timestamp, Log.id) > tuple_(*cursor)).order_by(Log.timestamp, Log.id)
+    return list(reversed((await session.scalars(stmt.limit(limit))).all()))
+
+async def purge_logs(session: AsyncSession, before: datetime, batch_size: int = 5000) -> int:
+    """ Удаляет логи старше before порциями (короткие транзакции, запись логов не ждет). Возвращает число удаленных. """
+    total = 0
+    try:
+        while True:
+            ids = select(Log.id).where(Log.timestamp < before).limit(batch_size)
+            deleted = (await session.execute(delete(Log).where(Log.id.in_(ids)))).rowcount
+            await session.commit(); total += deleted
+            if deleted < batch_size: return total
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error purge_logs: {e}"); await session.rollback(); return total
+
+# --- Статистика ---
+async def count_total_users(session: AsyncSession) -> int:
+    return await session.scalar(select(func.count(User.id))) or 0
+
+async def count_new_users(session: AsyncSession, since: datetime) -> int:
+    return await session.scalar(select(func.count(User.id)).where(User.registration_date >= since)) or 0
+
+async def count_active_users(session: AsyncSession, since: datetime) -> int:
+    return await session.scalar(select(func.count(User.id)).where(User.last_activity_date >= since)) or 0
+
+async def count_horoscope_users(session: AsyncSession) -> int:
+    return await session.scalar(select(func.count(User.id)).where(User.daily_horoscope_time.is_not(None))) or 0
+
+# --- Дневные сводки ---
+def _utc_today() -> date: return datetime.now(timezone.utc).date()
+
+def _day_bounds(day: date) -> Tuple[datetime, datetime]:
+    start = datetime.combine(day, time.min, tzinfo=timezone.utc); return start, start + timedelta(days=1)
+
+async def _upsert(session: AsyncSession, model, keys: Dict[str, Any], values: Dict[str, Any], increment: bool):
+    """ Без commit. increment - прибавить values к существующей строке, иначе - перезаписать. """
+    stmt = insert_for(session.bind.dialect.name)(model).values(**keys, **values)
+    set_ = {k: getattr(model, k) + v for k, v in values.items()} if increment else values
+    await session.execute(stmt.on_conflict_do_update(index_elements=list(keys), set_=set_))
+
+async def _bump_daily_stats(session: AsyncSession, **deltas: int):
+    """ Событийные счетчики сегодняшней сводки - в транзакции события (без commit). """
+    await _upsert(session, DailyStats, {"day": _utc_today()}, deltas, increment=True)
+
+async def _bump_service_stats(session: AsyncSession, service_id: str, **deltas: int):
+    await _upsert(session, DailyServiceStats, {"day": _utc_today(), "service_id": service_id}, deltas, increment=True)
+
+async def refresh_daily_snapshot(session: AsyncSession, now: datetime) -> bool:
+    """ Снимки сегодняшней сводки: всего пользователей, активные (с начала дня и за 7 дней), подписки на гороскоп. """
+    day_start, _ = _day_bounds(now.date())
+    try:
+        row = (await session.execute(select(
+            func.count(User.id), func.count(User.id).filter(User.last_activity_date >= day_start),
+            func.count(User.id).filter(User.last_activity_date >= now - timedelta(days=7)),
+            func.count(User.id).filter(User.daily_horoscope_time.is_not(None))))).one() # Один проход по users вместо четырех COUNT
+        await _upsert(session, DailyStats, {"day": now.date()}, dict(zip(
+            ("total_users", "active_users", "active_users_7d", "horoscope_subs"), row)), increment=False)
+        await session.commit(); return True
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error refresh_daily_snapshot: {e}"); await session.rollback(); return False
+
+async def get_days_to_finalize(session: AsyncSession, today: date, lookback_days: int = 7) -> List[date]:
+    """ Прошедшие дни (за lookback_days), сводка которых еще не пересчитана начисто (или отсутствует). """
+    since = today - timedelta(days=lookback_days)
+    done = set((await session.scalars(select(DailyStats.day).where(DailyStats.day >= since, DailyStats.finalized.is_(True)))).all())
+    return [since + timedelta(days=i) for i in range(lookback_days) if since + timedelta(days=i) not in done]
+
+async def finalize_daily_stats(session: AsyncSession, day: date) -> bool:
+    """
+    Пересчет событийных счетчиков прошедшего дня из исходных таблиц (индексы по датам) - исправляет
+    возможный дрейф инкрементов. Снимки (активные и т.п.) остаются последними, снятыми в течение дня.
+    """
+    start, end = _day_bounds(day)
+    in_day = lambda col: (col >= start, col < end)
+    try:
+        new_users = await session.scalar(select(func.count(User.id)).where(*in_day(User.registration_date))) or 0
+        payments_count, payments_amount, credits_sold = (await session.execute(
+            select(func.count(CreditLedger.id), func.coalesce(func.sum(Payment.amount), 0), func.coalesce(func.sum(CreditLedger.delta), 0))
+            .join(Payment, Payment.yookassa_payment_id == CreditLedger.ref)
+            .where(CreditLedger.reason == CreditReason.PAYMENT, *in_day(CreditLedger.created_at)))).one()
+        service_rows = (await session.execute(
+            select(CreditLedger.ref, CreditLedger.reason, func.count(CreditLedger.id))
+            .where(CreditLedger.reason.in_([CreditReason.SERVICE, CreditReason.REFUND, CreditReason.FREE_SERVICE]),
+                   CreditLedger.ref.is_not(None), *in_day(CreditLedger.created_at))
+            .group_by(CreditLedger.ref, CreditLedger.reason))).all()
+        services: Dict[str, Dict[str, int]] = {}
+        for service_id, reason, n in service_rows:
+            counts = services.setdefault(service_id, {"uses": 0, "free_uses": 0})
+            if reason == CreditReason.FREE_SERVICE: counts["free_uses"] += n
+            else: counts["uses"] += n if reason == CreditReason.SERVICE else -n
+        await _upsert(session, DailyStats, {"day": day}, {
+            "new_users": new_users, "payments_count": payments_count, "payments_amount": payments_amount,
+            "credits_sold": credits_sold, "finalized": True}, increment=False)
+        await session.execute(delete(DailyServiceStats).where(DailyServiceStats.day == day))
+        if services: await session.execute(insert_for(session.bind.dialect.name)(DailyServiceStats),
+                                           [{"day": day, "service_id": sid, **counts} for sid, counts in services.items()])
+        await session.commit(); return True
+    except SQLAlchemyError as e:
+        logger.exception(f"DB error finalize_daily_stats {day}: {e}"); await session.rollback(); return False
+
+async def get_daily_stats(session: AsyncSession, since: date) -> List[DailyStats]:
+    """ Сводки с since по сегодня (по возрастанию дня) - чтение по первичному ключу. """
+    return list((await session.scalars(select(DailyStats).where(DailyStats.day >= since).order_by(DailyStats.day))).all())
+
+async def get_service_usage(session: AsyncSession, since: date) -> List[Row]:
+    """ (service_id, uses, free_uses) суммарно с since. """
+    stmt = (select(DailyServiceStats.service_id, func.sum(DailyServiceStats.uses).label("uses"), func.sum(DailyServiceStats.free_uses).label("free_uses"))
+            .where(DailyServiceStats.day >= since).group_by(DailyServiceStats.service_id).order_by(func.sum(DailyServiceStats.uses).desc()))
+    return list((await session.execute(stmt)).all())
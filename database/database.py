@@ -1,7 +1,11 @@
+import time
 import logging
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine, AsyncSession
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import text
+from sqlalchemy import Engine, URL, create_engine, event, make_url, text
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 # Используем Pydantic settings
 from core.config import settings
@@ -10,15 +14,78 @@ logger = logging.getLogger(__name__)
 
 DATABASE_URL = settings.database_url # Получаем URL из настроек
 
+# --- Профили движка ---
+def _sqlite_pragmas() -> List[str]:
+    """
+    WAL: читатели не блокируются писателем (планировщик, очередь задач и хендлеры работают с одним файлом).
+    synchronous=NORMAL в WAL безопасен от порчи БД, теряется максимум последняя транзакция при сбое питания.
+    busy_timeout: писатель ждет блокировку вместо мгновенного "database is locked".
+    """
+    return ["PRAGMA journal_mode=WAL", "PRAGMA synchronous=NORMAL", "PRAGMA foreign_keys=ON",
+            f"PRAGMA busy_timeout={settings.sqlite_busy_timeout_ms}", f"PRAGMA mmap_size={settings.sqlite_mmap_size}",
+            f"PRAGMA cache_size=-{settings.sqlite_cache_size_kib}", "PRAGMA temp_store=MEMORY"]
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in _sqlite_pragmas(): cursor.execute(pragma)
+    cursor.close()
+
+def _is_sqlite_memory(url: URL) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+def _engine_options(url: URL) -> Tuple[URL, Dict[str, Any]]:
+    """ Параметры create_engine по диалекту: SQLite (файл) или PostgreSQL (asyncpg). """
+    backend, driver = url.get_backend_name(), url.get_driver_name()
+    if backend == "sqlite":
+        options: Dict[str, Any] = {"connect_args": {"check_same_thread": False}}
+        # Файл: держим соединения в пуле, чтобы не открывать файл и не выполнять PRAGMA на каждую сессию.
+        # :memory: оставляем на StaticPool по умолчанию (одно соединение = одна БД).
+        if not _is_sqlite_memory(url):
+            options.update(poolclass=AsyncAdaptedQueuePool, pool_size=settings.db_pool_size, max_overflow=0, pool_timeout=settings.db_pool_timeout)
+        return url, options
+    if backend == "postgresql":
+        options = {"pool_size": settings.db_pool_size, "max_overflow": settings.db_max_overflow, "pool_timeout": settings.db_pool_timeout,
+                   "pool_recycle": settings.db_pool_recycle, "pool_pre_ping": True}
+        if driver == "asyncpg":
+            # Кэш подготовленных выражений: asyncpg (на соединение) и SQLAlchemy (SQL -> prepared statement)
+            url = url.update_query_dict({"prepared_statement_cache_size": str(settings.db_statement_cache_size)})
+            options["connect_args"] = {"statement_cache_size": settings.db_statement_cache_size,
+                                       "server_settings": {"application_name": "astro_bot", "jit": "off"}} # JIT не окупается на коротких OLTP-запросах
+        return url, options
+    return url, {}
+
+def create_db_engine(database_url: str, **overrides: Any) -> AsyncEngine:
+    """ Async-движок с профилем под диалект. overrides - поверх профиля (например poolclass=NullPool для Alembic). """
+    url, options = _engine_options(make_url(database_url))
+    if "poolclass" in overrides: options = {k: v for k, v in options.items() if not k.startswith("pool") and k != "max_overflow"}
+    db_engine = create_async_engine(url, echo=False, **{**options, **overrides})
+    if url.get_backend_name() == "sqlite": event.listen(db_engine.sync_engine, "connect", _set_sqlite_pragmas)
+    return db_engine
+
+def create_sync_db_engine(database_url: str) -> Engine:
+    """ Синхронный движок (APScheduler) с теми же PRAGMA для SQLite и небольшим пулом. """
+    url = make_url(database_url)
+    if url.get_backend_name() == "sqlite":
+        db_engine = create_engine(url, connect_args={"check_same_thread": False})
+        event.listen(db_engine, "connect", _set_sqlite_pragmas)
+        return db_engine
+    return create_engine(url, pool_size=2, max_overflow=2, pool_pre_ping=True, pool_recycle=settings.db_pool_recycle)
+
 try:
-    engine = create_async_engine(DATABASE_URL, echo=False, connect_args={"check_same_thread": False})
+    engine = create_db_engine(DATABASE_URL)
     async_session_factory = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
-    logger.info(f"Подключение к БД настроено: {DATABASE_URL}")
+    logger.info(f"Подключение к БД настроено: {engine.url.render_as_string(hide_password=True)} (pool: {type(engine.pool).__name__})")
 
 except Exception as e:
-    logger.exception(f"Ошибка подключения к БД {DATABASE_URL}: {e}")
+    logger.exception(f"Ошибка подключения к БД {make_url(DATABASE_URL).render_as_string(hide_password=True)}: {e}")
     raise
 
+def insert_for(dialect_name: str):
+    """ INSERT ... ON CONFLICT для текущего диалекта (SQLite / PostgreSQL). """
+    if dialect_name == 'postgresql': from sqlalchemy.dialects.postgresql import insert
+    else: from sqlalchemy.dialects.sqlite import insert
+    return insert
+
 # Базовый класс для декларативных моделей SQLAlchemy
 Base = declarative_base()
 
@@ -29,9 +96,60 @@ async def init_models():
     logger.info("Проверка соединения с БД... (Таблицы создаются через 'alembic upgrade head')")
     try:
         async with engine.connect() as conn:
+            # PRAGMA для SQLite выставляются на каждом соединении (connect event), здесь только проверяем
             if engine.dialect.name == "sqlite":
-                 await conn.execute(text("PRAGMA foreign_keys=ON"))
+                journal_mode = await conn.scalar(text("PRAGMA journal_mode"))
+                logger.info(f"SQLite journal_mode={journal_mode}")
+            else: await conn.execute(text("SELECT 1"))
             logger.info("Проверка соединения с БД прошла успешно.")
     except Exception as e:
          logger.exception(f"Не удалось подключиться к БД при проверке в init_models: {e}")
-         raise
\ No newline at end of file
+         raise
+
+
+# --- Статистика запросов в рамках апдейта ---
+class QueryStats:
+    __slots__ = ('queries', 'db_time')
+    def __init__(self): self.queries = 0; self.db_time = 0.0
+
+query_stats: ContextVar[Optional[QueryStats]] = ContextVar('query_stats', default=None)
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_start'].pop()
+    stats = query_stats.get() # Greenlet AsyncSession выполняется в контексте задачи апдейта
+    if stats is not None: stats.queries += 1; stats.db_time += time.perf_counter() - started
+
+
+# --- Ленивая сессия ---
+class LazySession:
+    """
+    Прокси AsyncSession для хендлеров: сессия создается при первом обращении (апдейты без БД ее не открывают).
+    release() завершает текущую транзакцию и отдает соединение в пул перед долгим ожиданием (OpenAI,
+    геокодинг, ЮKassa); следующий запрос возьмет соединение заново. Загруженные объекты остаются доступны.
+    """
+    __slots__ = ('_factory', '_session')
+    def __init__(self, factory: async_sessionmaker[AsyncSession]):
+        self._factory = factory; self._session: Optional[AsyncSession] = None
+
+    @property
+    def opened(self) -> bool: return self._session is not None
+
+    def __getattr__(self, name: str) -> Any:
+        if self._session is None: self._session = self._factory()
+        return getattr(self._session, name)
+
+    async def release(self):
+        if self._session is not None and self._session.in_transaction(): await self._session.commit()
+
+    async def close(self):
+        if self._session is not None: await self._session.close()
+
+async def release_session(session):
+    """ Отдать соединение в пул до долгого await. Работает и с LazySession, и с обычной AsyncSession. """
+    if isinstance(session, LazySession): await session.release()
+    elif session.in_transaction(): await session.commit()
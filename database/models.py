@@ -1,10 +1,11 @@
 import datetime
 import enum
 from sqlalchemy import (
-    Column, Integer, String, DateTime, Float, Boolean,
-    ForeignKey, BigInteger, Text, Enum as SQLAlchemyEnum, Index, select, func
+    Column, Integer, String, Date, DateTime, Float, Boolean,
+    ForeignKey, BigInteger, Text, Enum as SQLAlchemyEnum, Index, UniqueConstraint, select, func, true, false,
+    DDL, event, literal_column
 )
-from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy.orm import relationship, backref, declarative_base
 from sqlalchemy.sql import func as sqlfunc
 
 from database.database import Base # Импортируем Base
@@ -15,6 +16,8 @@ class PaymentStatus(enum.Enum):
     PENDING = "pending"; WAITING_FOR_CAPTURE = "waiting_for_capture"; SUCCEEDED = "succeeded"; CANCELED = "canceled"
 class LogLevel(enum.Enum):
     DEBUG = "DEBUG"; INFO = "INFO"; WARNING = "WARNING"; ERROR = "ERROR"; CRITICAL = "CRITICAL"
+class UndeliverableReason(enum.Enum): # Почему сообщения пользователю не доходят (ошибка Telegram при отправке)
+    BLOCKED = "blocked"; DEACTIVATED = "deactivated"; NOT_FOUND = "not_found"; FORBIDDEN = "forbidden"
 
 # --- Модели ---
 class User(Base):
@@ -24,19 +27,34 @@ class User(Base):
     first_name = Column(String, nullable=False); last_name = Column(String, nullable=True)
     language_code = Column(String(10), nullable=True) # Добавили длину
     registration_date = Column(DateTime(timezone=True), server_default=sqlfunc.now(), index=True)
-    last_activity_date = Column(DateTime(timezone=True), onupdate=sqlfunc.now(), default=sqlfunc.now, index=True)
+    last_activity_date = Column(DateTime(timezone=True), default=sqlfunc.now(), index=True) # Пакетно пишет ActivityTracker
     credits = Column(Integer, default=0, nullable=False)
     first_service_used = Column(Boolean, default=False, nullable=False)
     accepted_terms = Column(Boolean, default=False, nullable=False)
     daily_horoscope_time = Column(String(5), nullable=True, index=True) # HH:MM
     referral_code = Column(String, unique=True, index=True, nullable=True)
     referrer_id = Column(BigInteger, ForeignKey('users.id', ondelete='SET NULL'), nullable=True, index=True)
+    # Доставляемость: False после 403/404 от Telegram (бот заблокирован, аккаунт удален), снова True при /start
+    is_deliverable = Column(Boolean, default=True, server_default=true(), nullable=False)
+    undeliverable_reason = Column(SQLAlchemyEnum(UndeliverableReason), nullable=True)
+    undeliverable_since = Column(DateTime(timezone=True), nullable=True)
     # Relationships
-    referrer = relationship("User", remote_side=[id], backref="referrals")
+    # Коллекции не грузятся вместе с User: берите их явными запросами (crud.get_user_payments/get_user_logs)
+    # или selectinload(...). Обращение без загрузки -> ошибка, а не тихий запрос в async.
+    referrer = relationship("User", remote_side=[id], backref=backref("referrals", lazy="raise"))
     natal_data = relationship("NatalData", back_populates="user", uselist=False, cascade="all, delete-orphan")
-    payments = relationship("Payment", back_populates="user", cascade="all, delete-orphan", lazy="selectin")
-    logs = relationship("Log", back_populates="user", cascade="all, delete-orphan", lazy="selectin")
-    __table_args__ = (Index('ix_users_accepted_terms', 'accepted_terms'),)
+    payments = relationship("Payment", back_populates="user", cascade="all, delete-orphan", lazy="raise", passive_deletes=True)
+    logs = relationship("Log", back_populates="user", cascade="all, delete-orphan", lazy="raise", passive_deletes=True)
+    __table_args__ = (
+        Index('ix_users_accepted_terms', 'accepted_terms'),
+        # Частичные индексы: в них только живые чаты, рассылка и гороскопы не читают заблокировавших бота
+        Index('ix_users_broadcast_recipients', 'id',
+              postgresql_where=accepted_terms.is_(True) & is_deliverable.is_(True),
+              sqlite_where=accepted_terms.is_(True) & is_deliverable.is_(True)),
+        Index('ix_users_horoscope_recipients', 'daily_horoscope_time',
+              postgresql_where=daily_horoscope_time.is_not(None) & accepted_terms.is_(True) & is_deliverable.is_(True),
+              sqlite_where=daily_horoscope_time.is_not(None) & accepted_terms.is_(True) & is_deliverable.is_(True)),
+    )
     def __repr__(self): return f"<User(id={self.id})>"
 
 class NatalData(Base):
@@ -49,7 +67,7 @@ class NatalData(Base):
     latitude = Column(Float, nullable=False); longitude = Column(Float, nullable=False)
     timezone = Column(String, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=sqlfunc.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=sqlfunc.now(), default=sqlfunc.now)
+    updated_at = Column(DateTime(timezone=True), onupdate=sqlfunc.now(), default=sqlfunc.now())
     user = relationship("User", back_populates="natal_data")
     def __repr__(self): return f"<NatalData(user_id={self.user_id})>"
 
@@ -65,10 +83,16 @@ class Payment(Base):
     credits_awarded = Column(Boolean, default=False, nullable=False, index=True)
     description = Column(String, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=sqlfunc.now(), index=True)
-    updated_at = Column(DateTime(timezone=True), onupdate=sqlfunc.now(), default=sqlfunc.now)
+    updated_at = Column(DateTime(timezone=True), onupdate=sqlfunc.now(), default=sqlfunc.now())
     user = relationship("User", back_populates="payments")
+    __table_args__ = (Index('ix_payments_status_created_at', 'status', 'created_at'),) # Сверка зависших платежей
     def __repr__(self): return f"<Payment(id={self.id}, status={self.status.name})>"
 
+def log_search_document(message, exception_info):
+    """ tsvector по тексту лога (PostgreSQL). Выражение запроса должно совпадать с выражением индекса ix_logs_search. """
+    text = message.op('||')(literal_column("' '")).op('||')(func.coalesce(exception_info, literal_column("''")))
+    return func.to_tsvector(literal_column("'simple'"), text)
+
 class Log(Base):
     __tablename__ = 'logs'
     id = Column(Integer, primary_key=True, index=True)
@@ -79,5 +103,186 @@ class Log(Base):
     handler = Column(String, nullable=True)
     exception_info = Column(Text, nullable=True)
     user = relationship("User", back_populates="logs")
-    __table_args__ = (Index('ix_logs_level_timestamp', 'level', 'timestamp'),)
-    def __repr__(self): return f"<Log(id={self.id}, level={self.level.name})>"
\ No newline at end of file
+    __table_args__ = (Index('ix_logs_level_timestamp', 'level', 'timestamp'),
+                      Index('ix_logs_search', log_search_document(message, exception_info), postgresql_using='gin').ddl_if(dialect='postgresql'),)
+    def __repr__(self): return f"<Log(id={self.id}, level={self.level.name})>"
+
+# Полнотекстовый поиск по логам в SQLite: FTS5 с внешним содержимым (logs), синхронизируется триггерами
+LOGS_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS logs_fts USING fts5(message, exception_info, content='logs', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS logs_fts_ai AFTER INSERT ON logs BEGIN "
+    "INSERT INTO logs_fts(rowid, message, exception_info) VALUES (new.id, new.message, new.exception_info); END",
+    "CREATE TRIGGER IF NOT EXISTS logs_fts_ad AFTER DELETE ON logs BEGIN "
+    "INSERT INTO logs_fts(logs_fts, rowid, message, exception_info) VALUES ('delete', old.id, old.message, old.exception_info); END",
+    "CREATE TRIGGER IF NOT EXISTS logs_fts_au AFTER UPDATE ON logs BEGIN "
+    "INSERT INTO logs_fts(logs_fts, rowid, message, exception_info) VALUES ('delete', old.id, old.message, old.exception_info); "
+    "INSERT INTO logs_fts(rowid, message, exception_info) VALUES (new.id, new.message, new.exception_info); END",
+)
+for _ddl in LOGS_FTS_DDL: event.listen(Log.__table__, 'after_create', DDL(_ddl).execute_if(dialect='sqlite'))
+event.listen(Log.__table__, 'before_drop', DDL("DROP TABLE IF EXISTS logs_fts").execute_if(dialect='sqlite'))
+class HoroscopeStatus(enum.Enum):
+    PENDING = "pending"; READY = "ready"; SENT = "sent"; FAILED = "failed"
+
+class JobStatus(enum.Enum):
+    QUEUED = "queued"; RUNNING = "running"; DONE = "done"; FAILED = "failed"
+
+class BroadcastStatus(enum.Enum):
+    RUNNING = "running"; PAUSED = "paused"; CANCELED = "canceled"; DONE = "done"
+
+class NotificationStatus(enum.Enum):
+    PENDING = "pending"; SENT = "sent"; FAILED = "failed"
+
+class CreditReason(enum.Enum):
+    SERVICE = "service"; FREE_SERVICE = "free_service"; REFUND = "refund"
+    PAYMENT = "payment"; REFERRAL = "referral"; ADMIN = "admin"
+
+class HoroscopeOutbox(Base):
+    """ Заранее сгенерированные ежедневные гороскопы, ожидающие отправки в свой слот. """
+    __tablename__ = 'horoscope_outbox'
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(BigInteger, ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    scheduled_for = Column(DateTime(timezone=True), nullable=False) # Минута отправки (UTC)
+    status = Column(SQLAlchemyEnum(HoroscopeStatus), default=HoroscopeStatus.PENDING, nullable=False)
+    text = Column(Text, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=sqlfunc.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=sqlfunc.now(), default=sqlfunc.now())
+    user = relationship("User")
+    __table_args__ = (UniqueConstraint('user_id', 'scheduled_for', name='uq_horoscope_outbox_user_slot'),
+                      Index('ix_horoscope_outbox_status_scheduled', 'status', 'scheduled_for'),)
+    def __repr__(self): return f"<HoroscopeOutbox(id={self.id}, user_id={self.user_id}, status={self.status.name})>"
+
+class ServiceJob(Base):
+    """ Фоновое выполнение платной услуги (натальная карта, хиромантия, сон...) после оплаты. """
+    __tablename__ = 'service_jobs'
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(BigInteger, ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    chat_id = Column(BigInteger, nullable=False)
+    service_id = Column(String(50), nullable=False)
+    payload = Column(Text, nullable=False) # JSON с данными услуги
+    is_free = Column(Boolean, default=False, server_default=false(), nullable=False) # Бесплатная попытка - кредит при ошибке не возвращается
+    status = Column(SQLAlchemyEnum(JobStatus), default=JobStatus.QUEUED, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=sqlfunc.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    __table_args__ = (Index('ix_service_jobs_status_id', 'status', 'id'),)
+    def __repr__(self): return f"<ServiceJob(id={self.id}, service={self.service_id}, status={self.status.name})>"
+
+class FsmRecord(Base):
+    """ Состояние FSM (FSM_STORAGE=sql): одна строка на ключ, общая для всех воркеров. """
+    __tablename__ = 'fsm_storage'
+    key = Column(String(255), primary_key=True) # bot:chat:user[:thread][:business]:destiny
+    state = Column(String(255), nullable=True)
+    data = Column(Text, nullable=True) # Компактный JSON
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True) # Брошенные сценарии удаляются по TTL
+    def __repr__(self): return f"<FsmRecord(key={self.key}, state={self.state})>"
+
+class CreditLedger(Base):
+    """ Журнал движения кредитов: одна строка на изменение баланса (пишется в той же транзакции, что и UPDATE users). """
+    __tablename__ = 'credit_ledger'
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(BigInteger, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    delta = Column(Integer, nullable=False) # 0 - бесплатная услуга
+    balance_after = Column(Integer, nullable=False)
+    reason = Column(SQLAlchemyEnum(CreditReason), nullable=False)
+    ref = Column(String(100), nullable=True) # service_id / ID платежа ЮKassa / ID реферала / ID админа
+    created_at = Column(DateTime(timezone=True), server_default=sqlfunc.now())
+    __table_args__ = (Index('ix_credit_ledger_user_id_id', 'user_id', 'id'), # Постраничный просмотр истории пользователя
+                      Index('ix_credit_ledger_created_at', 'created_at'),) # Дневные сводки
+    def __repr__(self): return f"<CreditLedger(id={self.id}, user_id={self.user_id}, delta={self.delta:+}, reason={self.reason.name})>"
+
+class DailyStats(Base):
+    """
+    Дневная сводка для админ-отчета (день - по UTC). Событийные счетчики (новые пользователи, платежи)
+    увеличиваются в транзакции самого события; снимки (всего, активные, подписки) обновляет задача планировщика.
+    После окончания дня строка пересчитывается из исходных таблиц и помечается finalized.
+    """
+    __tablename__ = 'daily_stats'
+    day = Column(Date, primary_key=True)
+    new_users = Column(Integer, default=0, nullable=False)
+    payments_count = Column(Integer, default=0, nullable=False)
+    payments_amount = Column(Integer, default=0, nullable=False) # Копейки
+    credits_sold = Column(Integer, default=0, nullable=False)
+    total_users = Column(Integer, default=0, nullable=False)
+    active_users = Column(Integer, default=0, nullable=False) # Активные с начала дня
+    active_users_7d = Column(Integer, default=0, nullable=False) # Активные за 7 дней на момент снимка
+    horoscope_subs = Column(Integer, default=0, nullable=False)
+    finalized = Column(Boolean, default=False, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=sqlfunc.now(), onupdate=sqlfunc.now())
+    def __repr__(self): return f"<DailyStats(day={self.day}, new={self.new_users}, active={self.active_users})>"
+
+class DailyServiceStats(Base):
+    """ Использование услуг по дням (платные за вычетом возвратов и бесплатные). """
+    __tablename__ = 'daily_service_stats'
+    day = Column(Date, primary_key=True)
+    service_id = Column(String(50), primary_key=True)
+    uses = Column(Integer, default=0, nullable=False)
+    free_uses = Column(Integer, default=0, nullable=False)
+    def __repr__(self): return f"<DailyServiceStats(day={self.day}, service={self.service_id}, uses={self.uses})>"
+
+class Broadcast(Base):
+    """
+    Рассылка админа. Получатели перебираются по users.id (keyset), курсор сохраняется после каждой страницы,
+    поэтому рестарт продолжает с места остановки. Пауза/отмена - сменой status (проверяется на каждой странице).
+    """
+    __tablename__ = 'broadcasts'
+    id = Column(Integer, primary_key=True, index=True)
+    admin_id = Column(BigInteger, nullable=False)
+    admin_chat_id = Column(BigInteger, nullable=False)
+    progress_message_id = Column(Integer, nullable=True) # Сообщение админу, которое редактируется с прогрессом
+    text = Column(Text, nullable=False) # HTML
+    status = Column(SQLAlchemyEnum(BroadcastStatus), default=BroadcastStatus.RUNNING, nullable=False, index=True)
+    cursor_user_id = Column(BigInteger, default=0, nullable=False) # Последний обработанный users.id
+    total = Column(Integer, default=0, nullable=False) # Получателей на момент запуска
+    sent = Column(Integer, default=0, nullable=False)
+    failed = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=sqlfunc.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    def __repr__(self): return f"<Broadcast(id={self.id}, status={self.status.name}, sent={self.sent}/{self.total})>"
+
+class TelegramAsset(Base):
+    """ file_id статичного файла, уже загруженного в Telegram. Ключ - содержимое (sha256), а не путь: измененный файл загрузится заново. """
+    __tablename__ = 'telegram_assets'
+    content_hash = Column(String(64), primary_key=True)
+    kind = Column(String(16), primary_key=True) # document / photo: file_id одного файла различается по способу отправки
+    file_id = Column(String, nullable=False)
+    filename = Column(String, nullable=True) # Для админа/отладки
+    created_at = Column(DateTime(timezone=True), server_default=sqlfunc.now())
+    def __repr__(self): return f"<TelegramAsset(hash={self.content_hash[:12]}, kind={self.kind}, file={self.filename})>"
+
+class PaymentNotification(Base):
+    """
+    Входящие уведомления ЮKassa (inbox): вебхук только сохраняет тело и сразу отвечает 200, обработка - PaymentInboxWorker.
+    Уникальность (payment_id, status) делает повторы ЮKassa бесплатными: дубликат не вставляется.
+    """
+    __tablename__ = 'payment_inbox'
+    id = Column(Integer, primary_key=True)
+    payment_id = Column(String, nullable=False)
+    status = Column(String(32), nullable=False) # Статус платежа из уведомления (succeeded, canceled...)
+    event = Column(String(64), nullable=True)
+    payload = Column(Text, nullable=False) # Сырой JSON уведомления
+    received_at = Column(DateTime(timezone=True), server_default=sqlfunc.now())
+    processed_at = Column(DateTime(timezone=True), nullable=True) # NULL - ждет обработки
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(String, nullable=True)
+    __table_args__ = (
+        UniqueConstraint('payment_id', 'status', name='uq_payment_inbox_payment_status'),
+        Index('ix_payment_inbox_unprocessed', 'id', postgresql_where=processed_at.is_(None), sqlite_where=processed_at.is_(None)),
+    )
+    def __repr__(self): return f"<PaymentNotification(id={self.id}, payment={self.payment_id}, status={self.status})>"
+
+class NotificationOutbox(Base):
+    """ Сообщения пользователям, записанные в транзакции события (оплата): отправляются после commit, не теряются при сбое отправки. """
+    __tablename__ = 'notification_outbox'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    text = Column(Text, nullable=False)
+    status = Column(SQLAlchemyEnum(NotificationStatus), default=NotificationStatus.PENDING, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=sqlfunc.now())
+    sent_at = Column(DateTime(timezone=True), nullable=True)
+    __table_args__ = (Index('ix_notification_outbox_status_id', 'status', 'id'),)
+    def __repr__(self): return f"<NotificationOutbox(id={self.id}, user_id={self.user_id}, status={self.status.name})>"
@@ -0,0 +1,90 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from core.config import settings
+from utils.http_metrics import counters
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "user_cache:invalidate"
+
+
+class UserStatusCache:
+    """
+    Кэш горячих полей пользователя (crud.UserStatus) в процессе: LRU на max_size записей с TTL.
+    Мутаторы crud сбрасывают запись после commit (write-through invalidation). Счетчик version защищает
+    от гонки "чтение из БД началось до сброса, а в кэш попало после": put() с версией старше последнего
+    сброса этого пользователя игнорируется. Между воркерами сбросы рассылаются через Redis pub/sub
+    (при REDIS_URL); без Redis расхождение ограничено TTL. Списания на кэш не опираются - их проверяет
+    условный UPDATE в БД, так что устаревшая запись влияет только на отображение.
+    """
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl; self.max_size = max_size
+        self.version = 0; self._floor = 0 # put() с версией ниже floor (чтение началось до clear()) игнорируется
+        self._entries: "OrderedDict[int, Tuple[float, Any]]" = OrderedDict() # user_id -> (expires_at, status)
+        self._invalidated: "OrderedDict[int, int]" = OrderedDict() # user_id -> version последнего сброса
+        self._redis = None
+        self._listener: Optional[asyncio.Task] = None
+
+    def get(self, user_id: int) -> Optional[Any]:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            counters['user_cache_misses_total'] += 1; return None
+        self._entries.move_to_end(user_id); counters['user_cache_hits_total'] += 1
+        return entry[1]
+
+    def put(self, user_id: int, status: Any, read_version: int):
+        """ read_version - self.version, снятый ДО запроса в БД. """
+        if self.ttl <= 0 or read_version < self._floor or self._invalidated.get(user_id, -1) > read_version: return # Сброшен после начала чтения
+        self._entries[user_id] = (time.monotonic() + self.ttl, status); self._entries.move_to_end(user_id)
+        if len(self._entries) > self.max_size: self._entries.popitem(last=False)
+
+    def _invalidate_local(self, user_id: int):
+        self.version += 1; self._entries.pop(user_id, None)
+        self._invalidated[user_id] = self.version; self._invalidated.move_to_end(user_id)
+        if len(self._invalidated) > self.max_size: self._invalidated.popitem(last=False)
+
+    async def invalidate(self, *user_ids: int):
+        """ Сброс после commit: локально и (при Redis) во всех воркерах. """
+        for user_id in user_ids: self._invalidate_local(user_id)
+        if self._redis is None: return
+        try:
+            for user_id in user_ids: await self._redis.publish(INVALIDATION_CHANNEL, user_id)
+        except Exception as e: logger.warning(f"[UserCache] Redis publish failed (entries expire by TTL): {e}")
+
+    def clear(self):
+        self.version += 1; self._floor = self.version; self._entries.clear(); self._invalidated.clear()
+
+    def start(self):
+        """ Подписка на сбросы других воркеров (если задан REDIS_URL). """
+        if self._listener or not settings.redis_url or self.ttl <= 0: return
+        try: from redis.asyncio import Redis
+        except ImportError: logger.warning("[UserCache] Пакет 'redis' не установлен - межпроцессный сброс кэша отключен."); return
+        self._redis = Redis.from_url(settings.redis_url)
+        self._listener = asyncio.create_task(self._listen(), name="user-cache-invalidation")
+
+    async def stop(self):
+        if self._listener:
+            self._listener.cancel()
+            try: await self._listener
+            except asyncio.CancelledError: pass
+            self._listener = None
+        if self._redis is not None: await self._redis.aclose(); self._redis = None
+
+    async def _listen(self):
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                self.clear() # Сообщения, пропущенные без подписки, не восстановить - начинаем с пустого кэша
+                async for message in pubsub.listen():
+                    if message.get('type') == 'message': self._invalidate_local(int(message['data']))
+            except asyncio.CancelledError: raise
+            except Exception as e: logger.warning(f"[UserCache] Invalidation listener error, resubscribing: {e}"); await asyncio.sleep(5)
+            finally: await pubsub.aclose()
+
+
+user_cache = UserStatusCache(settings.user_cache_ttl, settings.user_cache_size)
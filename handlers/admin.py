@@ -13,8 +13,9 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from keyboards import reply, inline
 from database import crud
-from database.models import LogLevel, User # Добавлен User
-from services import user_service, payment_service, admin_service
+from database.models import LogLevel, User, CreditReason, BroadcastStatus # Добавлен User
+from services import user_service, payment_service, admin_service, broadcast_service
+from services.broadcast_service import broadcast_runner
 from core.config import settings
 from states.user_states import AdminActions
 
@@ -83,11 +84,13 @@ async def find_user_process(m: Message, state: FSMContext, session: AsyncSession
         payments = await crud.get_user_payments(session, user.id, 10)
         logs = await crud.get_user_logs(session, user.id, 20)
 
-        info = await admin_service.format_user_info(user, natal, len(payments), len(logs))
+        referrals_count = await crud.count_referrals(session, user.id) # user.referrals не грузится (lazy="raise")
+        info = await admin_service.format_user_info(user, natal, len(payments), len(logs), referrals_count)
         await m.answer(info, parse_mode="HTML")
 
         if payments:
             await m.answer(admin_service.format_payment_list(payments), parse_mode="HTML")
+        await send_credit_history(m, session, user.id)
         if logs:
             try:
                 await m.answer(admin_service.format_log_list(logs), parse_mode="HTML")
@@ -98,6 +101,23 @@ async def find_user_process(m: Message, state: FSMContext, session: AsyncSession
     else:
         await m.reply("Не найден. Попробуйте еще.", reply_markup=inline.get_cancel_keyboard())
 
+# --- Журнал кредитов ---
+CREDIT_HISTORY_PAGE = 10
+
+async def send_credit_history(m: Message, session: AsyncSession, uid: int, before_id: Optional[int] = None):
+    """ Страница журнала по индексу (user_id, id): WHERE id < before_id, без OFFSET. """
+    entries = await crud.get_credit_history(session, uid, before_id, CREDIT_HISTORY_PAGE)
+    if not entries and before_id is not None: await m.answer("Больше операций нет."); return
+    markup = inline.get_credit_history_keyboard(uid, entries[-1].id) if len(entries) == CREDIT_HISTORY_PAGE else None
+    await m.answer(admin_service.format_credit_history(entries), reply_markup=markup, parse_mode="HTML")
+
+@admin_router.callback_query(IsAdmin(), F.data.startswith("credit_history:"))
+async def credit_history_more(c: CallbackQuery, session: AsyncSession):
+    _, uid, before_id = c.data.split(":")
+    try: await c.message.edit_reply_markup(reply_markup=None)
+    except TelegramBadRequest: pass
+    await send_credit_history(c.message, session, int(uid), int(before_id))
+
 # --- Управление Кредитами ---
 @admin_router.message(IsAdmin(), F.text == "💰 Управление кредитами")
 async def credits_start(m: Message, state: FSMContext): await m.answer("Введите ID или Username:", reply_markup=inline.get_cancel_keyboard()); await state.set_state(AdminActions.waiting_for_user_query_credits)
@@ -121,7 +141,7 @@ async def credits_reason(m: Message, state: FSMContext):
 async def credits_confirm(m: Message, state: FSMContext, session: AsyncSession, bot: Bot):
     data = await state.get_data(); await state.clear(); uid = data.get('uid'); change = data.get('change'); reason = data.get('reason','-'); admin_id = m.from_user.id
     if uid is None or change is None: logger.error(f"Admin {admin_id}: Ошибка FSM credits."); await m.answer("Ошибка состояния.", reply_markup=reply.get_admin_menu()); return
-    new_b = await crud.update_user_credits(session, uid, change)
+    new_b = await crud.update_user_credits(session, uid, change, CreditReason.ADMIN, str(admin_id))
     if new_b is not None:
         log_msg = f"Admin {admin_id} изменил баланс user {uid} на {change:+}. Причина: {reason}. Новый баланс: {new_b}"; logger.warning(log_msg); await crud.add_log_entry(session, LogLevel.WARNING, log_msg, uid, "admin_credits")
         await m.answer(f"✅ Баланс user {uid} изменен. Новый: {new_b}", reply_markup=ReplyKeyboardRemove())
@@ -140,31 +160,82 @@ async def broadcast_msg(m: Message, state: FSMContext): text = m.html_text; awai
 async def broadcast_confirm(m: Message, state: FSMContext, session: AsyncSession, bot: Bot):
     data = await state.get_data(); await state.clear(); text = data.get("bcast"); admin_id = m.from_user.id
     if not text: logger.error(f"Admin {admin_id}: Текст рассылки не найден."); await m.answer("Ошибка.", reply_markup=reply.get_admin_menu()); return
-    uids = await crud.get_all_user_ids(session)
-    if not uids: await m.answer("Нет пользователей.", reply_markup=reply.get_admin_menu()); return
-    await m.answer(f"Начинаю рассылку {len(uids)} пользователям...", reply_markup=ReplyKeyboardRemove()); logger.info(f"Admin {admin_id} начал рассылку {len(uids)}."); await crud.add_log_entry(session, LogLevel.INFO, f"Admin {admin_id} начал рассылку ({len(uids)})", handler="admin_bcast")
-    s, f = 0, 0; start = asyncio.get_event_loop().time()
-    for uid in uids: s += 1 if await user_service.notify_user(bot, uid, text) else (f := f + 1); await asyncio.sleep(0.1)
-    dur = round(asyncio.get_event_loop().time() - start, 2); res = f"✅ Рассылка ({dur}с). Успех: {s}, Ошибки: {f}"; log_res = f"Рассылка Ad:{admin_id}. Успех:{s}, Ошибки:{f}."; logger.info(log_res); await crud.add_log_entry(session, LogLevel.INFO, log_res, handler="admin_bcast"); await m.answer(res, reply_markup=reply.get_admin_menu())
+    total = await crud.count_broadcast_recipients(session)
+    if not total: await m.answer("Нет пользователей.", reply_markup=reply.get_admin_menu()); return
+    # Рассылку выполняет BroadcastRunner главного процесса; здесь только запись задания и сообщение с прогрессом
+    bcast = await crud.create_broadcast(session, admin_id, m.chat.id, text, total)
+    if not bcast: await m.answer("❌ Не удалось создать рассылку.", reply_markup=reply.get_admin_menu()); return
+    progress = await m.answer(broadcast_service.format_progress(bcast), reply_markup=inline.get_broadcast_control_keyboard(bcast.id, bcast.status), parse_mode="HTML")
+    await crud.update_broadcast(session, bcast.id, progress_message_id=progress.message_id); broadcast_runner.wake()
+    logger.info(f"Admin {admin_id} начал рассылку №{bcast.id} ({total})."); await crud.add_log_entry(session, LogLevel.INFO, f"Admin {admin_id} начал рассылку №{bcast.id} ({total})", handler="admin_bcast")
+    await m.answer("Рассылка запущена, прогресс обновляется в сообщении выше.", reply_markup=reply.get_admin_menu())
 @admin_router.message(IsAdmin(), AdminActions.waiting_for_broadcast_confirmation, F.text == "❌ Нет")
 async def broadcast_cancel(m: Message, state: FSMContext): await state.clear(); await m.answer("Рассылка отменена.", reply_markup=reply.get_admin_menu())
 
+BROADCAST_TRANSITIONS = { # действие -> (из каких статусов, новый статус, ответ)
+    "pause": ([BroadcastStatus.RUNNING], BroadcastStatus.PAUSED, "Пауза."),
+    "resume": ([BroadcastStatus.PAUSED], BroadcastStatus.RUNNING, "Продолжаем."),
+    "cancel": ([BroadcastStatus.RUNNING, BroadcastStatus.PAUSED], BroadcastStatus.CANCELED, "Рассылка отменена."),
+}
+
+@admin_router.callback_query(IsAdmin(), F.data.startswith("bcast:"))
+async def broadcast_control(c: CallbackQuery, session: AsyncSession):
+    _, action, bid = c.data.split(":"); bid = int(bid)
+    if action not in BROADCAST_TRANSITIONS: await c.answer(); return
+    from_statuses, new_status, answer = BROADCAST_TRANSITIONS[action]
+    changed = await crud.update_broadcast(session, bid, only_if=from_statuses, status=new_status)
+    if changed: logger.warning(f"Admin {c.from_user.id}: рассылка №{bid} -> {new_status.name}")
+    if changed and new_status == BroadcastStatus.RUNNING: broadcast_runner.wake()
+    bcast = await crud.get_broadcast(session, bid)
+    if bcast:
+        try: await c.message.edit_text(broadcast_service.format_progress(bcast), reply_markup=inline.get_broadcast_control_keyboard(bid, bcast.status), parse_mode="HTML")
+        except TelegramBadRequest: pass
+    await c.answer(answer if changed else "Статус уже изменился.")
+
 # --- Просмотр Логов ---
+LOG_PAGE = 8 # Строк на страницу (сообщение до 4096 символов)
+
+async def send_log_page(m: Message, session: AsyncSession, log_filter: dict, before_id: Optional[int] = None, after_id: Optional[int] = None) -> bool:
+    """ Страница логов по фильтру (keyset по (timestamp, id)). Листание редактирует сообщение. False - в эту сторону логов нет. """
+    level = LogLevel[log_filter['level']] if 'level' in log_filter else None
+    rows = await crud.get_logs_page(session, LOG_PAGE + 1, level=level, handler=log_filter.get('handler'), user_id=log_filter.get('user_id'),
+                                    search=log_filter.get('search'), before_id=before_id, after_id=after_id)
+    more = len(rows) > LOG_PAGE; paging = before_id is not None or after_id is not None
+    if not rows and paging: return False
+    if after_id is not None: logs = rows[-LOG_PAGE:]; has_newer, has_older = more, True # Лишняя строка - самая новая
+    else: logs = rows[:LOG_PAGE]; has_newer, has_older = before_id is not None, more
+    text = admin_service.format_log_page(logs, log_filter)
+    markup = inline.get_log_page_keyboard(logs[0].id if logs and has_newer else None, logs[-1].id if logs and has_older else None)
+    try:
+        if paging: await m.edit_text(text, reply_markup=markup, parse_mode="HTML")
+        else: await m.answer(text, reply_markup=markup, parse_mode="HTML")
+    except TelegramBadRequest as e: logger.error(f"Ошибка отправки логов админу: {e}"); await m.answer(f"📄 Не удалось показать логи ({len(logs)}).")
+    return True
+
 @admin_router.message(IsAdmin(), F.text == "📄 Логи бота/пользователя")
-async def logs_start(m: Message, state: FSMContext): await m.answer("User ID для фильтра или 'все' (последние 50):", reply_markup=inline.get_cancel_keyboard()); await state.set_state(AdminActions.waiting_for_user_query_logs)
+async def logs_start(m: Message, state: FSMContext):
+    await m.answer("Фильтр логов: 'все', User ID или <code>user:ID level:ERROR handler:имя</code> и слова для поиска:",
+                   reply_markup=inline.get_cancel_keyboard(), parse_mode="HTML")
+    await state.set_state(AdminActions.waiting_for_user_query_logs)
 @admin_router.message(IsAdmin(), AdminActions.waiting_for_user_query_logs)
 async def logs_process(m: Message, state: FSMContext, session: AsyncSession):
-    q = m.text.strip().lower(); limit = 50; uid: Optional[int] = None
-    if q != 'все':
-        try: uid = int(q); assert await crud.get_user(session, uid)
-        except (ValueError, AssertionError): await m.reply("Неверный ID или user не найден.", reply_markup=inline.get_cancel_keyboard()); return
-    await state.clear(); target = f"user {uid}" if uid else "бота"; await m.answer(f"Загружаю {limit} логов {target}...")
-    logs = await crud.get_user_logs(session, user_id=uid, limit=limit); text = admin_service.format_log_list(logs)
-    try: await m.answer(text, parse_mode="HTML")
-    except TelegramBadRequest: await m.answer(f"📄 Логи ({len(logs)}) слишком длинные.")
-    except Exception as e: logger.error(f"Ошибка отправки логов админу: {e}"); await m.answer("Ошибка.")
+    try: log_filter = admin_service.parse_log_filter(m.text or "")
+    except ValueError as e: await m.reply(f"{e}. Попробуйте еще.", reply_markup=inline.get_cancel_keyboard()); return
+    if 'user_id' in log_filter and not await crud.get_user(session, log_filter['user_id']):
+        await m.reply("Неверный ID или user не найден.", reply_markup=inline.get_cancel_keyboard()); return
+    await state.clear(); await state.update_data(log_filter=log_filter) # Для кнопок листания
+    await send_log_page(m, session, log_filter)
     await m.answer("👑 Админ-панель:", reply_markup=reply.get_admin_menu())
 
+@admin_router.callback_query(IsAdmin(), F.data.startswith("logs:"))
+async def logs_page(c: CallbackQuery, state: FSMContext, session: AsyncSession):
+    _, direction, cursor_id = c.data.split(":")
+    log_filter = (await state.get_data()).get('log_filter')
+    if log_filter is None: await c.answer("Фильтр устарел, откройте логи заново.", show_alert=True); return
+    cursor = {'before_id' if direction == "older" else 'after_id': int(cursor_id)}
+    if await send_log_page(c.message, session, log_filter, **cursor): await c.answer()
+    else: await c.answer("Больше логов нет.")
+
 # --- Проверка Платежа ЮKassa ---
 @admin_router.message(IsAdmin(), F.text == "🔎 Проверить платеж ЮKassa")
 async def check_pay_start(m: Message, state: FSMContext): await m.answer("Введите ID платежа ЮKassa:", reply_markup=inline.get_cancel_keyboard()); await state.set_state(AdminActions.waiting_for_payment_id_check)
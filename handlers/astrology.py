@@ -17,12 +17,17 @@ from services.astrology_service import get_natal_data_kerykeion, KrInstance, gen
 from core.config import (
     settings, PAID_SERVICES,
     SERVICE_NATAL_CHART, SERVICE_FORECAST, SERVICE_COMPATIBILITY,
-    ASTROLOGY_DISCLAIMER, GEOCODING_DISCLAIMER
+    GEOCODING_DISCLAIMER
 )
 from states.user_states import NatalInput
 from keyboards import inline, reply
 from database import crud
 from services import user_service, astrology_service, referral_service
+from services.job_queue import job_queue, job_status_hint
+from services.user_service import refund_service_credit
+from services.openai_service import is_error_result
+from database.models import ServiceJob
+from database.database import release_session
 from services.astrology_service import get_natal_data_kerykeion, KrInstance, generate_natal_chart_image
 from utils.geocoding import get_coordinates_and_timezone
 from utils.date_time_helpers import (
@@ -194,6 +199,7 @@ async def process_city_input(
         reply_markup=ReplyKeyboardRemove(),
         parse_mode="HTML"
     )
+    await release_session(session) # Геокодинг может занять секунды - соединение с БД не держим
     geo_result = await asyncio.to_thread(get_coordinates_and_timezone, city)
 
     if not geo_result:
@@ -233,14 +239,14 @@ async def process_city_input(
     service_used = False
 
     if not is_free:
-        if await user_service.use_service_credit(session, user_id):
+        if await user_service.use_service_credit(session, user_id, service_id):
             service_used = True
         else:
             logger.error(f"Ошибка списания user {user_id} за {service_id}")
             await message.answer("Ошибка оплаты.", reply_markup=reply.get_main_menu(user_id))
             return
     else:
-        if await crud.mark_first_service_used(session, user_id):
+        if await crud.mark_first_service_used(session, user_id, service_id):
             logger.info(f"Исп. беспл. услуга {service_id} user {user_id}")
             service_used = True
             await referral_service.award_referral_bonus_if_applicable(session, bot, user_id)
@@ -264,28 +270,15 @@ async def process_city_input(
             final_data['timezone']
         )
 
-    calc_error = False
-    result = None
-    try:
-        if service_id == SERVICE_NATAL_CHART:
-            result = await calculate_and_send_natal_chart(message, bot, final_data)
-        elif service_id == SERVICE_FORECAST:
-            result = await calculate_and_send_forecast(message, bot, final_data)
-        elif service_id == SERVICE_COMPATIBILITY:
-            result = await calculate_and_send_compatibility(message, bot, final_data)
-        if result is None:
-            calc_error = True
-    except Exception as calc_e:
-        logger.exception(f"Ошибка расчета {service_id} user {user_id}: {calc_e}")
-        calc_error = True
-
-    if calc_error:
-        await message.answer(
-            f"❌ Ошибка при расчете '{PAID_SERVICES[service_id]}'.",
-            reply_markup=reply.get_main_menu(user_id)
-        )
-    else:
-        await message.answer("✅ Запрос обработан.", reply_markup=reply.get_main_menu(user_id))
+    # Расчет и OpenAI - в фоновой очереди: вебхук не держим, после рестарта задача продолжится
+    job_payload = {**final_data, "user_name": user_name}
+    job_id = await job_queue.enqueue(session, user_id, message.chat.id, service_id, job_payload, is_free)
+    if job_id is None:
+        await refund_service_credit(session, user_id, is_free, service_id)
+        await message.answer(f"❌ Ошибка при расчете '{PAID_SERVICES[service_id]}'.", reply_markup=reply.get_main_menu(user_id))
+        return
+    await message.answer(f"⏳ Заявка №{job_id} принята. Результат придет отдельным сообщением.\n{job_status_hint(job_id)}", reply_markup=reply.get_main_menu(user_id))
+
 # --- Обработчики кнопок услуг ---
 @astrology_router.message(F.text == "🔮 Натальная карта")
 async def cmd_natal_chart(m: Message, state: FSMContext, session: AsyncSession):
@@ -416,59 +409,71 @@ async def cb_back_to_hour(c: CallbackQuery, state: FSMContext):
     await c.answer()
 
 # --- Обработчики ввода города ---
-@astrology_router.message(NatalInput.waiting_for_city)
+@astrology_router.message(NatalInput.waiting_for_city, flags={"throttling_key": "paid"})
 async def handle_city(m: Message, state: FSMContext, session: AsyncSession, bot: Bot):
     await process_city_input(m, state, session, bot, "")
 
-@astrology_router.message(NatalInput.waiting_for_partner_city)
+@astrology_router.message(NatalInput.waiting_for_partner_city, flags={"throttling_key": "paid"})
 async def handle_partner_city(m: Message, state: FSMContext, session: AsyncSession, bot: Bot):
     await process_city_input(m, state, session, bot, "partner_")
 
 # --- Функции расчета и отправки результатов (возвращают Optional[str]) ---
-async def calculate_and_send_natal_chart(message: Message, bot: Bot, data: Dict[str, Any]) -> Optional[str]:
-    user_id = message.from_user.id
-    user_name = message.from_user.first_name or "?"
+# Выполняются в фоновой очереди (services/job_queue.py), поэтому работают с bot/chat_id, а не с Message.
+# None - расчет не удался; об ошибке сообщает (и возвращает кредит) notify_job_failed, сами функции ее не отправляют
+async def calculate_and_send_natal_chart(bot: Bot, chat_id: int, data: Dict[str, Any]) -> Optional[str]:
+    user_name = data.get("user_name") or "?"
     kr_instance = await get_kr_instance_from_data(data, user_name)
-    if not kr_instance:
-        await message.answer(f"Ошибка расчета данных. {ASTROLOGY_DISCLAIMER}")
-        return None
-    filename_base = f"natal_{user_id}_{int(datetime.now().timestamp())}"
+    if not kr_instance: return None
+    filename_base = f"natal_{chat_id}_{int(datetime.now().timestamp())}"
     chart_path = await generate_natal_chart_image(kr_instance, filename_base)
     if chart_path and chart_path.exists():
         try:
-            await message.answer_photo(FSInputFile(chart_path, filename=f"{filename_base}.png"), caption=f"🔮 Карта {hbold(user_name)}!", parse_mode="HTML")
+            await bot.send_photo(chat_id, FSInputFile(chart_path, filename=f"{filename_base}.png"), caption=f"🔮 Карта {hbold(user_name)}!", parse_mode="HTML")
         except Exception as e:
             logger.exception(f"Ошибка отправки фото {chart_path}: {e}")
-            await message.answer("Ошибка отправки изображения.")
+            await bot.send_message(chat_id, "Ошибка отправки изображения.")
         finally:
             try:
                 chart_path.unlink()
             except OSError as e_del:
                 logger.error(f"Ошибка удаления файла {chart_path}: {e_del}")
     else:
-        await message.answer("Не удалось создать изображение карты.")
+        await bot.send_message(chat_id, "Не удалось создать изображение карты.")
     interpretation = await astrology_service.get_natal_chart_interpretation(kr_instance)
-    await message.answer(interpretation, parse_mode="HTML", disable_web_page_preview=True)
+    if is_error_result(interpretation): return None
+    await bot.send_message(chat_id, interpretation, parse_mode="HTML", disable_web_page_preview=True)
     return interpretation
 
-async def calculate_and_send_forecast(message: Message, bot: Bot, data: Dict[str, Any]) -> Optional[str]:
-    kr_instance = await get_kr_instance_from_data(data, message.from_user.first_name or "?")
-    if not kr_instance:
-        await message.answer(f"Ошибка расчета данных. {ASTROLOGY_DISCLAIMER}")
-        return None
+async def calculate_and_send_forecast(bot: Bot, chat_id: int, data: Dict[str, Any]) -> Optional[str]:
+    kr_instance = await get_kr_instance_from_data(data, data.get("user_name") or "?")
+    if not kr_instance: return None
     interpretation = await astrology_service.get_yearly_forecast_interpretation(kr_instance)
-    await message.answer(interpretation, parse_mode="HTML", disable_web_page_preview=True)
+    if is_error_result(interpretation): return None
+    await bot.send_message(chat_id, interpretation, parse_mode="HTML", disable_web_page_preview=True)
     return interpretation
 
-async def calculate_and_send_compatibility(message: Message, bot: Bot, data: Dict[str, Any]) -> Optional[str]:
-    uname = message.from_user.first_name or "?"
+async def calculate_and_send_compatibility(bot: Bot, chat_id: int, data: Dict[str, Any]) -> Optional[str]:
+    uname = data.get("user_name") or "?"
     kr1 = await get_kr_instance_from_data(data, uname, "")
     kr2 = await get_kr_instance_from_data(data, uname, "partner_")
-    if not kr1 or not kr2:
-        await message.answer(f"Ошибка расчета данных партнеров. {ASTROLOGY_DISCLAIMER}")
-        return None
+    if not kr1 or not kr2: return None
     perc, interp = await astrology_service.get_compatibility_interpretation(kr1, kr2)
+    if is_error_result(interp): return None
     res = f"📊 {hbold('Совместимость:')} {perc}%\n\n" if perc is not None else "📊 Оценка не определена.\n\n"
     res += interp
-    await message.answer(res, parse_mode="HTML", disable_web_page_preview=True)
+    await bot.send_message(chat_id, res, parse_mode="HTML", disable_web_page_preview=True)
     return res
+
+ASTRO_CALCULATORS = {
+    SERVICE_NATAL_CHART: calculate_and_send_natal_chart,
+    SERVICE_FORECAST: calculate_and_send_forecast,
+    SERVICE_COMPATIBILITY: calculate_and_send_compatibility,
+}
+
+async def run_astro_job(bot: Bot, job: ServiceJob, data: Dict[str, Any]) -> bool:
+    """ Задача очереди: расчет и отправка. False/исключение - очередь сообщит об ошибке и вернет кредит (notify_job_failed). """
+    if await ASTRO_CALCULATORS[job.service_id](bot, job.chat_id, data) is None: return False
+    await bot.send_message(job.chat_id, "✅ Запрос обработан.", reply_markup=reply.get_main_menu(job.user_id))
+    return True
+
+for _sid in ASTRO_CALCULATORS: job_queue.register(_sid, run_astro_job)
@@ -2,7 +2,7 @@ import logging
 from aiogram import Router, F, Bot
 from aiogram.filters import CommandStart, Command, StateFilter
 from aiogram.fsm.context import FSMContext
-from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove, FSInputFile, User # Добавлен User
+from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove, User # Добавлен User
 from aiogram.utils.markdown import hlink, hbold
 from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
 
@@ -11,7 +11,11 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from keyboards import reply, inline
 from core.config import settings, PAID_SERVICES, SERVICE_COST # Используем Pydantic settings
 from database import crud
-from services.user_service import notify_user # get_user_or_register не используется
+from database.database import async_session_factory
+from services.user_service import notify_user, refund_service_credit # get_user_or_register не используется
+from services.job_queue import job_queue, JOB_STATUS_COMMAND
+from services.asset_service import asset_registry
+from database.models import JobStatus, ServiceJob
 from states.user_states import TermsAgreement
 from utils.referral_utils import generate_referral_link
 
@@ -88,7 +92,7 @@ async def handle_accept_terms(callback: CallbackQuery, session: AsyncSession, st
 @common_router.message(Command("help"))
 @common_router.message(F.text == "ℹ️ Помощь")
 async def handle_help(message: Message, session: AsyncSession, state: FSMContext, bot: Bot):
-     user = await crud.get_user(session, message.from_user.id)
+     user = await crud.get_user_status(session, message.from_user.id)
      user_name = message.from_user.first_name or "Пользователь"
      if not user or not user.accepted_terms: await handle_start(message, session, state, bot); return
 
@@ -106,6 +110,7 @@ async def handle_help(message: Message, session: AsyncSession, state: FSMContext
 🎁 {hbold("Реферальная программа:")} Бонусы за друзей (за их первую беспл. услугу).
 
 Используйте кнопки меню. /start для перезапуска.
+Статус заявки на услугу: /job_<номер> (номер приходит при приеме заявки).
 Вопросы по оплате/возвратам: {settings.refund_contact_email}
 """
      await message.answer(help_text, reply_markup=reply.get_main_menu(user.id), parse_mode="HTML")
@@ -114,7 +119,7 @@ async def handle_help(message: Message, session: AsyncSession, state: FSMContext
 @common_router.message(Command("menu"))
 async def handle_menu_command(message: Message, session: AsyncSession, state: FSMContext, bot: Bot): # Добавлен bot
     await state.clear()
-    user = await crud.get_user(session, message.from_user.id)
+    user = await crud.get_user_status(session, message.from_user.id)
     if not user or not user.accepted_terms: await handle_start(message, session, state, bot); return
     await message.answer("Главное меню:", reply_markup=reply.get_main_menu(user.id))
 
@@ -144,22 +149,45 @@ async def handle_dummy_callback(callback: CallbackQuery):
 
 # --- Просмотр PDF примера ---
 @common_router.callback_query(F.data.startswith("show_pdf_example:"))
-async def handle_show_pdf_example(callback: CallbackQuery, session: AsyncSession): # session не нужна
+async def handle_show_pdf_example(callback: CallbackQuery, bot: Bot):
     service_id = callback.data.split(":", 1)[1]; service_name = PAID_SERVICES.get(service_id, "?")
     pdf_path = settings.pdf_dir / f"{service_id}_example.pdf"
     if pdf_path.exists():
         try:
-            pdf_file = FSInputFile(pdf_path, filename=f"{service_id}_example.pdf")
-            await callback.message.answer_document(pdf_file, caption=f"📄 Пример '{service_name}'.")
+            # Загружается один раз, дальше - по file_id (без повторной выгрузки мегабайт на каждое нажатие)
+            await asset_registry.send_document(bot, callback.message.chat.id, pdf_path, caption=f"📄 Пример '{service_name}'.")
             await callback.answer()
         except TelegramAPIError as e: logger.error(f"Ошибка PDF user {callback.from_user.id}: {e}"); await callback.answer("Ошибка отправки файла.", show_alert=True)
         except Exception as e: logger.exception(f"Ошибка PDF {pdf_path}: {e}"); await callback.answer("Ошибка файла.", show_alert=True)
     else: logger.warning(f"PDF не найден: {pdf_path}"); await callback.answer(f"Пример для '{service_name}' не найден.", show_alert=True)
 
+# --- Статус фоновой услуги: /job_<номер> (кликабельная команда из сообщения о приеме заявки) ---
+JOB_STATUS_TEXT = {
+    JobStatus.QUEUED: "⏳ в очереди", JobStatus.RUNNING: "⚙️ выполняется",
+    JobStatus.DONE: "✅ выполнена, результат отправлен", JobStatus.FAILED: "❌ не выполнена" }
+
+@common_router.message(F.text.regexp(rf"^/{JOB_STATUS_COMMAND}(\d+)(?:@\w+)?$").as_("match"))
+async def cmd_job_status(message: Message, session: AsyncSession, match):
+    job = await crud.get_service_job(session, int(match.group(1)))
+    if not job or job.user_id != message.from_user.id: await message.answer("Заявка не найдена."); return # Чужие заявки не показываем
+    text = f"Заявка №{job.id} ('{PAID_SERVICES.get(job.service_id, job.service_id)}'): {JOB_STATUS_TEXT[job.status]}."
+    if job.status == JobStatus.FAILED and not job.is_free: text += " Кредит возвращен на баланс."
+    await message.answer(text)
+
 # --- Обработка неизвестных сообщений (должен быть последним) ---
 @common_router.message(StateFilter(None), ~CommandStart()) # Ловим все, кроме /start, вне состояний
 async def handle_unknown_message(message: Message, session: AsyncSession, state: FSMContext, bot: Bot):
-    user = await crud.get_user(session, message.from_user.id)
+    user = await crud.get_user_status(session, message.from_user.id)
     if not user or not user.accepted_terms: await handle_start(message, session, state, bot); return
     logger.debug(f"Unknown message user {message.from_user.id}: {message.text[:50]}")
-    await message.reply("Не понимаю вас. 🤔 Используйте кнопки меню или /help.", reply_markup=reply.get_main_menu(message.from_user.id))
\ No newline at end of file
+    await message.reply("Не понимаю вас. 🤔 Используйте кнопки меню или /help.", reply_markup=reply.get_main_menu(message.from_user.id))
+
+# --- Ошибка фоновой услуги ---
+async def notify_job_failed(bot: Bot, job: ServiceJob):
+    """ Задача очереди провалилась (ошибка, таймаут, падение воркера) - возвращаем кредит и сообщаем пользователю. """
+    service_name = PAID_SERVICES.get(job.service_id, job.service_id)
+    async with async_session_factory() as session: refunded = await refund_service_credit(session, job.user_id, job.is_free, job.service_id)
+    refund_note = " Кредит возвращен на баланс." if refunded else ""
+    await notify_user(bot, job.chat_id, f"❌ Ошибка при расчете '{service_name}' (заявка №{job.id}). Попробуйте позже.{refund_note}",
+                      keyboard=reply.get_main_menu(job.user_id))
+job_queue.on_failure(notify_job_failed)
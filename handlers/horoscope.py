@@ -26,7 +26,7 @@ async def cmd_daily_horoscope_settings(message: Message, session: AsyncSession,
     if not await user_service.has_natal_data(session, user_id):
         await message.answer(f"Нужны данные рождения. Сначала '🔮 {hbold(PAID_SERVICES[SERVICE_NATAL_CHART])}'.",
                              parse_mode="HTML", reply_markup=reply.get_main_menu(user_id)); return
-    user = await crud.get_user(session, user_id)
+    user = await crud.get_user_status(session, user_id)
     if not user: return
     current_time = user.daily_horoscope_time; markup = inline.create_horoscope_time_keyboard()
     if current_time: await message.answer(f"Гороскоп включен ({hbold(current_time)} UTC).\nИзменить/отключить?", reply_markup=markup)
@@ -1,4 +1,5 @@
 import logging
+from typing import Any, Dict
 from aiogram import Router, F, Bot
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove, User # Добавлен User
@@ -13,6 +14,8 @@ from states.user_states import DreamInput, SignsInput
 from keyboards import inline, reply
 from database import crud
 from services import user_service, openai_service, referral_service # Добавлен referral_service
+from services.job_queue import job_queue, job_status_hint
+from database.models import ServiceJob
 
 other_services_router = Router()
 logger = logging.getLogger(__name__)
@@ -20,12 +23,33 @@ logger = logging.getLogger(__name__)
 # --- Вспомогательные функции ---
 async def use_credit_or_free(session: AsyncSession, bot: Bot, user_id: int, is_free: bool, service_id: str) -> bool:
     if not is_free:
-        if not await user_service.use_service_credit(session, user_id): logger.error(f"Ошибка списания user {user_id} за {service_id}"); return False
+        if not await user_service.use_service_credit(session, user_id, service_id): logger.error(f"Ошибка списания user {user_id} за {service_id}"); return False
         else: return True
     else:
-        if not await crud.mark_first_service_used(session, user_id): logger.error(f"Ошибка отметки free user {user_id} для {service_id}"); return False
+        if not await crud.mark_first_service_used(session, user_id, service_id): logger.error(f"Ошибка отметки free user {user_id} для {service_id}"); return False
         else: logger.info(f"Исп. беспл. {service_id} user {user_id}"); await referral_service.award_referral_bonus_if_applicable(session, bot, user_id); return True
 
+async def enqueue_text_service(m: Message, session: AsyncSession, proc_msg: Message, sid: str, txt: str, is_free: bool):
+    """ Ставит оплаченную услугу в фоновую очередь; ответ OpenAI заменит текст proc_msg. """
+    uid = m.from_user.id
+    job_id = await job_queue.enqueue(session, uid, m.chat.id, sid, {"text": txt, "message_id": proc_msg.message_id}, is_free)
+    if job_id is None:
+        await user_service.refund_service_credit(session, uid, is_free, sid)
+        await proc_msg.edit_text(f"❌ Ошибка при обработке '{PAID_SERVICES[sid]}'.", reply_markup=None)
+        await m.answer("Выберите действие:", reply_markup=reply.get_main_menu(uid))
+        return
+    await m.answer(f"⏳ Заявка №{job_id} принята. {job_status_hint(job_id)}") # Не правим proc_msg: его может уже заменить результат
+
+async def run_text_service_job(bot: Bot, job: ServiceJob, data: Dict[str, Any]) -> bool:
+    """ Задача очереди: запрос к OpenAI и ответ в исходное сообщение "Анализирую...". """
+    await bot.send_chat_action(chat_id=job.chat_id, action="typing")
+    interp = await TEXT_SERVICES[job.service_id](data["text"])
+    if openai_service.is_error_result(interp): return False # Сообщение и возврат кредита - в notify_job_failed
+    try: await bot.edit_message_text(interp, chat_id=job.chat_id, message_id=data["message_id"], parse_mode="HTML", disable_web_page_preview=True)
+    except TelegramBadRequest: await bot.send_message(job.chat_id, interp, parse_mode="HTML", disable_web_page_preview=True)
+    await bot.send_message(job.chat_id, "Выберите действие:", reply_markup=reply.get_main_menu(job.user_id))
+    return True
+
 async def start_other_service(m: Message, state: FSMContext, session: AsyncSession, sid: str):
     await state.clear(); uid = m.from_user.id
     can_use, creds, is_free, chk_msg = await user_service.check_service_availability(session, uid)
@@ -75,16 +99,14 @@ async def process_confirm_other_service(
 async def cmd_dream(m: Message, state: FSMContext, session: AsyncSession): await start_other_service(m, state, session, SERVICE_DREAM)
 @other_services_router.callback_query(F.data == f"confirm_service:{SERVICE_DREAM}")
 async def confirm_dream(c: CallbackQuery, state: FSMContext, session: AsyncSession): await process_confirm_other_service(c, state, session, SERVICE_DREAM, "Опишите ваш сон:", DreamInput.waiting_for_dream_text)
-@other_services_router.message(DreamInput.waiting_for_dream_text, F.text)
+@other_services_router.message(DreamInput.waiting_for_dream_text, F.text, flags={"throttling_key": "paid"})
 async def handle_dream(m: Message, state: FSMContext, session: AsyncSession, bot: Bot):
     txt = m.text; uid = m.from_user.id
     if not txt or len(txt.split()) < 3: await m.reply("Опишите подробнее (мин. 3 слова).", reply_markup=inline.get_cancel_keyboard()); return
     data = await state.get_data(); await state.clear()
     proc_msg = await m.answer("🌙 Анализирую...", reply_markup=ReplyKeyboardRemove())
-    await bot.send_chat_action(chat_id=uid, action="typing")
     if not await use_credit_or_free(session, bot, uid, data.get("is_free", False), SERVICE_DREAM): await proc_msg.edit_text("Ошибка оплаты.", reply_markup=reply.get_main_menu(uid)); return
-    interp = await openai_service.get_dream_interpretation(txt); await proc_msg.edit_text(interp, parse_mode="HTML", disable_web_page_preview=True)
-    await m.answer("Выберите действие:", reply_markup=reply.get_main_menu(uid))
+    await enqueue_text_service(m, session, proc_msg, SERVICE_DREAM, txt, data.get("is_free", False))
 @other_services_router.message(DreamInput.waiting_for_dream_text)
 async def dream_wrong_input(m: Message): await m.reply("Опишите сон текстом.", reply_markup=inline.get_cancel_keyboard())
 
@@ -93,15 +115,17 @@ async def dream_wrong_input(m: Message): await m.reply("Опишите сон т
 async def cmd_signs(m: Message, state: FSMContext, session: AsyncSession): await start_other_service(m, state, session, SERVICE_SIGNS)
 @other_services_router.callback_query(F.data == f"confirm_service:{SERVICE_SIGNS}")
 async def confirm_signs(c: CallbackQuery, state: FSMContext, session: AsyncSession): await process_confirm_other_service(c, state, session, SERVICE_SIGNS, "О какой примете узнать?", SignsInput.waiting_for_sign_text)
-@other_services_router.message(SignsInput.waiting_for_sign_text, F.text)
+@other_services_router.message(SignsInput.waiting_for_sign_text, F.text, flags={"throttling_key": "paid"})
 async def handle_signs(m: Message, state: FSMContext, session: AsyncSession, bot: Bot):
     txt = m.text; uid = m.from_user.id
     if not txt or len(txt) < 3: await m.reply("Сформулируйте вопрос (мин. 3 симв).", reply_markup=inline.get_cancel_keyboard()); return
     data = await state.get_data(); await state.clear()
     proc_msg = await m.answer("🍀 Ищу информацию...", reply_markup=ReplyKeyboardRemove())
-    await bot.send_chat_action(chat_id=uid, action="typing")
     if not await use_credit_or_free(session, bot, uid, data.get("is_free", False), SERVICE_SIGNS): await proc_msg.edit_text("Ошибка оплаты.", reply_markup=reply.get_main_menu(uid)); return
-    interp = await openai_service.get_sign_interpretation(txt); await proc_msg.edit_text(interp, parse_mode="HTML", disable_web_page_preview=True)
-    await m.answer("Выберите действие:", reply_markup=reply.get_main_menu(uid))
+    await enqueue_text_service(m, session, proc_msg, SERVICE_SIGNS, txt, data.get("is_free", False))
 @other_services_router.message(SignsInput.waiting_for_sign_text)
-async def signs_wrong_input(m: Message): await m.reply("Введите вопрос текстом.", reply_markup=inline.get_cancel_keyboard())
\ No newline at end of file
+async def signs_wrong_input(m: Message): await m.reply("Введите вопрос текстом.", reply_markup=inline.get_cancel_keyboard())
+
+# --- Фоновые задачи ---
+TEXT_SERVICES = {SERVICE_DREAM: openai_service.get_dream_interpretation, SERVICE_SIGNS: openai_service.get_sign_interpretation}
+for _sid in TEXT_SERVICES: job_queue.register(_sid, run_text_service_job)
@@ -1,5 +1,7 @@
 import logging
 import io
+import asyncio
+from typing import Any, Dict, Optional
 from aiogram import Router, F, Bot
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove
@@ -16,6 +18,8 @@ from states.user_states import PalmistryInput
 from keyboards import inline, reply
 from database import crud
 from services import user_service, openai_service, referral_service # Добавлен referral_service
+from services.job_queue import job_queue, job_status_hint
+from database.models import ServiceJob
 
 palmistry_router = Router()
 logger = logging.getLogger(__name__)
@@ -68,17 +72,22 @@ async def handle_confirm_palmistry_service(
     await state.set_state(PalmistryInput.waiting_for_left_hand)
     await callback.answer()
 
+async def _download_photo(bot: Bot, file_id: Optional[str]) -> Optional[bytes]:
+    """ Скачивает фото по file_id. None - если file_id нет или скачать не удалось. """
+    if not file_id: return None
+    photo_data = io.BytesIO()
+    try: await bot.download(file_id, destination=photo_data); return photo_data.getvalue() or None
+    except Exception as e: logger.exception(f"Ошибка скач. фото {file_id}: {e}"); return None
+    finally: photo_data.close()
+
 # Получение фото левой руки
 @palmistry_router.message(PalmistryInput.waiting_for_left_hand, F.photo)
 async def handle_left_hand_photo(message: Message, state: FSMContext, bot: Bot):
     if not message.photo: await message.reply("Ошибка: Фото не найдено.", reply_markup=inline.get_cancel_keyboard("cancel_palmistry")); return
-    photo = message.photo[-1]; photo_data = io.BytesIO()
-    try: await bot.download(photo, destination=photo_data); photo_bytes = photo_data.getvalue(); assert photo_bytes
-    except Exception as e: logger.exception(f"Ошибка скач. фото Л руки user {message.from_user.id}: {e}"); await message.reply("Не удалось загрузить. Попробуйте еще раз.", reply_markup=inline.get_cancel_keyboard("cancel_palmistry")); return
-    finally: photo_data.close()
-
-    await state.update_data(left_hand_photo=photo_bytes)
-    await message.answer(f"Фото Л ({len(photo_bytes) // 1024} КБ) получено.\nТеперь пришлите фото {hbold('ПРАВОЙ')} ладони.",
+    photo = message.photo[-1]
+    # В FSM кладем только file_id: хранилище может быть общим (Redis/SQL), байты скачиваются перед анализом
+    await state.update_data(left_hand_file_id=photo.file_id)
+    await message.answer(f"Фото Л ({(photo.file_size or 0) // 1024} КБ) получено.\nТеперь пришлите фото {hbold('ПРАВОЙ')} ладони.",
                          reply_markup=inline.get_cancel_keyboard("cancel_palmistry"), parse_mode="HTML")
     await state.set_state(PalmistryInput.waiting_for_right_hand)
 
@@ -88,37 +97,53 @@ async def handle_text_instead_of_left_photo(message: Message):
      await message.reply("Пришлите именно ФОТО левой ладони.", reply_markup=inline.get_cancel_keyboard("cancel_palmistry"))
 
 # Получение фото правой руки и запуск анализа
-@palmistry_router.message(PalmistryInput.waiting_for_right_hand, F.photo)
+@palmistry_router.message(PalmistryInput.waiting_for_right_hand, F.photo, flags={"throttling_key": "paid"})
 async def handle_right_hand_photo(message: Message, state: FSMContext, session: AsyncSession, bot: Bot):
     if not message.photo: await message.reply("Ошибка: Фото не найдено.", reply_markup=inline.get_cancel_keyboard("cancel_palmistry")); return
-    photo = message.photo[-1]; photo_data = io.BytesIO(); user_id = message.from_user.id
-    try: await bot.download(photo, destination=photo_data); photo_bytes_right = photo_data.getvalue(); assert photo_bytes_right
-    except Exception as e: logger.exception(f"Ошибка скач. фото П руки user {user_id}: {e}"); await message.reply("Не удалось загрузить. Попробуйте еще раз.", reply_markup=inline.get_cancel_keyboard("cancel_palmistry")); return
-    finally: photo_data.close()
-
-    data = await state.get_data(); photo_bytes_left = data.get('left_hand_photo')
-    if not photo_bytes_left: logger.error(f"Фото Л руки не найдено в FSM user {user_id}"); await state.clear(); await message.answer("Ошибка. Начните заново.", reply_markup=reply.get_main_menu(user_id)); return
+    photo = message.photo[-1]; user_id = message.from_user.id
+    data = await state.get_data(); left_file_id = data.get('left_hand_file_id')
+    if not left_file_id: logger.error(f"Фото Л руки не найдено в FSM user {user_id}"); await state.clear(); await message.answer("Ошибка. Начните заново.", reply_markup=reply.get_main_menu(user_id)); return
 
     await state.clear()
-    proc_msg = await message.answer(f"Фото П ({len(photo_bytes_right) // 1024} КБ) получено.\n✋ Анализирую...", reply_markup=ReplyKeyboardRemove())
-    await bot.send_chat_action(chat_id=user_id, action="typing")
+    proc_msg = await message.answer(f"Фото П ({(photo.file_size or 0) // 1024} КБ) получено.\n✋ Анализирую...", reply_markup=ReplyKeyboardRemove())
 
     # --- Списываем кредит / используем бесплатную ---
     is_free = data.get("is_free", False); service_used = False
     if not is_free:
-        if await user_service.use_service_credit(session, user_id): service_used = True
+        if await user_service.use_service_credit(session, user_id, SERVICE_PALMISTRY): service_used = True
         else: logger.error(f"Ошибка списания user {user_id} за {SERVICE_PALMISTRY}"); await proc_msg.edit_text("Ошибка оплаты.", reply_markup=reply.get_main_menu(user_id)); return
     else:
-        if await crud.mark_first_service_used(session, user_id):
+        if await crud.mark_first_service_used(session, user_id, SERVICE_PALMISTRY):
             logger.info(f"Исп. беспл. {SERVICE_PALMISTRY} user {user_id}"); service_used = True
             await referral_service.award_referral_bonus_if_applicable(session, bot, user_id) # Проверка бонуса
         else: logger.error(f"Ошибка отметки беспл. user {user_id} для {SERVICE_PALMISTRY}"); await proc_msg.edit_text("Ошибка.", reply_markup=reply.get_main_menu(user_id)); return
     if not service_used: return
     # --- Конец списания / использования ---
 
+    # Скачивание фото и анализ - в фоновой очереди
+    job_id = await job_queue.enqueue(session, user_id, message.chat.id, SERVICE_PALMISTRY,
+                                     {"left_file_id": left_file_id, "right_file_id": photo.file_id, "message_id": proc_msg.message_id}, is_free)
+    if job_id is None:
+        await user_service.refund_service_credit(session, user_id, is_free, SERVICE_PALMISTRY)
+        await proc_msg.edit_text("❌ Ошибка анализа. Попробуйте позже.")
+        await message.answer("Выберите следующее действие:", reply_markup=reply.get_main_menu(user_id))
+        return
+    await message.answer(f"⏳ Заявка №{job_id} принята. {job_status_hint(job_id)}") # Не правим proc_msg: его может уже заменить результат
+
+async def run_palmistry_job(bot: Bot, job: ServiceJob, data: Dict[str, Any]) -> bool:
+    """ Задача очереди: скачать оба фото, анализ OpenAI, ответ в сообщение "Анализирую...". """
+    photo_bytes_left, photo_bytes_right = await asyncio.gather(
+        _download_photo(bot, data.get("left_file_id")), _download_photo(bot, data.get("right_file_id")))
+    if not photo_bytes_left or not photo_bytes_right: return False
+    await bot.send_chat_action(chat_id=job.chat_id, action="typing")
     analysis = await openai_service.get_palmistry_analysis(photo_bytes_left, photo_bytes_right)
-    await proc_msg.edit_text(analysis, parse_mode="HTML", disable_web_page_preview=True)
-    await message.answer("Выберите следующее действие:", reply_markup=reply.get_main_menu(user_id))
+    if openai_service.is_error_result(analysis): return False # Сообщение и возврат кредита - в notify_job_failed
+    try: await bot.edit_message_text(analysis, chat_id=job.chat_id, message_id=data["message_id"], parse_mode="HTML", disable_web_page_preview=True)
+    except TelegramBadRequest: await bot.send_message(job.chat_id, analysis, parse_mode="HTML", disable_web_page_preview=True)
+    await bot.send_message(job.chat_id, "Выберите следующее действие:", reply_markup=reply.get_main_menu(job.user_id))
+    return True
+
+job_queue.register(SERVICE_PALMISTRY, run_palmistry_job)
 
 # Текст вместо фото П руки
 @palmistry_router.message(PalmistryInput.waiting_for_right_hand)
@@ -10,7 +10,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from keyboards import inline, reply
 from database import crud
-from core.config import settings # Используем settings
+from core.config import settings, PAYMENT_OPTIONS # Используем settings
 from services import user_service, payment_service
 
 payment_router = Router()
@@ -18,10 +18,9 @@ logger = logging.getLogger(__name__)
 
 @payment_router.message(F.text == "💰 Баланс и Покупка")
 async def cmd_balance(message: Message, session: AsyncSession):
-    user_id = message.from_user.id; credits = await crud.get_user_credits(session, user_id); is_free = False
-    if settings.first_service_free:
-        user = await crud.get_user(session, user_id)
-        if user and not user.first_service_used: is_free = True
+    user_id = message.from_user.id; user = await crud.get_user_status(session, user_id) # Один легкий запрос
+    credits = user.credits if user else 0
+    is_free = bool(settings.first_service_free and user and not user.first_service_used)
     text = f"💰 Баланс: {hbold(credits)} кр.\n" + ("✨ Доступна 1 бесплатная услуга!" if is_free else "") + "\n\nВыберите пакет:"
     await message.answer(text, reply_markup=inline.get_payment_options_keyboard(), parse_mode="HTML")
 
@@ -33,11 +32,11 @@ async def cb_buy_credits_menu(callback: CallbackQuery, session: AsyncSession):
     except TelegramBadRequest: pass
     await callback.answer()
 
-@payment_router.callback_query(F.data.startswith("create_payment:"))
+@payment_router.callback_query(F.data.startswith("create_payment:"), flags={"throttling_key": "paid"})
 async def handle_create_payment(callback: CallbackQuery, session: AsyncSession, bot: Bot):
     option_key = callback.data.split(":", 1)[1]; user_id = callback.from_user.id
-    if option_key not in settings.PAYMENT_OPTIONS: await callback.answer("Неверная опция.", show_alert=True); return
-    opt = settings.PAYMENT_OPTIONS[option_key]; amount = opt['price'] / 100; credits = opt['credits']
+    if option_key not in PAYMENT_OPTIONS: await callback.answer("Неверная опция.", show_alert=True); return
+    opt = PAYMENT_OPTIONS[option_key]; amount = opt['price'] / 100; credits = opt['credits']
     try: await callback.message.edit_text(f"⏳ Создаю ссылку на оплату {opt['description']}...", reply_markup=None)
     except TelegramBadRequest: pass
     await callback.answer()
@@ -44,7 +44,7 @@ def get_confirm_service_keyboard(service_id: str, credits_needed: int, current_c
 
 # --- Клавиатура для выбора опции покупки кредитов ---
 def get_payment_options_keyboard() -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder(); [builder.button(text=f"{d['description']} за {d['price']/100:.0f} ₽", callback_data=f"create_payment:{k}") for k, d in settings.PAYMENT_OPTIONS.items()]; builder.button(text="❌ Отмена", callback_data="cancel_payment"); builder.adjust(1); return builder.as_markup()
+    builder = InlineKeyboardBuilder(); [builder.button(text=f"{d['description']} за {d['price']/100:.0f} ₽", callback_data=f"create_payment:{k}") for k, d in PAYMENT_OPTIONS.items()]; builder.button(text="❌ Отмена", callback_data="cancel_payment"); builder.adjust(1); return builder.as_markup()
 
 # --- Клавиатура со ссылкой на оплату (БЕЗ кнопки проверки) ---
 def get_payment_link_keyboard(payment_url: str) -> InlineKeyboardMarkup:
@@ -54,6 +54,27 @@ def get_payment_link_keyboard(payment_url: str) -> InlineKeyboardMarkup:
 def get_palm_hand_selection_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder(); builder.button(text="Левая рука", callback_data="palm_hand:left"); builder.button(text="Правая рука", callback_data="palm_hand:right"); builder.button(text="❌ Отмена", callback_data="cancel_palmistry"); builder.adjust(2); return builder.as_markup()
 
+# --- Постраничный журнал кредитов (админ) ---
+def get_credit_history_keyboard(user_id: int, before_id: int) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder(); builder.button(text="⬇️ Ещё", callback_data=f"credit_history:{user_id}:{before_id}"); return builder.as_markup()
+
+# --- Постраничный просмотр логов (админ) ---
+def get_log_page_keyboard(newer_id: Optional[int], older_id: Optional[int]) -> Optional[InlineKeyboardMarkup]:
+    """ Курсоры - id первой/последней строки страницы; фильтр хранится в данных FSM (callback_data до 64 байт). """
+    if newer_id is None and older_id is None: return None
+    builder = InlineKeyboardBuilder()
+    if newer_id is not None: builder.button(text="⬅️ Новее", callback_data=f"logs:newer:{newer_id}")
+    if older_id is not None: builder.button(text="Старее ➡️", callback_data=f"logs:older:{older_id}")
+    builder.adjust(2); return builder.as_markup()
+
+# --- Управление рассылкой (админ) ---
+def get_broadcast_control_keyboard(broadcast_id: int, status) -> Optional[InlineKeyboardMarkup]:
+    builder = InlineKeyboardBuilder()
+    if status.value == "running": builder.button(text="⏸ Пауза", callback_data=f"bcast:pause:{broadcast_id}")
+    elif status.value == "paused": builder.button(text="▶️ Продолжить", callback_data=f"bcast:resume:{broadcast_id}")
+    else: return None # Завершена/отменена - без кнопок
+    builder.button(text="⛔ Отменить", callback_data=f"bcast:cancel:{broadcast_id}"); builder.adjust(2); return builder.as_markup()
+
 # --- Клавиатура отмены FSM ---
 def get_cancel_keyboard(callback_data="fsm_cancel") -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder(); builder.button(text="❌ Отмена", callback_data=callback_data); return builder.as_markup()
\ No newline at end of file
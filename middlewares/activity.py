@@ -0,0 +1,70 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update, User as TgUser
+
+from core.config import settings
+from database import crud
+from database.database import async_session_factory
+from utils.http_metrics import counters
+
+logger = logging.getLogger(__name__)
+
+class ActivityTracker:
+    """
+    Последняя активность пользователей без записи в БД на каждый апдейт: id копятся во множестве
+    и раз в flush_interval сек пишутся одним UPDATE users SET last_activity_date WHERE id IN (...).
+    Точность last_activity_date - до интервала сброса (для статистики "активны за сутки/неделю" достаточно).
+    """
+    def __init__(self, session_factory, flush_interval: float):
+        self.session_factory = session_factory; self.flush_interval = flush_interval
+        self._pending: Set[int] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def touch(self, user_id: int):
+        self._pending.add(user_id)
+
+    def start(self):
+        if self._task: return
+        self._task = asyncio.create_task(self._run(), name="activity-tracker")
+
+    async def stop(self):
+        """ Останавливает цикл и сбрасывает накопленное. """
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> int:
+        if not self._pending: return 0
+        user_ids, self._pending = self._pending, set()
+        async with self.session_factory() as session:
+            updated = await crud.touch_users_activity(session, user_ids, datetime.now(timezone.utc))
+        if updated < 0: self._pending |= user_ids; return 0 # Ошибка БД - попробуем в следующий раз
+        counters['activity_users_flushed_total'] += len(user_ids)
+        logger.debug(f"[Activity] Flushed {len(user_ids)} users ({updated} rows).")
+        return updated
+
+
+activity_tracker = ActivityTracker(async_session_factory, settings.activity_flush_interval)
+
+
+class ActivityMiddleware(BaseMiddleware):
+    """ Outer middleware на dp.update: отмечает пользователя апдейта в ActivityTracker (без обращения к БД). """
+    def __init__(self, tracker: ActivityTracker = activity_tracker):
+        super().__init__(); self.tracker = tracker
+
+    async def __call__(self, handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]], event: Update, data: Dict[str, Any]) -> Any:
+        user: Optional[TgUser] = data.get('event_from_user')
+        if user and not user.is_bot: self.tracker.touch(user.id)
+        return await handler(event, data)
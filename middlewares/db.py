@@ -1,13 +1,30 @@
+import logging
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import Update
 from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
 
+from database.database import LazySession, QueryStats, query_stats
+from utils.http_metrics import counters
+
+logger = logging.getLogger(__name__)
+
 class DbSessionMiddleware(BaseMiddleware):
-    """ Middleware для предоставления сессии SQLAlchemy в хендлеры. """
-    def __init__(self, session_factory: async_sessionmaker[AsyncSession]):
-        super().__init__(); self.session_factory = session_factory
+    """
+    Middleware для предоставления сессии SQLAlchemy в хендлеры. Сессия ленивая (LazySession):
+    соединение берется только при первом запросе. Считает запросы и время БД на апдейт.
+    """
+    def __init__(self, session_factory: async_sessionmaker[AsyncSession], slow_db_time: float = 0.5):
+        super().__init__(); self.session_factory = session_factory; self.slow_db_time = slow_db_time
 
     async def __call__(self, handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]], event: Update, data: Dict[str, Any]) -> Any:
-        async with self.session_factory() as session:
-            data['session'] = session; return await handler(event, data)
\ No newline at end of file
+        session = LazySession(self.session_factory); stats = QueryStats(); token = query_stats.set(stats)
+        data['session'] = session
+        try: return await handler(event, data)
+        finally:
+            query_stats.reset(token)
+            if session.opened: await session.close(); counters['db_sessions_opened_total'] += 1
+            else: counters['db_sessions_skipped_total'] += 1
+            counters['db_queries_total'] += stats.queries
+            if stats.db_time >= self.slow_db_time: logger.warning(f"Update {event.update_id}: {stats.queries} queries, DB {stats.db_time * 1000:.0f} ms")
+            elif stats.queries: logger.debug(f"Update {event.update_id}: {stats.queries} queries, DB {stats.db_time * 1000:.1f} ms")
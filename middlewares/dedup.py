@@ -0,0 +1,68 @@
+import time
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Set, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from core.config import settings
+from utils.http_metrics import counters
+
+logger = logging.getLogger(__name__)
+
+class MemoryUpdateDeduplicator:
+    """
+    Окно недавних update_id: кольцевой буфер (порядок прихода) + множество (проверка за O(1)).
+    Запись выпадает из окна по возрасту (window сек) или по размеру (max_size).
+    """
+    def __init__(self, window: float, max_size: int):
+        self.window = window; self.max_size = max_size
+        self._order: Deque[Tuple[int, float]] = deque()
+        self._seen: Set[int] = set()
+
+    async def is_duplicate(self, update_id: int) -> bool:
+        """ True - update_id уже был в окне; иначе запоминает его. """
+        now = time.monotonic(); order = self._order
+        while order and (now - order[0][1] > self.window or len(order) >= self.max_size):
+            self._seen.discard(order.popleft()[0])
+        if update_id in self._seen: return True
+        self._seen.add(update_id); order.append((update_id, now))
+        return False
+
+
+class RedisUpdateDeduplicator:
+    """ Общее окно для нескольких воркеров: SET NX с TTL = window. При недоступности Redis пропускает апдейт. """
+    def __init__(self, redis, window: float, prefix: str = "upd"):
+        self.redis = redis; self.ttl = max(1, int(window)); self.prefix = prefix
+
+    async def is_duplicate(self, update_id: int) -> bool:
+        try: return not await self.redis.set(f"{self.prefix}:{update_id}", 1, nx=True, ex=self.ttl)
+        except Exception as e: logger.warning(f"Redis dedup unavailable, processing update {update_id}: {e}"); return False
+
+
+def create_update_deduplicator():
+    """ memory - в процессе; redis - общий (REDIS_URL, пакет redis). """
+    if settings.dedup_backend == 'redis':
+        try: from redis.asyncio import Redis
+        except ImportError: raise RuntimeError("DEDUP_BACKEND=redis требует пакет 'redis'")
+        if not settings.redis_url: raise RuntimeError("DEDUP_BACKEND=redis требует REDIS_URL")
+        return RedisUpdateDeduplicator(Redis.from_url(settings.redis_url), settings.dedup_window_seconds)
+    return MemoryUpdateDeduplicator(settings.dedup_window_seconds, settings.dedup_max_updates)
+
+
+class UpdateDeduplicationMiddleware(BaseMiddleware):
+    """
+    Отбрасывает повторно доставленные Telegram апдейты (ретраи вебхука) до открытия сессии БД,
+    чтобы повтор не списал кредит и не запустил услугу второй раз. Регистрируется outer middleware на dp.update перед DbSessionMiddleware.
+    """
+    def __init__(self, deduplicator=None):
+        super().__init__()
+        self.deduplicator = deduplicator or create_update_deduplicator()
+
+    async def __call__(self, handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]], event: Update, data: Dict[str, Any]) -> Any:
+        if await self.deduplicator.is_duplicate(event.update_id):
+            counters['telegram_duplicate_updates_total'] += 1
+            logger.info(f"Duplicate update {event.update_id} suppressed.")
+            return None
+        return await handler(event, data)
@@ -1,15 +1,16 @@
+import html
 import logging
 import asyncio
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta, timezone
 
 # Используем Pydantic settings
-from core.config import settings
+from core.config import settings, PAID_SERVICES
 
 # Импорты базы данных и моделей
 from database import crud
-from database.models import User, NatalData, Payment, Log, PaymentStatus, LogLevel
+from database.models import User, NatalData, Payment, Log, PaymentStatus, LogLevel, CreditLedger
 
 # Импорты для проверки статуса внешних сервисов
 from services import openai_service, payment_service
@@ -22,7 +23,8 @@ async def format_user_info(
     user: User,
     natal_data: Optional[NatalData],
     payments_count: int,
-    logs_count: int
+    logs_count: int,
+    referrals_count: int = 0
 ) -> str:
     """Форматирует информацию о пользователе для вывода админу."""
     if not user: return "Пользователь не найден."
@@ -40,6 +42,10 @@ async def format_user_info(
                       f"Город: {natal_data.birth_city} (TZ: {natal_data.timezone})")
 
     horoscope_time = user.daily_horoscope_time or "Не установлено"
+    delivery_info = "Да"
+    if not user.is_deliverable:
+        since = user.undeliverable_since.strftime('%Y-%m-%d') if user.undeliverable_since else 'N/A'
+        delivery_info = f"Нет ({user.undeliverable_reason.value if user.undeliverable_reason else '?'}, с {since})"
     # Используем .isoformat() для надежного форматирования или strftime с проверкой на None
     reg_date_str = user.registration_date.strftime('%Y-%m-%d %H:%M %Z') if user.registration_date else 'N/A'
     last_act_str = user.last_activity_date.strftime('%Y-%m-%d %H:%M %Z') if user.last_activity_date else 'N/A'
@@ -57,11 +63,12 @@ Username: @{user.username if user.username else '<i>-</i>'}
 Кредиты: <b>{user.credits}</b>
 Беспл. услуга: {'Да' if user.first_service_used else 'Нет'}
 Условия приняты: {'Да' if user.accepted_terms else 'Нет'}
+Доставка: {delivery_info}
 
 🔗 <b>Рефералы:</b>
 Реф. код: <code>{user.referral_code or 'N/A'}</code>
 Приглашен от: {referrer_info}
-Пригласил: {len(user.referrals)} чел.
+Пригласил: {referrals_count} чел.
 
 🔮 <b>Данные:</b>
 Натальные: {natal_info}
@@ -75,38 +82,52 @@ Username: @{user.username if user.username else '<i>-</i>'}
     return "\n".join(line.strip() for line in info.strip().splitlines())
 
 
+def _pct_change(current: int, previous: int) -> str:
+    if not previous: return "—"
+    return f"{(current - previous) * 100 / previous:+.0f}%"
+
 async def generate_statistics_report(session: AsyncSession) -> str:
-    """Генерирует текстовый отчет со статистикой."""
+    """Генерирует текстовый отчет по дневным сводкам (daily_stats) - без сканирования users/payments."""
     try:
-        now = datetime.now(timezone.utc)
-        day_ago = now - timedelta(days=1)
-        week_ago = now - timedelta(days=7)
-
-        total_users = await crud.count_total_users(session)
-        new_today = await crud.count_new_users(session, day_ago)
-        new_week = await crud.count_new_users(session, week_ago)
-        active_today = await crud.count_active_users(session, day_ago)
-        active_week = await crud.count_active_users(session, week_ago)
-        horoscope_subs = await crud.count_horoscope_users(session)
-
-        # TODO: Добавить статистику по платежам (сумма, количество) и услугам
+        now = datetime.now(timezone.utc); today = now.date()
+        rows = await crud.get_daily_stats(session, today - timedelta(days=89))
+        if not rows or rows[-1].day != today: # Сегодняшнего снимка еще нет (первый запуск / задача не успела)
+            await crud.refresh_daily_snapshot(session, now); rows = await crud.get_daily_stats(session, today - timedelta(days=89))
+        by_day = {r.day: r for r in rows}; current = by_day.get(today)
+        def total(field: str, days: int, offset: int = 0) -> int:
+            return sum(getattr(r, field) for d, r in by_day.items() if offset <= (today - d).days < offset + days)
+        usage = await crud.get_service_usage(session, today - timedelta(days=29))
+        services = "\n".join(f"- {PAID_SERVICES.get(u.service_id, u.service_id)}: {u.uses}" + (f" (+{u.free_uses} беспл.)" if u.free_uses else "")
+                             for u in usage) or "- нет данных"
+        new_30, new_prev_30 = total("new_users", 30), total("new_users", 30, 30)
+        snapshot_at = current.updated_at.strftime('%H:%M') if current and current.updated_at else '—'
 
         report = f"""
 📊 <b>Статистика Бота</b> ({now.strftime('%Y-%m-%d %H:%M %Z')}):
 -----------------------------------
-<b>Всего пользователей:</b> {total_users}
+<b>Всего пользователей:</b> {current.total_users if current else 0}
 
 <b>Новые пользователи:</b>
-- За сегодня: {new_today}
-- За неделю: {new_week}
+- За сегодня: {total("new_users", 1)}
+- За неделю: {total("new_users", 7)}
+- За 30 дней: {new_30} ({_pct_change(new_30, new_prev_30)} к пред. 30 дням)
+- За 90 дней: {total("new_users", 90)}
 
 <b>Активные пользователи:</b>
-- Сегодня: {active_today}
-- За неделю: {active_week}
+- Сегодня: {current.active_users if current else 0}
+- За неделю: {current.active_users_7d if current else 0}
 
-<b>Подписки на гороскоп:</b> {horoscope_subs}
+<b>Подписки на гороскоп:</b> {current.horoscope_subs if current else 0}
 
-<i>(Другая статистика пока не реализована)</i>
+<b>Платежи:</b>
+- Сегодня: {total("payments_count", 1)} на {total("payments_amount", 1) / 100:.0f} ₽
+- За неделю: {total("payments_count", 7)} на {total("payments_amount", 7) / 100:.0f} ₽
+- За 30 дней: {total("payments_count", 30)} на {total("payments_amount", 30) / 100:.0f} ₽ ({total("credits_sold", 30)} кр.)
+
+<b>Услуги за 30 дней:</b>
+{services}
+
+<i>Снимок активности: {snapshot_at} UTC</i>
 """
         return report.strip()
     except Exception as e:
@@ -126,20 +147,69 @@ def format_payment_list(payments: List[Payment]) -> str:
     return "\n".join(lines)
 
 
+def format_credit_history(entries: List[CreditLedger]) -> str:
+    """Форматирует страницу журнала кредитов."""
+    if not entries: return "Операций с кредитами нет."
+    lines = [f"💳 <b>Операции с кредитами ({len(entries)}):</b>"]
+    for e in entries:
+        ts = e.created_at.strftime('%y-%m-%d %H:%M') if e.created_at else '?'
+        ref = f" <code>{e.ref[-12:]}</code>" if e.ref else ""
+        lines.append(f"- {ts}: {e.delta:+} → {e.balance_after} ({e.reason.value}{ref})")
+    return "\n".join(lines)
+
+
+LOG_LEVEL_EMOJI = {"DEBUG": "⚙️", "INFO": "ℹ️", "WARNING": "⚠️", "ERROR": "❌", "CRITICAL": "🔥"}
+
+def _clip(text: str, limit: int) -> str: return text if len(text) <= limit else text[:limit] + '...'
+
+def _format_log_entry(log: Log, message_limit: int = 250) -> str:
+    user_info = f" U:{log.user_id}" if log.user_id else ""
+    handler_info = f" [{html.escape(log.handler[:20])}]" if log.handler else ""
+    ts = log.timestamp.strftime('%m-%d %H:%M:%S') if log.timestamp else '?'
+    line = f"{LOG_LEVEL_EMOJI.get(log.level.name, '❓')} {ts}{user_info}{handler_info}: <i>{html.escape(_clip(log.message, message_limit))}</i>"
+    if log.exception_info and log.exception_info.strip(): # Последняя строка трейсбека - тип и текст исключения
+        line += f"\n  <code>{html.escape(_clip(log.exception_info.strip().splitlines()[-1], 150))}</code>"
+    return line
+
 def format_log_list(logs: List[Log]) -> str:
     """Форматирует список логов."""
     if not logs: return "Логи не найдены."
-    lines = [f"📄 <b>Последние {len(logs)} логов:</b>"]
-    for log in logs:
-        user_info = f" U:{log.user_id}" if log.user_id else ""
-        handler_info = f" [{log.handler[:15]}]" if log.handler else ""
-        level_emoji = {"DEBUG": "⚙️", "INFO": "ℹ️", "WARNING": "⚠️", "ERROR": "❌", "CRITICAL": "🔥"}.get(log.level.name, "❓")
-        ts = log.timestamp.strftime('%m-%d %H:%M:%S') if log.timestamp else '?'
-        message = (log.message[:100] + '...') if len(log.message) > 100 else log.message
-        exception = ""
-        if log.exception_info: exception = "\n  <code>" + (log.exception_info[:100] + '...') + "</code>"
-        lines.append(f"{level_emoji} {ts}{user_info}{handler_info}: <i>{message}</i>{exception}")
-    return "<pre>" + "\n".join(lines) + "</pre>"
+    return "\n".join([f"📄 <b>Последние {len(logs)} логов:</b>"] + [_format_log_entry(log, 100) for log in logs])
+
+
+def parse_log_filter(query: str) -> Dict[str, Any]:
+    """
+    Фильтр просмотра логов (хранится в данных FSM): 'все', ID пользователя или
+    ключи user:ID level:УРОВЕНЬ handler:имя, остальные слова - полнотекстовый поиск. ValueError - неверный ключ.
+    """
+    query = query.strip()
+    if query.lower() == 'все': return {}
+    if query.isdigit(): return {'user_id': int(query)}
+    log_filter: Dict[str, Any] = {}; words = []
+    for token in query.split():
+        key, sep, value = token.partition(':'); key = key.lower()
+        if not sep or not value or key not in ('user', 'level', 'handler'): words.append(token); continue
+        if key == 'user':
+            if not value.isdigit(): raise ValueError(f"Неверный ID пользователя: {value}")
+            log_filter['user_id'] = int(value)
+        elif key == 'level':
+            if value.upper() not in LogLevel.__members__: raise ValueError(f"Уровень: {', '.join(LogLevel.__members__)}")
+            log_filter['level'] = value.upper()
+        else: log_filter['handler'] = value
+    if words: log_filter['search'] = " ".join(words)
+    return log_filter
+
+def format_log_filter(log_filter: Dict[str, Any]) -> str:
+    parts = [f"user:{log_filter['user_id']}" if 'user_id' in log_filter else "",
+             f"level:{log_filter['level']}" if 'level' in log_filter else "",
+             f"handler:{log_filter['handler']}" if 'handler' in log_filter else "",
+             f"«{log_filter['search']}»" if 'search' in log_filter else ""]
+    return html.escape(" ".join(p for p in parts if p)) or "все"
+
+def format_log_page(logs: List[Log], log_filter: Dict[str, Any]) -> str:
+    """Страница логов с фильтром в заголовке."""
+    lines = [f"📄 <b>Логи</b> ({format_log_filter(log_filter)}):"]
+    return "\n".join(lines + [_format_log_entry(log) for log in logs]) if logs else lines[0] + "\nЛоги не найдены."
 
 
 async def check_external_services() -> str:
@@ -161,7 +231,7 @@ async def check_external_services() -> str:
     async def check_yookassa():
         # Реальная проверка API Юкассы сложна без выполнения операции.
         # Проверяем только конфигурацию SDK.
-        return "✅ YooKassa: SDK сконфигурирован" if payment_service.YOOKASSA_ENABLED else "❌ YooKassa: SDK не настроен"
+        return "✅ YooKassa: клиент настроен" if payment_service.YOOKASSA_ENABLED else "❌ YooKassa: не настроена"
     tasks.append(check_yookassa())
 
     # Geocoding
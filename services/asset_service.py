@@ -0,0 +1,93 @@
+import asyncio
+import hashlib
+import logging
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+from database import crud
+from database.database import async_session_factory
+
+logger = logging.getLogger(__name__)
+
+# Способ отправки -> (метод Bot, file_id из ответа)
+ASSET_KINDS: Dict[str, Tuple[str, Callable[[Message], str]]] = {
+    "document": ("send_document", lambda m: m.document.file_id),
+    "photo": ("send_photo", lambda m: m.photo[-1].file_id),
+}
+
+# Ответы Telegram на непринятый file_id (другой бот/токен, удаленный файл). Прочие BadRequest (чат, подпись, разметка) - не про файл
+FILE_ID_ERRORS = ("wrong file identifier", "file_id", "wrong remote file", "file reference")
+
+def _is_file_id_error(error: TelegramBadRequest) -> bool:
+    message = error.message.lower()
+    return any(marker in message for marker in FILE_ID_ERRORS)
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""): digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AssetRegistry:
+    """
+    Отправка статичных файлов (примеры PDF и т.п.) по file_id вместо повторной загрузки.
+    Файл загружается один раз, file_id сохраняется в telegram_assets по sha256 содержимого (общий для воркеров)
+    и кэшируется в памяти. Хэш пересчитывается только при смене mtime/размера файла - измененный файл уйдет новой загрузкой.
+    Если Telegram не принял именно file_id (другой бот/токен), запись удаляется и файл загружается заново;
+    остальные ошибки отправки пробрасываются, кэш не трогается.
+    """
+    def __init__(self):
+        self._hashes: Dict[Path, Tuple[int, int, str]] = {} # path -> (mtime_ns, size, sha256)
+        self._file_ids: Dict[Tuple[str, str], str] = {} # (sha256, kind) -> file_id
+        self._locks: Dict[Tuple[str, str], asyncio.Lock] = {} # Одна загрузка на файл при одновременных нажатиях (отправка по file_id - без блокировки)
+
+    async def _content_hash(self, path: Path) -> str:
+        st = path.stat(); cached = self._hashes.get(path)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size: return cached[2]
+        content_hash = await asyncio.to_thread(_sha256, path)
+        self._hashes[path] = (st.st_mtime_ns, st.st_size, content_hash)
+        return content_hash
+
+    async def _get_file_id(self, key: Tuple[str, str]) -> Optional[str]:
+        file_id = self._file_ids.get(key)
+        if file_id is None:
+            async with async_session_factory() as session: file_id = await crud.get_asset_file_id(session, *key)
+            if file_id: self._file_ids[key] = file_id
+        return file_id
+
+    async def _forget(self, key: Tuple[str, str]):
+        self._file_ids.pop(key, None)
+        async with async_session_factory() as session: await crud.delete_asset_file_id(session, *key)
+
+    async def send(self, bot: Bot, chat_id: int, path: Path, kind: str = "document", **kwargs: Any) -> Message:
+        """ Отправляет файл по пути (kwargs - caption, reply_markup...). Исключения Telegram пробрасываются. """
+        method_name, extract_file_id = ASSET_KINDS[kind]; method = getattr(bot, method_name)
+        key = (await self._content_hash(path), kind)
+        file_id = await self._get_file_id(key)
+        if file_id:
+            try: return await method(chat_id, file_id, **kwargs)
+            except TelegramBadRequest as e:
+                if not _is_file_id_error(e): raise
+                logger.warning(f"[Assets] file_id for {path.name} rejected ({e.message}), re-uploading."); await self._forget(key)
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            file_id = self._file_ids.get(key) # Пока ждали, файл мог загрузить параллельный запрос
+            if file_id: return await method(chat_id, file_id, **kwargs)
+            message = await method(chat_id, FSInputFile(path, filename=path.name), **kwargs)
+            self._file_ids[key] = file_id = extract_file_id(message)
+            async with async_session_factory() as session: await crud.save_asset_file_id(session, *key, file_id, path.name)
+            logger.info(f"[Assets] Uploaded {path.name} ({key[0][:12]}, {kind}).")
+            return message
+
+    async def send_document(self, bot: Bot, chat_id: int, path: Path, **kwargs: Any) -> Message:
+        return await self.send(bot, chat_id, path, "document", **kwargs)
+
+    async def send_photo(self, bot: Bot, chat_id: int, path: Path, **kwargs: Any) -> Message:
+        return await self.send(bot, chat_id, path, "photo", **kwargs)
+
+
+asset_registry = AssetRegistry()
@@ -0,0 +1,113 @@
+import time
+import asyncio
+import logging
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+
+from core.config import settings
+from database import crud
+from database.database import async_session_factory
+from database.models import Broadcast, BroadcastStatus, LogLevel
+from keyboards import inline
+from services.user_service import notify_user
+from utils.send_scheduler import bulk_sends
+
+logger = logging.getLogger(__name__)
+
+STATUS_TITLES = {BroadcastStatus.RUNNING: "⏳ идет", BroadcastStatus.PAUSED: "⏸ на паузе",
+                 BroadcastStatus.CANCELED: "⛔ отменена", BroadcastStatus.DONE: "✅ завершена"}
+
+def format_progress(broadcast: Broadcast) -> str:
+    processed = broadcast.sent + broadcast.failed
+    pct = min(100, processed * 100 // broadcast.total) if broadcast.total else 100
+    return (f"📢 <b>Рассылка №{broadcast.id}</b>: {STATUS_TITLES[broadcast.status]}\n"
+            f"Обработано: {processed} из ~{broadcast.total} ({pct}%)\n"
+            f"Успех: {broadcast.sent}, Ошибки: {broadcast.failed}")
+
+
+class BroadcastRunner:
+    """
+    Выполняет рассылки из таблицы broadcasts по одной, в главном процессе (как планировщик).
+    Получатели читаются страницами по users.id, отправка - параллельно (concurrency); темп и 429 - в send_scheduler (низкий приоритет).
+    После каждой страницы сохраняются курсор и счетчики: после рестарта рассылка продолжится,
+    повторно могут уйти не более page_size сообщений. Пауза/отмена проверяются перед каждой страницей.
+    """
+    def __init__(self, concurrency: int, page_size: int, progress_interval: float, poll_interval: float = 5.0):
+        self.page_size = page_size; self.progress_interval = progress_interval; self.poll_interval = poll_interval
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bot: Optional[Bot] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, bot: Bot):
+        if self._task: return
+        self._bot = bot; self._wakeup = asyncio.Event()
+        with bulk_sends(): self._task = asyncio.create_task(self._poll(), name="broadcast-runner") # Задача наследует приоритет
+
+    def wake(self):
+        """ Новая/возобновленная рассылка в этом процессе - не ждать poll_interval. """
+        if self._wakeup: self._wakeup.set()
+
+    async def stop(self):
+        if not self._task: return
+        self._task.cancel()
+        try: await self._task
+        except asyncio.CancelledError: pass
+        self._task = None
+
+    async def _poll(self):
+        while True:
+            try:
+                async with async_session_factory() as session: broadcast = await crud.get_next_running_broadcast(session)
+                if broadcast: await self._run(broadcast); continue
+            except asyncio.CancelledError: raise
+            except Exception as e: logger.exception(f"[Broadcast] Runner error: {e}")
+            try: await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError: pass
+            self._wakeup.clear()
+
+    async def _send(self, user_id: int, text: str) -> bool:
+        async with self._semaphore: return await notify_user(self._bot, user_id, text)
+
+    async def _run(self, broadcast: Broadcast):
+        bid, text = broadcast.id, broadcast.text
+        cursor, sent, failed = broadcast.cursor_user_id, broadcast.sent, broadcast.failed
+        logger.info(f"[Broadcast {bid}] {'Resumed from user ' + str(cursor) if cursor else 'Started'} ({broadcast.total} recipients).")
+        next_report = time.monotonic() + self.progress_interval; started = time.monotonic(); processed = 0
+        while True:
+            async with async_session_factory() as session:
+                broadcast = await crud.get_broadcast(session, bid)
+                if broadcast is None or broadcast.status != BroadcastStatus.RUNNING: break
+                user_ids = await crud.get_broadcast_recipient_ids(session, cursor, self.page_size)
+                if not user_ids:
+                    await crud.update_broadcast(session, bid, only_if=[BroadcastStatus.RUNNING], status=BroadcastStatus.DONE)
+                    broadcast = await crud.get_broadcast(session, bid); break
+            results = await asyncio.gather(*(self._send(uid, text) for uid in user_ids))
+            ok = sum(results); sent += ok; failed += len(results) - ok; cursor = user_ids[-1]; processed += len(results)
+            async with async_session_factory() as session:
+                await crud.update_broadcast(session, bid, cursor_user_id=cursor, sent=sent, failed=failed)
+                if time.monotonic() >= next_report:
+                    await self.report(await crud.get_broadcast(session, bid)); next_report = time.monotonic() + self.progress_interval
+        if broadcast is None: return
+        await self.report(broadcast)
+        elapsed = time.monotonic() - started
+        log_msg = (f"Рассылка №{bid} (Ad:{broadcast.admin_id}) {broadcast.status.name}. Успех:{sent}, Ошибки:{failed}. "
+                   f"За этот запуск {processed} за {elapsed:.0f}с.")
+        logger.info(log_msg)
+        async with async_session_factory() as session: await crud.add_log_entry(session, LogLevel.INFO, log_msg, handler="admin_bcast")
+
+    async def report(self, broadcast: Optional[Broadcast]):
+        """ Обновляет сообщение админа с прогрессом и кнопками управления. """
+        if not broadcast or not broadcast.progress_message_id or not self._bot: return
+        try:
+            await self._bot.edit_message_text(format_progress(broadcast), chat_id=broadcast.admin_chat_id, message_id=broadcast.progress_message_id,
+                                              reply_markup=inline.get_broadcast_control_keyboard(broadcast.id, broadcast.status))
+        except TelegramBadRequest: pass # "message is not modified" / сообщение удалено
+        except Exception as e: logger.warning(f"[Broadcast {broadcast.id}] Progress update failed: {e}")
+
+
+broadcast_runner = BroadcastRunner(
+    concurrency=settings.broadcast_concurrency,
+    page_size=settings.broadcast_page_size, progress_interval=settings.broadcast_progress_interval )
@@ -0,0 +1,134 @@
+import json
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from aiogram import Bot
+
+from core.config import settings
+from database import crud
+from database.database import async_session_factory
+from database.models import JobStatus, ServiceJob
+
+logger = logging.getLogger(__name__)
+
+# Обработчик услуги: (bot, job, payload) -> True при успехе. Сам отправляет результат пользователю.
+JobHandler = Callable[[Bot, ServiceJob, Dict[str, Any]], Awaitable[bool]]
+# Вызывается один раз, если задача окончательно провалилась (исключение, таймаут, исчерпаны попытки): сообщение и возврат кредита
+JobFailureHandler = Callable[[Bot, ServiceJob], Awaitable[None]]
+
+JOB_RETENTION = timedelta(days=7) # Сколько хранить завершенные задачи
+JOB_STATUS_COMMAND = "job_" # /job_<номер> - статус заявки (handlers/common.py)
+
+def job_status_hint(job_id: int) -> str: return f"Статус: /{JOB_STATUS_COMMAND}{job_id}"
+
+
+class JobQueue:
+    """
+    Очередь долгих платных услуг (OpenAI, kerykeion, отрисовка карт) в таблице service_jobs.
+    Хендлер списывает кредит, кладет задачу и сразу отвечает; результат приходит отдельным сообщением,
+    при окончательной ошибке обработчик on_failure возвращает кредит.
+    В каждом процессе - до concurrency одновременно выполняемых задач; задачи забираются атомарно,
+    поэтому воркеров может быть несколько. Задачи переживают рестарт: незавершенные возвращаются в очередь.
+    """
+    def __init__(self, concurrency: int, timeout: float, max_attempts: int, poll_interval: float):
+        self.concurrency = concurrency; self.timeout = timeout
+        self.max_attempts = max_attempts; self.poll_interval = poll_interval
+        self._handlers: Dict[str, JobHandler] = {}
+        self._on_failure: Optional[JobFailureHandler] = None
+        self._bot: Optional[Bot] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._poller: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+        self._stopping = False
+
+    def register(self, service_id: str, handler: JobHandler):
+        self._handlers[service_id] = handler
+
+    def on_failure(self, handler: JobFailureHandler):
+        self._on_failure = handler
+
+    async def enqueue(self, session, user_id: int, chat_id: int, service_id: str, payload: Dict[str, Any], is_free: bool = False) -> Optional[int]:
+        """ Сохраняет задачу и будит поллер этого процесса. None - если задачу записать не удалось. """
+        job_id = await crud.create_service_job(session, user_id, chat_id, service_id, payload, is_free)
+        if job_id is not None and self._wakeup: self._wakeup.set()
+        return job_id
+
+    def start(self, bot: Bot):
+        if self._poller: return
+        self._bot = bot; self._stopping = False
+        self._wakeup = asyncio.Event(); self._wakeup.set() # Сразу подобрать то, что осталось с прошлого запуска
+        self._poller = asyncio.create_task(self._poll(), name="job-queue-poller")
+        logger.info(f"[JobQueue] Started: concurrency={self.concurrency}, timeout={self.timeout}s.")
+
+    async def stop(self, grace: float = 10.0):
+        """ Перестает брать задачи, дает выполняющимся grace секунд, остальные возвращает в очередь. """
+        if not self._poller: return
+        self._stopping = True; self._poller.cancel()
+        try: await self._poller
+        except asyncio.CancelledError: pass
+        self._poller = None
+        if self._running:
+            _, pending = await asyncio.wait(self._running, timeout=grace)
+            for task in pending: task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        logger.info("[JobQueue] Stopped.")
+
+    async def _poll(self):
+        last_maintenance = datetime.min.replace(tzinfo=timezone.utc)
+        while True:
+            try: await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError: pass
+            self._wakeup.clear()
+            try:
+                now = datetime.now(timezone.utc)
+                if now - last_maintenance >= timedelta(minutes=1): await self._maintenance(now); last_maintenance = now
+                free = self.concurrency - len(self._running)
+                if free <= 0: continue
+                async with async_session_factory() as session: jobs = await crud.claim_service_jobs(session, free)
+                for job in jobs:
+                    task = asyncio.create_task(self._run(job), name=f"job-{job.id}")
+                    self._running.add(task); task.add_done_callback(self._on_task_done)
+            except asyncio.CancelledError: raise
+            except Exception as e: logger.exception(f"[JobQueue] Poll error: {e}")
+
+    def _on_task_done(self, task: asyncio.Task):
+        self._running.discard(task)
+        if self._wakeup and not self._stopping: self._wakeup.set() # Освободился слот - берем следующую
+
+    async def _maintenance(self, now: datetime):
+        """ Возврат "зависших" задач упавших процессов и чистка старых. """
+        async with async_session_factory() as session:
+            requeued, failed = await crud.requeue_stale_service_jobs(session, now - timedelta(seconds=self.timeout * 2), self.max_attempts)
+            if requeued: logger.warning(f"[JobQueue] Requeued {requeued} stale jobs.")
+            for job in failed: await self._notify_failure(job)
+            if now.minute == 0: await crud.purge_service_jobs(session, now - JOB_RETENTION)
+
+    async def _run(self, job: ServiceJob):
+        handler = self._handlers.get(job.service_id)
+        status, error = JobStatus.FAILED, None
+        try:
+            if not handler: error = f"no handler for {job.service_id}"
+            else:
+                ok = await asyncio.wait_for(handler(self._bot, job, json.loads(job.payload)), timeout=self.timeout)
+                status = JobStatus.DONE if ok else JobStatus.FAILED
+        except asyncio.CancelledError: # Остановка процесса: вернем задачу в очередь
+            async with async_session_factory() as session: await crud.finish_service_job(session, job.id, JobStatus.QUEUED)
+            raise
+        except asyncio.TimeoutError: error = f"timeout {self.timeout}s"
+        except Exception as e: logger.exception(f"[JobQueue] Job {job.id} ({job.service_id}) failed: {e}"); error = repr(e)
+        async with async_session_factory() as session: finished = await crud.finish_service_job(session, job.id, status, error)
+        if not finished: logger.warning(f"[JobQueue] Job {job.id} ({job.service_id}) was already finished elsewhere, result {status.name} ignored."); return
+        logger.info(f"[JobQueue] Job {job.id} ({job.service_id}) user {job.user_id}: {status.name}" + (f" ({error})" if error else ""))
+        if status == JobStatus.FAILED: await self._notify_failure(job)
+
+    async def _notify_failure(self, job: ServiceJob):
+        if not self._on_failure or not self._bot: return
+        try: await self._on_failure(self._bot, job)
+        except Exception as e: logger.exception(f"[JobQueue] Failure notification error job {job.id}: {e}")
+
+
+job_queue = JobQueue(
+    concurrency=settings.job_workers, timeout=settings.job_timeout_seconds,
+    max_attempts=settings.job_max_attempts, poll_interval=settings.job_poll_interval )
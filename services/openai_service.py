@@ -41,6 +41,13 @@ if settings.openai_api_key:
     except Exception as e: logger.exception(f"Ошибка инициализации клиента OpenAI: {e}")
 else: logger.error("OpenAI API Key не найден.")
 
+# Ошибки и пустые ответы возвращаются текстом вместо результата
+ERROR_RESULT_PREFIXES = ("Ошибка", "ИИ не смог")
+
+def is_error_result(text: Optional[str]) -> bool:
+    """ Ответ сервиса - ошибка, а не интерпретация: платную задачу нужно провалить (возврат кредита). """
+    return not text or text.lstrip().startswith(ERROR_RESULT_PREFIXES)
+
 
 async def get_openai_interpretation(
     prompt_template_name: str, prompt_data: Dict[str, Any], context: str = "general",
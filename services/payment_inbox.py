@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from aiogram import Bot
+
+from core.config import settings, PAYMENT_THANK_YOU
+from database import crud
+from database.database import async_session_factory
+from services.user_service import notify_user
+
+logger = logging.getLogger(__name__)
+
+INBOX_RETENTION = timedelta(days=30) # Обработанные уведомления и отправленные сообщения
+
+
+class PaymentInboxWorker:
+    """
+    Обработка payment_inbox в главном процессе (как планировщик и рассылки).
+    Пачка уведомлений - одна транзакция: статусы, начисления, сообщения пользователям в notification_outbox.
+    Если пачка не применилась, уведомления применяются по одному, и ошибочное не задерживает остальные
+    (после max_attempts снимается с обработки с last_error). Сообщения из outbox отправляются после commit.
+    """
+    def __init__(self, batch_size: int, poll_interval: float, max_attempts: int):
+        self.batch_size = batch_size; self.poll_interval = poll_interval; self.max_attempts = max_attempts
+        self._bot: Optional[Bot] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, bot: Bot):
+        if self._task: return
+        self._bot = bot; self._wakeup = asyncio.Event(); self._wakeup.set() # Сразу разобрать накопленное
+        self._task = asyncio.create_task(self._poll(), name="payment-inbox")
+
+    def wake(self):
+        """ Вебхук принят этим процессом - не ждать poll_interval. В остальных воркерах _wakeup нет. """
+        if self._wakeup: self._wakeup.set()
+
+    async def stop(self):
+        if not self._task: return
+        self._task.cancel()
+        try: await self._task
+        except asyncio.CancelledError: pass
+        self._task = None
+
+    async def _poll(self):
+        last_purge = datetime.min.replace(tzinfo=timezone.utc)
+        while True:
+            try:
+                processed = await self._process_inbox()
+                await self._deliver()
+                now = datetime.now(timezone.utc)
+                if now - last_purge >= timedelta(hours=1):
+                    async with async_session_factory() as session: await crud.purge_payment_inbox(session, now - INBOX_RETENTION)
+                    last_purge = now
+                if processed >= self.batch_size: continue # Есть еще - без ожидания
+            except asyncio.CancelledError: raise
+            except Exception as e: logger.exception(f"[PaymentInbox] Poll error: {e}")
+            try: await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError: pass
+            self._wakeup.clear()
+
+    async def _process_inbox(self) -> int:
+        async with async_session_factory() as session:
+            batch = await crud.get_unprocessed_payment_notifications(session, self.batch_size)
+            if not batch: return 0
+            awards = await crud.apply_payment_notifications(session, batch, PAYMENT_THANK_YOU)
+            if awards is None:
+                awards = []
+                for n in batch:
+                    one = await crud.apply_payment_notifications(session, [n], PAYMENT_THANK_YOU)
+                    if one is not None: awards += one; continue
+                    logger.error(f"[PaymentInbox] Notification {n.id} ({n.payment_id}/{n.status}) failed.")
+                    await crud.fail_payment_notification(session, n.id, "apply failed, see logs", self.max_attempts)
+        for award in awards: logger.info(f"[PaymentInbox] Credits ({award.credits}) awarded user {award.user_id}. Balance: {award.balance}")
+        logger.info(f"[PaymentInbox] Processed {len(batch)} notifications, {len(awards)} awards.")
+        return len(batch)
+
+    async def _deliver(self):
+        """ Сообщения из outbox. Отправка по одному, статусы - одним commit на пачку. """
+        async with async_session_factory() as session: pending = await crud.get_pending_notifications(session, self.batch_size)
+        if not pending: return
+        sent: List[int] = []; failed: List[int] = []
+        for item in pending: (sent if await notify_user(self._bot, item.user_id, item.text) else failed).append(item.id)
+        async with async_session_factory() as session: await crud.finish_notifications(session, sent, failed, self.max_attempts)
+        if failed: logger.warning(f"[PaymentInbox] {len(failed)} notifications not delivered (will retry up to {self.max_attempts} attempts).")
+
+
+payment_inbox_worker = PaymentInboxWorker(
+    batch_size=settings.payment_inbox_batch_size, poll_interval=settings.payment_inbox_poll_interval,
+    max_attempts=settings.payment_inbox_max_attempts )
@@ -1,38 +1,39 @@
+import json
+import asyncio
 import logging
 import uuid
-import asyncio
-from typing import Optional, Dict, Any, Tuple
-from yookassa import Configuration, Payment as YooKassaPayment
-from yookassa.domain.response import PaymentResponse
-from yookassa.domain.exceptions import (
-    ApiError, BadRequestError, ForbiddenError, InternalServerError,
-    NotFoundError, ResponseProcessingError, TooManyRequestsError, UnauthorizedError
-)
+import ipaddress
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import NamedTuple, Optional, Dict, Any, Tuple
 from sqlalchemy.ext.asyncio import AsyncSession
-from aiogram import Bot
 
 # Используем Pydantic settings
-from core.config import settings
+from core.config import settings, PAYMENT_OPTIONS
 
 # Импорт CRUD и моделей
 import database.crud as crud
 from database.models import PaymentStatus, Payment
+from database.database import async_session_factory, release_session
 
-# Импорт user_service для уведомлений об оплате
-from services import user_service
+from services.yookassa_client import (
+    yookassa_client, YooKassaError, YooKassaPayment, BadRequestError, ForbiddenError,
+    InternalServerError, NotFoundError, TooManyRequestsError, UnauthorizedError
+)
+from services.payment_inbox import payment_inbox_worker # Обработка уведомлений и сообщения об оплате
+from utils.http_metrics import counters
 
 logger = logging.getLogger(__name__)
 
 # --- YooKassa Configuration ---
-YOOKASSA_ENABLED = False
-if settings.yookassa_shop_id and settings.yookassa_secret_key:
-    try:
-        Configuration.configure(settings.yookassa_shop_id, settings.yookassa_secret_key.get_secret_value())
-        logger.info("YooKassa SDK сконфигурирован.")
-        YOOKASSA_ENABLED = True
-    except Exception as e: logger.exception(f"Ошибка конфигурации YooKassa SDK: {e}")
+YOOKASSA_ENABLED = yookassa_client is not None
+if YOOKASSA_ENABLED: logger.info(f"YooKassa клиент настроен ({settings.yookassa_api_url}).")
 else: logger.warning("YooKassa Shop ID/Secret Key не установлены.")
 
+async def close():
+    """ Закрывает пул HTTP-соединений с ЮKassa (on_shutdown). """
+    if yookassa_client: await yookassa_client.close()
+
 
 async def create_yookassa_payment(
     session: AsyncSession, user_id: int, amount_rub: int, credits_to_add: int, payment_option_key: str
@@ -40,7 +41,7 @@ async def create_yookassa_payment(
     if not YOOKASSA_ENABLED: logger.error(f"Create payment user {user_id}: YooKassa disabled."); return None, None, "Платежный сервис отключен."
 
     amount_kopecks = amount_rub * 100
-    description = f"Покупка {credits_to_add} кр. ({settings.PAYMENT_OPTIONS.get(payment_option_key,{}).get('description','')}) user:{user_id}"
+    description = f"Покупка {credits_to_add} кр. ({PAYMENT_OPTIONS.get(payment_option_key,{}).get('description','')}) user:{user_id}"
     idempotence_key = str(uuid.uuid4())
     return_url = settings.base_webhook_url or "https://t.me/" # Куда вернуть пользователя
 
@@ -54,70 +55,117 @@ async def create_yookassa_payment(
 
     logger.info(f"Create payment user {user_id}, amount: {amount_rub}, credits: {credits_to_add}, key: {idempotence_key}")
     try:
-        payment_response: PaymentResponse = await asyncio.to_thread(YooKassaPayment.create, payment_data, idempotence_key)
+        await release_session(session) # Не держим соединение с БД, пока ждем ЮKassa
+        payment_response: YooKassaPayment = await yookassa_client.create_payment(payment_data, idempotence_key)
         logger.info(f"Payment created: ID={payment_response.id}, Status={payment_response.status}")
         db_payment = await crud.create_payment(session, user_id, payment_response.id, amount_kopecks, credits_to_add, description)
         if not db_payment: logger.error(f"Failed save payment {payment_response.id} to DB!"); return None, None, "Ошибка БД."
-        if payment_response.confirmation and payment_response.confirmation.confirmation_url:
-            logger.info(f"Confirmation URL user {user_id}: {payment_response.confirmation.confirmation_url}")
-            return payment_response.confirmation.confirmation_url, payment_response.id, None
+        if payment_response.confirmation_url:
+            logger.info(f"Confirmation URL user {user_id}: {payment_response.confirmation_url}")
+            return payment_response.confirmation_url, payment_response.id, None
         else: logger.error(f"No confirmation_url for payment {payment_response.id}"); return None, payment_response.id, "Нет ссылки на оплату."
     except UnauthorizedError: logger.error(f"Auth Error YooKassa user {user_id}."); return None, None, "Ошибка конфигурации платежей."
     except ForbiddenError: logger.error(f"Forbidden YooKassa user {user_id}."); return None, None, "Ошибка доступа к платежам."
-    except BadRequestError as e: logger.exception(f"Bad Request YooKassa user {user_id}: {e}"); return None, None, f"Ошибка параметров: {getattr(e, 'message', '')}"
+    except BadRequestError as e: logger.error(f"Bad Request YooKassa user {user_id}: {e}"); return None, None, f"Ошибка параметров: {e.description}"
     except TooManyRequestsError: logger.warning(f"Rate Limit YooKassa user {user_id}."); return None, None, "Слишком много запросов, попробуйте позже."
     except InternalServerError as e: logger.error(f"Internal Error YooKassa user {user_id}: {e}"); return None, None, "Ошибка сервера платежей."
-    except ApiError as e: logger.exception(f"API Error YooKassa user {user_id}: {e}"); return None, None, f"Ошибка API платежей: {getattr(e, 'message', type(e).__name__)}"
+    except YooKassaError as e: logger.error(f"API Error YooKassa user {user_id}: {e}"); return None, None, f"Ошибка API платежей: {e.description or e.code}"
     except Exception as e: logger.exception(f"Unexpected error create payment user {user_id}: {e}"); return None, None, "Внутренняя ошибка."
 
 
+async def _fetch_status(yookassa_payment_id: str) -> Optional[str]:
+    """ Статус платежа в ЮKassa. Платеж не найден - canceled (как при ручной проверке). None - ошибка API/сети. """
+    try: return (await yookassa_client.get_payment(yookassa_payment_id)).status
+    except NotFoundError: logger.warning(f"Payment {yookassa_payment_id} not found in YooKassa."); return PaymentStatus.CANCELED.value
+    except YooKassaError as e: logger.warning(f"Get payment {yookassa_payment_id} error: {e}"); return None
+
+async def _enqueue_statuses(session: AsyncSession, statuses: Dict[str, str], event: str) -> Optional[int]:
+    """ Статусы, полученные запросом к ЮKassa, идут в payment_inbox как уведомления - начисляет и сообщает PaymentInboxWorker. """
+    payloads = [(pid, status, json.dumps({"event": event, "object": {"id": pid, "status": status}})) for pid, status in statuses.items()]
+    queued = await crud.save_payment_notifications(session, payloads, event)
+    if queued: payment_inbox_worker.wake()
+    return queued
+
+
 async def check_yookassa_payment_status(session: AsyncSession, yookassa_payment_id: str) -> Tuple[Optional[PaymentStatus], Optional[int]]:
     if not YOOKASSA_ENABLED: return None, None
     logger.info(f"[Manual Check] Check status payment {yookassa_payment_id}")
     try:
-        payment_info: PaymentResponse = await asyncio.to_thread(YooKassaPayment.find_one, yookassa_payment_id)
-        status = payment_info.status; logger.info(f"[Manual Check] YooKassa status {yookassa_payment_id}: {status}")
+        await release_session(session)
+        status = await _fetch_status(yookassa_payment_id)
+        if status is None: return None, None
+        logger.info(f"[Manual Check] YooKassa status {yookassa_payment_id}: {status}")
         new_status = {"succeeded": PaymentStatus.SUCCEEDED, "canceled": PaymentStatus.CANCELED, "waiting_for_capture": PaymentStatus.WAITING_FOR_CAPTURE}.get(status, PaymentStatus.PENDING)
         db_payment = await crud.get_payment_by_yookassa_id(session, yookassa_payment_id)
         if not db_payment: logger.warning(f"[Manual Check] Payment {yookassa_payment_id} not in DB."); return new_status, None
-        if db_payment.status != new_status:
-            await crud.update_payment_status(session, yookassa_payment_id, new_status)
-            logger.info(f"[Manual Check] DB Status updated {yookassa_payment_id} -> {new_status.name}")
+        if db_payment.status != new_status: # Через inbox: успешный платеж будет и начислен, и сообщен пользователю
+            await _enqueue_statuses(session, {yookassa_payment_id: new_status.value}, "manual_check")
+            logger.info(f"[Manual Check] Queued {yookassa_payment_id} -> {new_status.name}")
         return new_status, db_payment.user_id
-    except NotFoundError: logger.warning(f"[Manual Check] Payment {yookassa_payment_id} not found in YooKassa."); await crud.update_payment_status(session, yookassa_payment_id, PaymentStatus.CANCELED); return PaymentStatus.CANCELED, None
     except Exception as e: logger.exception(f"[Manual Check] Error check status {yookassa_payment_id}: {e}"); return None, None
 
 
-async def process_yookassa_notification(session: AsyncSession, bot: Bot, notification_data: Dict[str, Any]) -> bool:
-    if not YOOKASSA_ENABLED: logger.error("[Webhook] YooKassa disabled."); return False
-    try:
-        event, payment_obj = notification_data.get('event'), notification_data.get('object')
-        if not event or not payment_obj or payment_obj.get('type') != 'payment': logger.warning(f"[Webhook] Invalid notification: {notification_data}"); return True
-        payment_id, status_notif = payment_obj.get('id'), payment_obj.get('status')
-        if not payment_id or not status_notif: logger.warning(f"[Webhook] No ID or Status: {notification_data}"); return True
-        logger.info(f"[Webhook] Notification: {payment_id=}, {status_notif=}, {event=}")
-        db_payment = await crud.get_payment_by_yookassa_id(session, payment_id)
-        if not db_payment: logger.error(f"[Webhook] Payment {payment_id} not in DB."); return True # Отвечаем ОК
-
-        new_status = {"succeeded": PaymentStatus.SUCCEEDED, "canceled": PaymentStatus.CANCELED, "waiting_for_capture": PaymentStatus.WAITING_FOR_CAPTURE}.get(status_notif, PaymentStatus.PENDING)
-        needs_update = db_payment.status != new_status
-        is_success = new_status == PaymentStatus.SUCCEEDED
-        already_awarded = db_payment.credits_awarded
-
-        if needs_update: await crud.update_payment_status(session, payment_id, new_status); logger.info(f"[Webhook] DB Status updated {payment_id} -> {new_status.name}.")
-
-        if is_success and not already_awarded:
-            logger.info(f"[Webhook] Payment {payment_id} succeeded. Awarding credits.")
-            user_id, credits = db_payment.user_id, db_payment.credits_purchased
-            new_balance = await crud.update_user_credits(session, user_id, credits)
-            if new_balance is not None:
-                await crud.mark_payment_credits_awarded(session, payment_id)
-                logger.info(f"[Webhook] Credits ({credits}) awarded user {user_id}. Balance: {new_balance}")
-                await user_service.notify_payment_success(bot, user_id, credits) # Уведомляем пользователя
-                # Реферальный бонус теперь не здесь
-            else: logger.error(f"[Webhook] Failed awarding credits user {user_id} payment {payment_id}"); return False # Ошибка обработки
-        elif is_success and already_awarded: logger.info(f"[Webhook] Payment {payment_id} already awarded.")
-        elif new_status == PaymentStatus.CANCELED: logger.info(f"[Webhook] Payment {payment_id} canceled.")
-
-        return True # Уведомление обработано
-    except Exception as e: logger.exception(f"[Webhook] Unexpected error processing notification: {e}"); return False
\ No newline at end of file
+# --- Сверка платежей без уведомления (задача планировщика) ---
+class ReconcileResult(NamedTuple):
+    checked: int; fixed: int; errors: int
+
+async def reconcile_pending_payments() -> ReconcileResult:
+    """
+    Платежи, оставшиеся pending/waiting_for_capture дольше min_age (вебхук потерян), запрашиваются в ЮKassa
+    страницами по payment_inbox_batch_size с ограничением одновременных запросов. Изменившиеся статусы
+    одной вставкой на страницу уходят в payment_inbox - начисления и сообщения делает PaymentInboxWorker пачками.
+    fixed - сколько статусов поставлено в обработку.
+    """
+    if not YOOKASSA_ENABLED: return ReconcileResult(0, 0, 0)
+    now = datetime.now(timezone.utc)
+    created_from = now - timedelta(hours=settings.payment_reconcile_max_age_hours)
+    created_to = now - timedelta(minutes=settings.payment_reconcile_min_age_minutes)
+    semaphore = asyncio.Semaphore(settings.payment_reconcile_concurrency)
+    async def fetch(pid: str) -> Optional[str]:
+        async with semaphore: return await _fetch_status(pid)
+
+    checked = fixed = errors = 0; after = None
+    while True:
+        async with async_session_factory() as session:
+            page = await crud.get_stale_payments(session, created_from, created_to, after, settings.payment_inbox_batch_size)
+        if not page: break
+        after = (page[-1].created_at, page[-1].id)
+        statuses = await asyncio.gather(*(fetch(p.yookassa_payment_id) for p in page))
+        changed = {p.yookassa_payment_id: status for p, status in zip(page, statuses) if status and status != p.status.value}
+        checked += len(page); errors += statuses.count(None)
+        if changed:
+            async with async_session_factory() as session: queued = await _enqueue_statuses(session, changed, "reconcile")
+            if queued is None: errors += len(changed)
+            else: fixed += queued
+        if len(page) < settings.payment_inbox_batch_size: break
+    counters['payments_reconciled_total'] += fixed
+    if checked: logger.info(f"[Reconcile] Checked {checked} stale payments: {fixed} fixed, {errors} errors.")
+    return ReconcileResult(checked, fixed, errors)
+
+
+# --- Прием уведомлений (вебхук) ---
+YOOKASSA_NETWORKS = tuple(ipaddress.ip_network(net) for net in settings.yookassa_ips) # Разбираются один раз при импорте
+
+@lru_cache(maxsize=1024)
+def is_yookassa_ip(remote: Optional[str]) -> Optional[bool]:
+    """ Адрес из сетей ЮKassa (IPv4-mapped IPv6 тоже). None - адрес не распознан. Ответ кэшируется: адресов у ЮKassa немного. """
+    try: ip = ipaddress.ip_address(remote)
+    except ValueError: return None
+    if ip.version == 6 and ip.ipv4_mapped: ip = ip.ipv4_mapped
+    return any(ip in net for net in YOOKASSA_NETWORKS)
+
+async def ingest_yookassa_notification(session: AsyncSession, notification_data: Dict[str, Any]) -> bool:
+    """
+    Только проверка формы и запись в payment_inbox - без обращений к платежам и Telegram, чтобы ответить ЮKassa сразу.
+    Повтор того же (платеж, статус) не вставляется. False - ошибка БД (ответить 500, ЮKassa повторит).
+    """
+    event, payment_obj = notification_data.get('event'), notification_data.get('object')
+    if not event or not isinstance(payment_obj, dict) or payment_obj.get('type', 'payment') != 'payment':
+        logger.warning(f"[Webhook] Invalid notification: {str(notification_data)[:500]}"); return True
+    payment_id, status = payment_obj.get('id'), payment_obj.get('status')
+    if not payment_id or not status: logger.warning(f"[Webhook] No ID or Status: {str(notification_data)[:500]}"); return True
+    saved = await crud.save_payment_notification(session, str(payment_id), str(status), event, json.dumps(notification_data, ensure_ascii=False))
+    if saved is None: return False
+    logger.info(f"[Webhook] Notification {payment_id=}, {status=}, {event=}: {'queued' if saved else 'duplicate'}.")
+    if saved: payment_inbox_worker.wake()
+    return True
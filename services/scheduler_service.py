@@ -3,30 +3,34 @@ import asyncio
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.executors.asyncio import AsyncIOExecutor
-from datetime import datetime, time, timezone
+from datetime import datetime, time, timezone, timedelta
+from typing import Optional
 import pytz
 from aiogram import Bot
 
 # Используем Pydantic settings
 from core.config import settings
-from database.database import async_session_factory # Импортируем фабрику сессий
+from database.database import async_session_factory, create_sync_db_engine # Импортируем фабрику сессий
+from utils.send_scheduler import bulk_sends
 
 logger = logging.getLogger(__name__)
 
-# Настройка хранилища (используем СИНХРОННЫЙ URL из настроек)
-jobstores = {'default': SQLAlchemyJobStore(url=settings.sync_database_url)}
+# Настройка хранилища (СИНХРОННЫЙ движок: для SQLite с теми же PRAGMA, что и основной - WAL, busy_timeout)
+jobstores = {'default': SQLAlchemyJobStore(engine=create_sync_db_engine(settings.sync_database_url))}
 executors = {'default': AsyncIOExecutor()}
 job_defaults = {'coalesce': True, 'max_instances': 1, 'misfire_grace_time': 300}
 
 scheduler = AsyncIOScheduler(
     jobstores=jobstores, executors=executors, job_defaults=job_defaults, timezone=pytz.utc
 )
+_bot: Optional[Bot] = None # Задается в setup_scheduler_jobs: аргументы задач хранятся в jobstore (pickle), Bot туда не попадает
 
 def start_scheduler():
     try:
         if not scheduler.running: scheduler.start(); logger.info("[Scheduler] Started.")
         else: logger.warning("[Scheduler] Already running.")
     except Exception as e: logger.exception(f"[Scheduler] Start error: {e}")
+    if not scheduler.running: logger.critical("[Scheduler] Not running: periodic jobs are disabled.")
 
 def shutdown_scheduler():
     try:
@@ -34,54 +38,180 @@ def shutdown_scheduler():
     except Exception as e: logger.exception(f"[Scheduler] Stop error: {e}")
 
 # --- Задача рассылки гороскопов ---
-async def send_daily_horoscopes_job(bot: Bot):
-    # Импорты внутри для предотвращения циклов и доступа к сессии/боту
-    from database import crud
+# Гороскопы генерируются заранее (за horoscope_lookahead_minutes до слота) и складываются в horoscope_outbox,
+# а отправляются ровно в свою минуту. Так задержка OpenAI не попадает между "пора" и "доставлено",
+# а нагрузка на OpenAI распределяется по окну, а не приходится на :00.
+OUTBOX_DELIVERY_GRACE = timedelta(minutes=5) # Сколько после слота еще можно доставить (как misfire_grace_time)
+OUTBOX_RETENTION = timedelta(days=2) # Сколько хранить отправленные/неудачные записи
+
+async def _generate_horoscope_text(first_name: str, natal_data) -> Optional[str]:
+    """ Рассчитывает карту и получает текст гороскопа. None - ошибка (будет повтор). """
     from services.astrology_service import get_natal_data_kerykeion, get_daily_horoscope_interpretation
+    from services.openai_service import is_error_result
+    kr_instance = await get_natal_data_kerykeion(
+        first_name=first_name, birth_date=natal_data.birth_date, birth_time=natal_data.birth_time,
+        city_name=natal_data.birth_city, latitude=natal_data.latitude, longitude=natal_data.longitude,
+        timezone_str=natal_data.timezone )
+    if not kr_instance: return None
+    horoscope_text = await get_daily_horoscope_interpretation(kr_instance)
+    if is_error_result(horoscope_text): return None # Ошибки OpenAI возвращаются текстом
+    return horoscope_text
+
+async def _enqueue_upcoming_horoscopes(now: datetime):
+    """
+    Ставит в очередь слоты в окне [now, now + lookahead]: подписчики всех минут окна читаются одним потоковым запросом,
+    в очередь идут пачками по HOROSCOPE_ENQUEUE_CHUNK через отдельную сессию (commit не закрывает курсор чтения).
+    """
+    from database import crud
+    slot_by_time = {}
+    for offset in range(settings.horoscope_lookahead_minutes + 1):
+        slot = now + timedelta(minutes=offset); slot_by_time.setdefault(slot.strftime("%H:%M"), slot)
+    added = 0; chunk = []
+    async with async_session_factory() as read_session, async_session_factory() as write_session:
+        async for row in crud.stream_horoscope_recipients(read_session, list(slot_by_time)):
+            chunk.append((row.id, slot_by_time[row.daily_horoscope_time]))
+            if len(chunk) >= crud.HOROSCOPE_ENQUEUE_CHUNK: added += await crud.enqueue_horoscope_slots(write_session, chunk); chunk = []
+        added += await crud.enqueue_horoscope_slots(write_session, chunk)
+    if added: logger.info(f"[Scheduler] Queued {added} horoscopes up to {(now + timedelta(minutes=settings.horoscope_lookahead_minutes)):%H:%M} UTC.")
+
+async def _generate_pending_horoscopes(now: datetime):
+    """ Генерирует тексты для PENDING записей окна. Неудачные остаются PENDING и повторяются на следующих минутах. """
+    from database import crud
+    from database.models import HoroscopeStatus
+    window_end = now + timedelta(minutes=settings.horoscope_lookahead_minutes)
+    async with async_session_factory() as session:
+        pending = await crud.get_outbox_for_generation(session, now - OUTBOX_DELIVERY_GRACE, window_end, settings.horoscope_max_attempts)
+    if not pending: return
+
+    semaphore = asyncio.Semaphore(settings.horoscope_concurrency)
+    async def generate(row):
+        async with semaphore:
+            try: return await _generate_horoscope_text(row.first_name, row), None
+            except Exception as e: return None, f"{type(e).__name__}: {e}"
+
+    results = await asyncio.gather(*(generate(row) for row in pending))
+    updates = []; ready = 0
+    for row, (text, error) in zip(pending, results):
+        if text: updates.append({"id": row.outbox_id, "attempts": row.attempts + 1, "text": text, "status": HoroscopeStatus.READY, "last_error": None}); ready += 1
+        else:
+            updates.append({"id": row.outbox_id, "attempts": row.attempts + 1, "last_error": (error or "generation failed")[:500]})
+            logger.warning(f"[Scheduler] Horoscope generation failed user {row.id} (attempt {row.attempts + 1}).")
+    async with async_session_factory() as session:
+        updates.sort(key=lambda u: "text" in u) # Одинаковые наборы ключей подряд -> один executemany на группу
+        await crud.save_outbox_results(session, updates)
+    logger.info(f"[Scheduler] Generated {ready}/{len(pending)} horoscopes.")
+
+async def _deliver_due_horoscopes(bot: Bot, now: datetime):
+    """
+    Отправляет готовые гороскопы, время которых наступило: пачками по horoscope_send_batch_size,
+    внутри пачки параллельно (не больше horoscope_send_concurrency), статусы пачки - одним обновлением.
+    При сбое повторно может уйти только текущая пачка.
+    """
+    from database import crud
+    from database.models import HoroscopeStatus
     from services.user_service import notify_user
-    from utils.date_time_helpers import get_current_utc_time_str
-
-    current_utc_time_str = get_current_utc_time_str()
-    logger.info(f"[Scheduler] Running horoscope job for {current_utc_time_str} UTC.")
-
-    try: # Оборачиваем весь блок работы с сессией
-        async with async_session_factory() as session: # Получаем сессию из фабрики
-            users_to_notify = await crud.get_users_for_daily_horoscope(session, current_utc_time_str)
-            if not users_to_notify: logger.info(f"[Scheduler] No users for {current_utc_time_str}."); return
-            logger.info(f"[Scheduler] Found {len(users_to_notify)} users for {current_utc_time_str}.")
-
-            for user in users_to_notify:
-                # Проверка данных перед расчетом
-                if not user.accepted_terms: logger.warning(f"[Scheduler] Skip user {user.id}: terms not accepted."); continue
-                # natal_data проверяется JOIN'ом в crud.get_users_for_daily_horoscope
-                # Доп. проверка на всякий случай
-                natal_data = await crud.get_natal_data(session, user.id)
-                if not natal_data: logger.warning(f"[Scheduler] Skip user {user.id}: natal data not found (should not happen)."); continue
-
-                logger.debug(f"[Scheduler] Processing user {user.id} ({user.first_name}).")
-                try: # Обработка ошибок для одного пользователя
-                    kr_instance = await get_natal_data_kerykeion(
-                        first_name=user.first_name, birth_date=natal_data.birth_date, birth_time=natal_data.birth_time,
-                        city_name=natal_data.birth_city, latitude=natal_data.latitude, longitude=natal_data.longitude,
-                        timezone_str=natal_data.timezone )
-                    if not kr_instance: logger.error(f"[Scheduler] Failed KrInstance user {user.id}."); continue
-                    horoscope_text = await get_daily_horoscope_interpretation(kr_instance)
-                    if await notify_user(bot, user.id, horoscope_text): logger.debug(f"[Scheduler] Sent to user {user.id}.")
-                    else: logger.error(f"[Scheduler] Failed sending to user {user.id}.")
-                except Exception as user_e: logger.exception(f"[Scheduler] Error processing horoscope for user {user.id}: {user_e}")
-                await asyncio.sleep(0.1) # Пауза для избежания лимитов Telegram
+    semaphore = asyncio.Semaphore(settings.horoscope_send_concurrency)
+    async def send(item) -> Optional[str]:
+        async with semaphore:
+            try: return None if await notify_user(bot, item.user_id, item.text) else "send failed"
+            except Exception as e:
+                logger.exception(f"[Scheduler] Error sending horoscope to user {item.user_id}: {e}"); return f"{type(e).__name__}: {e}"[:500]
+
+    sent = failed = 0
+    while True:
+        async with async_session_factory() as session:
+            due = await crud.get_due_outbox(session, now - OUTBOX_DELIVERY_GRACE, now, settings.horoscope_send_batch_size)
+        if not due: break
+        errors = await asyncio.gather(*(send(item) for item in due))
+        updates = [{"id": item.id, "status": HoroscopeStatus.SENT} for item, error in zip(due, errors) if error is None]
+        updates += [{"id": item.id, "status": HoroscopeStatus.FAILED, "last_error": error} for item, error in zip(due, errors) if error] # По набору ключей - executemany на группу
+        ok = errors.count(None); sent += ok; failed += len(due) - ok
+        async with async_session_factory() as session:
+            if not await crud.save_outbox_results(session, updates): break # Иначе та же пачка ушла бы снова
+        if len(due) < settings.horoscope_send_batch_size: break
+    if sent or failed: logger.info(f"[Scheduler] Horoscopes for {now:%H:%M} UTC: {sent} sent, {failed} failed.")
+
+    async with async_session_factory() as session:
+        expired = await crud.fail_stale_outbox(session, now - OUTBOX_DELIVERY_GRACE, settings.horoscope_max_attempts)
+        if expired: logger.warning(f"[Scheduler] {expired} horoscopes expired or exhausted attempts.")
+        if now.minute == 0: await crud.purge_outbox(session, now - OUTBOX_RETENTION)
 
+async def prepare_daily_horoscopes_job():
+    """ Ставит в очередь и генерирует гороскопы для слотов в окне упреждения. """
+    now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    try:
+        await _enqueue_upcoming_horoscopes(now)
+        await _generate_pending_horoscopes(now) # Включая слот текущей минуты, если он еще не готов
+    except Exception as e: logger.exception(f"[Scheduler] Global error in horoscope prepare job: {e}")
+
+async def send_daily_horoscopes_job():
+    """ Доставляет заранее сгенерированные гороскопы в их минуту. Отдельная задача, чтобы генерация не задерживала отправку. """
+    now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    if _bot is None: logger.error("[Scheduler] Bot is not set, horoscope delivery skipped."); return
+    logger.info(f"[Scheduler] Running horoscope job for {now:%H:%M} UTC.")
+    try:
+        with bulk_sends(): await _deliver_due_horoscopes(_bot, now) # Ответы пользователям не ждут за гороскопами
     except Exception as e: logger.exception(f"[Scheduler] Global error in horoscope job: {e}")
-    logger.info(f"[Scheduler] Finished horoscope job for {current_utc_time_str} UTC.")
+    logger.info(f"[Scheduler] Finished horoscope job for {now:%H:%M} UTC.")
+
+
+# --- Дневные сводки для админ-отчета ---
+async def rollup_daily_stats_job():
+    """ Пересчитывает начисто прошедшие дни (первый запуск после полуночи UTC) и обновляет снимки сегодняшнего дня. """
+    from database import crud
+    now = datetime.now(timezone.utc)
+    try:
+        async with async_session_factory() as session:
+            for day in await crud.get_days_to_finalize(session, now.date()):
+                if await crud.finalize_daily_stats(session, day): logger.info(f"[Scheduler] Daily stats finalized for {day}.")
+            await crud.refresh_daily_snapshot(session, now)
+    except Exception as e: logger.exception(f"[Scheduler] Daily stats rollup error: {e}")
+
+
+# --- Сверка платежей с ЮKassa ---
+async def reconcile_payments_job():
+    """ Находит платежи, уведомление по которым не пришло, и ставит их фактические статусы в обработку. """
+    from services import payment_service
+    try: await payment_service.reconcile_pending_payments()
+    except Exception as e: logger.exception(f"[Scheduler] Payment reconcile error: {e}")
+
+
+# --- Хранение логов в БД ---
+async def purge_logs_job():
+    """ Удаляет логи старше LOG_DB_RETENTION_DAYS. """
+    from database import crud
+    if settings.log_db_retention_days <= 0: return
+    try:
+        async with async_session_factory() as session:
+            deleted = await crud.purge_logs(session, datetime.now(timezone.utc) - timedelta(days=settings.log_db_retention_days))
+        if deleted: logger.info(f"[Scheduler] Purged {deleted} old log records.")
+    except Exception as e: logger.exception(f"[Scheduler] Log purge error: {e}")
 
 
 def setup_scheduler_jobs(bot: Bot):
-    """ Настраивает задачи планировщика при старте бота. """
+    """ Настраивает задачи планировщика при старте бота. Задачи без аргументов - их можно сохранить в jobstore. """
+    global _bot; _bot = bot
     try:
          scheduler.add_job(
              send_daily_horoscopes_job, trigger='cron', minute='*', # Каждую минуту
              id='master_horoscope_sender', name='Master Horoscope Sender',
-             replace_existing=True, max_instances=1, args=[bot] )
-         logger.info("[Scheduler] Master horoscope sender job scheduled.")
+             replace_existing=True, max_instances=1 )
+         scheduler.add_job(
+             prepare_daily_horoscopes_job, trigger='cron', minute='*',
+             id='horoscope_pregenerator', name='Horoscope Pre-generator',
+             replace_existing=True, max_instances=1 )
+         scheduler.add_job(
+             rollup_daily_stats_job, trigger='cron', minute='*/10',
+             id='daily_stats_rollup', name='Daily Stats Rollup',
+             replace_existing=True, max_instances=1 )
+         scheduler.add_job(
+             reconcile_payments_job, trigger='interval', minutes=settings.payment_reconcile_interval_minutes,
+             id='payment_reconciler', name='Payment Reconciler',
+             replace_existing=True, max_instances=1 )
+         scheduler.add_job(
+             purge_logs_job, trigger='cron', hour=3, minute=30,
+             id='log_purger', name='Log Purger',
+             replace_existing=True, max_instances=1 )
+         logger.info(f"[Scheduler] Master horoscope sender job scheduled (lookahead: {settings.horoscope_lookahead_minutes} min).")
     except Exception as e: logger.exception("[Scheduler] Error scheduling horoscope job.")
     # TODO: Добавить другие периодические задачи (например, очистка папки temp)
\ No newline at end of file
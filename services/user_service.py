@@ -2,13 +2,14 @@ import logging
 from typing import Optional, Tuple
 from sqlalchemy.ext.asyncio import AsyncSession
 from aiogram import Bot
-from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramNotFound, TelegramRetryAfter
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramNotFound, TelegramRetryAfter
 
 # Используем Pydantic settings
 from core.config import settings
 
 from database import crud
-from database.models import User, NatalData # Импорт моделей
+from database.database import async_session_factory
+from database.models import User, NatalData, CreditReason, UndeliverableReason # Импорт моделей
 
 logger = logging.getLogger(__name__)
 
@@ -16,7 +17,7 @@ async def check_service_availability(
     session: AsyncSession, user_id: int
 ) -> Tuple[bool, int, bool, str]:
     """ Проверяет доступность платной услуги. """
-    user = await crud.get_user(session, user_id)
+    user = await crud.get_user_status(session, user_id) # Легкая проекция вместо ORM-объекта
     if not user: return False, 0, False, "Ошибка: Профиль не найден."
 
     credits = user.credits
@@ -34,16 +35,24 @@ async def check_service_availability(
         msg = f"У вас {credits} кр. Нужно {service_cost} кр.\nКупите кредиты."
         return False, credits, False, msg
 
-async def use_service_credit(session: AsyncSession, user_id: int) -> bool:
-    """ Списывает кредит за услугу (НЕ обрабатывает бесплатную). """
+async def use_service_credit(session: AsyncSession, user_id: int, service_id: Optional[str] = None) -> bool:
+    """ Списывает кредит за услугу (НЕ обрабатывает бесплатную). Атомарно: при нехватке кредитов ничего не списывается. """
     # Эта функция вызывается ТОЛЬКО для платного использования
     # Бесплатное использование обрабатывается отдельно с вызовом crud.mark_first_service_used
     service_cost = settings.service_cost
-    new_balance = await crud.update_user_credits(session, user_id, -service_cost)
+    new_balance = await crud.update_user_credits(session, user_id, -service_cost, CreditReason.SERVICE, service_id)
     # crud.update_user_credits вернет None при ошибке или нехватке средств
     return new_balance is not None
 
 
+async def refund_service_credit(session: AsyncSession, user_id: int, is_free: bool, service_id: str) -> bool:
+    """ Возврат списанного кредита, если услугу не удалось поставить в очередь или выполнить. Бесплатную попытку не возвращаем. """
+    if is_free: logger.warning(f"Free {service_id} of user {user_id} was not delivered (not refunded)."); return False
+    refunded = await crud.update_user_credits(session, user_id, settings.service_cost, CreditReason.REFUND, service_id) is not None
+    logger.warning(f"Refund {settings.service_cost} credits to user {user_id} for {service_id}: {'ok' if refunded else 'FAILED'}")
+    return refunded
+
+
 async def has_natal_data(session: AsyncSession, user_id: int) -> bool:
     """ Проверяет наличие натальных данных. """
     natal_data = await crud.get_natal_data(session, user_id)
@@ -56,20 +65,21 @@ async def has_natal_data(session: AsyncSession, user_id: int) -> bool:
 
 # --- Функции уведомлений ---
 async def notify_user(bot: Bot, user_id: int, message: str, keyboard=None, parse_mode="HTML") -> bool:
-    """ Безопасная отправка сообщения пользователю с обработкой ошибок. """
+    """ Безопасная отправка сообщения пользователю с обработкой ошибок. Темп и повторы после 429 - в send_scheduler. """
     try:
         await bot.send_message(user_id, message, reply_markup=keyboard, parse_mode=parse_mode, disable_web_page_preview=True)
         logger.debug(f"Сообщение успешно отправлено user {user_id}")
         return True
-    except TelegramRetryAfter as e:
-        logger.warning(f"Flood limit exceeded for user {user_id}. Sleeping for {e.retry_after}s.")
-        await asyncio.sleep(e.retry_after)
-        return await notify_user(bot, user_id, message, keyboard, parse_mode) # Рекурсивный вызов после паузы
+    except TelegramRetryAfter as e: # Паузы и повторы после 429 уже сделал send_scheduler
+        logger.warning(f"Flood limit for user {user_id} persisted after retries (retry_after {e.retry_after}s).")
+        return False
     except (TelegramForbiddenError, TelegramNotFound) as e:
         # Бот заблокирован, пользователь удален или не существует
         logger.warning(f"Cannot send message to user {user_id}: {e}. User might have blocked the bot or is deactivated.")
-        # TODO: Можно добавить логику деактивации пользователя в БД
-        # await crud.deactivate_user(session, user_id)
+        await _deactivate(user_id, _undeliverable_reason(e)); return False
+    except TelegramBadRequest as e:
+        if "chat not found" in e.message.lower(): await _deactivate(user_id, UndeliverableReason.NOT_FOUND)
+        logger.error(f"Failed to send message to user {user_id}: {e}")
         return False
     except TelegramAPIError as e: # Другие ошибки API
         logger.error(f"Failed to send message to user {user_id}: {e}")
@@ -79,10 +89,18 @@ async def notify_user(bot: Bot, user_id: int, message: str, keyboard=None, parse
         return False
 
 
-async def notify_payment_success(bot: Bot, user_id: int, credits_purchased: int):
-    """ Уведомляет пользователя об успешной оплате. """
-    message = settings.PAYMENT_THANK_YOU.format(credits=credits_purchased)
-    await notify_user(bot, user_id, message)
+def _undeliverable_reason(e: TelegramAPIError) -> UndeliverableReason:
+    if isinstance(e, TelegramNotFound): return UndeliverableReason.NOT_FOUND
+    text = e.message.lower()
+    if "blocked" in text: return UndeliverableReason.BLOCKED
+    if "deactivated" in text: return UndeliverableReason.DEACTIVATED
+    return UndeliverableReason.FORBIDDEN
+
+async def _deactivate(user_id: int, reason: UndeliverableReason):
+    """ Отдельная сессия: notify_user вызывается и вне хендлеров (рассылка, гороскопы). """
+    async with async_session_factory() as session:
+        if await crud.deactivate_user(session, user_id, reason): logger.info(f"User {user_id} marked undeliverable: {reason.name}.")
+
 
 async def notify_payment_failure(bot: Bot, user_id: int, reason: str = ""):
     """ Уведомляет пользователя о неудачной оплате. """
@@ -94,6 +112,3 @@ async def notify_referrer_bonus(bot: Bot, referrer_id: int, referred_user_name:
     message = (f"🎉 Ваш друг {referred_user_name} воспользовался первой бесплатной услугой!"
                f"\nВам начислен бонус: {bonus_credits} кредит(а).\nСпасибо, что приглашаете друзей!")
     await notify_user(bot, referrer_id, message)
-
-# Импорт asyncio для sleep
-import asyncio
\ No newline at end of file
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+from typing import Any, Dict, NamedTuple, Optional
+
+import httpx
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# --- Ошибки (как в SDK yookassa: по HTTP статусу) ---
+class YooKassaError(Exception):
+    """ Ошибка API ЮKassa: HTTP статус (0 - сеть/таймаут) и code/description из тела ответа. """
+    def __init__(self, status: int, code: str = "", description: str = ""):
+        super().__init__(f"{status} {code}: {description}".strip())
+        self.status = status; self.code = code; self.description = description
+
+class BadRequestError(YooKassaError): pass
+class UnauthorizedError(YooKassaError): pass
+class ForbiddenError(YooKassaError): pass
+class NotFoundError(YooKassaError): pass
+class TooManyRequestsError(YooKassaError): pass
+class InternalServerError(YooKassaError): pass
+
+ERRORS_BY_STATUS = {400: BadRequestError, 401: UnauthorizedError, 403: ForbiddenError, 404: NotFoundError, 429: TooManyRequestsError}
+RETRY_STATUSES = {202, 429, 500, 502, 503, 504} # 202 - запрос еще обрабатывается, повторить с тем же ключом
+
+
+class YooKassaPayment(NamedTuple):
+    """ Нужные боту поля объекта платежа ЮKassa. """
+    id: str; status: str; paid: bool
+    amount_value: str; currency: str
+    confirmation_url: Optional[str]; metadata: Dict[str, str]
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "YooKassaPayment":
+        amount = data.get("amount") or {}; confirmation = data.get("confirmation") or {}
+        return cls(id=data["id"], status=data["status"], paid=bool(data.get("paid")),
+                   amount_value=amount.get("value", "0.00"), currency=amount.get("currency", "RUB"),
+                   confirmation_url=confirmation.get("confirmation_url"), metadata=data.get("metadata") or {})
+
+
+class YooKassaClient:
+    """
+    Асинхронный клиент API v3 ЮKassa на httpx.AsyncClient: пул keep-alive соединений на процесс,
+    таймауты, повтор при 202/429/5xx/сетевых ошибках с тем же Idempotence-Key (ЮKassa вернет тот же платеж).
+    Клиент httpx создается при первом запросе - в event loop воркера (после fork).
+    """
+    def __init__(self, shop_id: str, secret_key: str, base_url: str, timeout: float, max_connections: int, max_retries: int):
+        self.shop_id = shop_id; self._secret_key = secret_key; self.base_url = base_url.rstrip("/")
+        self.timeout = timeout; self.max_connections = max_connections; self.max_retries = max_retries
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url, auth=(self.shop_id, self._secret_key),
+                timeout=httpx.Timeout(self.timeout, connect=min(5.0, self.timeout)),
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections, keepalive_expiry=60.0),
+                headers={"Content-Type": "application/json"} )
+        return self._client
+
+    async def close(self):
+        if self._client: await self._client.aclose(); self._client = None
+
+    async def _request(self, method: str, path: str, json: Optional[Dict[str, Any]] = None, idempotence_key: Optional[str] = None) -> Dict[str, Any]:
+        headers = {"Idempotence-Key": idempotence_key} if idempotence_key else None
+        for attempt in range(self.max_retries + 1):
+            last = attempt >= self.max_retries
+            try: response = await self._http().request(method, path, json=json, headers=headers)
+            except httpx.TransportError as e: # Таймаут/обрыв: запрос мог дойти, повтор безопасен благодаря ключу
+                if last: raise YooKassaError(0, type(e).__name__, str(e)) from e
+                logger.warning(f"[YooKassa] {method} {path}: {type(e).__name__}, retry {attempt + 1}."); await asyncio.sleep(0.5 * 2 ** attempt); continue
+            if response.status_code == 200: return response.json()
+            body = _json_or_empty(response)
+            if response.status_code in RETRY_STATUSES and not last:
+                delay = body.get("retry_after", 0) / 1000 if response.status_code == 202 else 0.5 * 2 ** attempt
+                logger.warning(f"[YooKassa] {method} {path}: HTTP {response.status_code}, retry {attempt + 1} in {delay:.1f}s."); await asyncio.sleep(delay); continue
+            error = ERRORS_BY_STATUS.get(response.status_code, InternalServerError if response.status_code >= 500 else YooKassaError)
+            raise error(response.status_code, body.get("code", ""), body.get("description", response.reason_phrase))
+
+    async def create_payment(self, payment_data: Dict[str, Any], idempotence_key: str) -> YooKassaPayment:
+        return YooKassaPayment.from_json(await self._request("POST", "/payments", json=payment_data, idempotence_key=idempotence_key))
+
+    async def get_payment(self, payment_id: str) -> YooKassaPayment:
+        return YooKassaPayment.from_json(await self._request("GET", f"/payments/{payment_id}"))
+
+def _json_or_empty(response: httpx.Response) -> Dict[str, Any]:
+    try: data = response.json()
+    except ValueError: return {}
+    return data if isinstance(data, dict) else {}
+
+
+yookassa_client: Optional[YooKassaClient] = None
+if settings.yookassa_shop_id and settings.yookassa_secret_key:
+    yookassa_client = YooKassaClient(
+        settings.yookassa_shop_id, settings.yookassa_secret_key.get_secret_value(), settings.yookassa_api_url,
+        timeout=settings.yookassa_timeout, max_connections=settings.yookassa_max_connections, max_retries=settings.yookassa_max_retries )
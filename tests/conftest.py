@@ -0,0 +1,65 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator
+
+import pytest
+
+# Настройки читаются при импорте core.config - окружение задаем до импорта модулей бота
+_db_dir = tempfile.mkdtemp(prefix="astro_bot_tests_")
+for _name, _value in {
+    "TELEGRAM_BOT_TOKEN": "123456:TEST", "WEBHOOK_DOMAIN": "example.com", "OPENAI_API_KEY": "test",
+    "DATABASE_URL": f"sqlite+aiosqlite:///{_db_dir}/test.db", "LOG_TO_DB": "false",
+}.items(): os.environ.setdefault(_name, _value)
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from database.database import Base, QueryStats, engine, query_stats
+from database.user_cache import user_cache
+
+
+@pytest.fixture
+async def db():
+    """ Чистая схема на каждый тест. Пул закрывается после теста: соединения aiosqlite привязаны к event loop теста. """
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all); await conn.run_sync(Base.metadata.create_all)
+    user_cache.clear()
+    yield engine
+    user_cache.clear()
+    await engine.dispose()
+
+
+class Budget:
+    """ Что загрузил код под measure(): запросы (QueryStats, как в DbSessionMiddleware), строки и байты результатов SELECT. """
+    def __init__(self): self.stats = QueryStats(); self.rows = 0; self.bytes = 0
+
+    @property
+    def queries(self) -> int: return self.stats.queries
+
+    def __repr__(self): return f"<Budget queries={self.queries} rows={self.rows} bytes={self.bytes}>"
+
+
+def _value_size(value) -> int:
+    mapper = getattr(type(value), "__mapper__", None)
+    if mapper is None: return len(repr(value)) if value is not None else 0
+    loaded = inspect(value).dict # Только загруженные атрибуты: незагруженные связи не считаются
+    return sum(_value_size(loaded[attr.key]) for attr in mapper.column_attrs if attr.key in loaded)
+
+
+@pytest.fixture
+def budget():
+    """ with budget() as b: ... - считает запросы, строки и объем (repr значений колонок) загруженных данных. """
+    @contextmanager
+    def measure() -> Iterator[Budget]:
+        result = Budget(); token = query_stats.set(result.stats)
+        def on_execute(orm_execute_state):
+            if not orm_execute_state.is_select: return None
+            frozen = orm_execute_state.invoke_statement().freeze()
+            for row in frozen().all():
+                result.rows += 1; result.bytes += sum(_value_size(value) for value in row)
+            return frozen()
+        event.listen(Session, "do_orm_execute", on_execute)
+        try: yield result
+        finally: event.remove(Session, "do_orm_execute", on_execute); query_stats.reset(token)
+    return measure
@@ -0,0 +1,50 @@
+"""
+Семплирование шумных логгеров (user-030): каждый приемник (консоль/файл через очередь и БД) получает
+примерно N * LOG_NOISY_SAMPLE_RATE записей aiogram/httpx, WARNING и выше - все.
+"""
+import logging
+
+import pytest
+
+from core.config import settings
+from database.database import async_session_factory
+from utils import logging_config
+
+N = 1000
+
+
+@pytest.fixture
+def sinks(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "log_file", tmp_path / "bot.log")
+    monkeypatch.setattr(settings, "log_to_db", True); monkeypatch.setattr(settings, "log_json", False)
+    monkeypatch.setattr(settings, "log_noisy_loggers", "aiogram,httpx"); monkeypatch.setattr(settings, "log_noisy_sample_rate", 0.1)
+    root = logging.getLogger(); saved = root.handlers[:], root.level
+    logging_config.setup_logging(async_session_factory)
+    yield tmp_path / "bot.log"
+    logging_config.stop_log_listener(); logging_config.db_log_handler = None
+    for handler in root.handlers[:]: root.removeHandler(handler)
+    for handler in saved[0]: root.addHandler(handler)
+    root.setLevel(saved[1])
+
+
+def sink_counts(log_file, marker: str):
+    logging_config.stop_log_listener() # Дописать очередь в файл
+    in_file = sum(marker in line for line in log_file.read_text(encoding="utf-8").splitlines())
+    rows = []
+    while batch := logging_config.db_log_handler._drain(): rows += batch # _drain отдает не больше batch_size
+    return in_file, sum(marker in row["message"] for row in rows)
+
+
+def test_each_sink_samples_noisy_records_at_rate(sinks):
+    noisy = logging.getLogger("aiogram.event")
+    for i in range(N): noisy.info("noise %d", i)
+    assert sink_counts(sinks, "noise") == (N * 0.1, N * 0.1) # Один счетчик на приемник: ровно каждая 10-я
+
+
+def test_warnings_and_other_loggers_are_not_sampled(sinks):
+    for i in range(N // 10): logging.getLogger("aiogram.event").warning("flood %d", i)
+    for i in range(N // 10): logging.getLogger("handlers.astrology").info("app %d", i)
+    assert sink_counts(sinks, "flood") == (N // 10, N // 10)
+    logging_config.setup_logging(async_session_factory) # sink_counts остановил слушателя
+    for i in range(N // 10): logging.getLogger("handlers.astrology").info("app2 %d", i)
+    assert sink_counts(sinks, "app2") == (N // 10, N // 10)
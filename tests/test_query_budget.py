@@ -0,0 +1,72 @@
+"""
+Бюджет запросов и загруженных данных на горячих путях (user-028): пользователь с длинной историей
+не должен тянуть за собой платежи и логи. Превышение бюджета - регрессия, а не повод поднять лимит.
+"""
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+from sqlalchemy import inspect
+
+from database import crud
+from database.database import async_session_factory
+from database.models import LogLevel
+from handlers.payment import cmd_balance
+from services import user_service
+
+USER_ID = 1001
+HISTORY = 50 # Платежей и логов у пользователя
+
+# Байты - сумма repr() значений загруженных колонок: строка пользователя ~120, проекция UserStatus ~15,
+# одна связь с историей дала бы десятки килобайт
+USER_ROW_BYTES = 512
+STATUS_BYTES = 128
+
+
+@pytest.fixture
+async def heavy_user(db):
+    async with async_session_factory() as session:
+        await crud.create_or_update_user(session, USER_ID, "user", "Test", None, "ru")
+        for i in range(HISTORY): await crud.create_payment(session, USER_ID, f"pay-{i:04d}", 9900, 3, "x" * 200)
+        for i in range(HISTORY): await crud.add_log_entry(session, LogLevel.INFO, "log " + "y" * 500, USER_ID, "test")
+    crud.user_cache.clear()
+    return USER_ID
+
+
+async def test_get_user_loads_only_user_row(heavy_user, budget):
+    async with async_session_factory() as session:
+        with budget() as b: user = await crud.get_user(session, heavy_user)
+    assert user is not None
+    assert (b.queries, b.rows) == (1, 1), b
+    assert b.bytes <= USER_ROW_BYTES, b
+    assert {"payments", "logs"} <= inspect(user).unloaded
+
+
+async def test_check_service_availability_budget(heavy_user, budget):
+    async with async_session_factory() as session:
+        with budget() as cold: can_use, *_ = await user_service.check_service_availability(session, heavy_user)
+        with budget() as warm: await user_service.check_service_availability(session, heavy_user)
+    assert can_use
+    assert (cold.queries, cold.rows) == (1, 1), cold
+    assert cold.bytes <= STATUS_BYTES, cold
+    assert warm.queries == 0, warm # Повтор - из user_cache
+
+
+async def test_balance_handler_budget(heavy_user, budget):
+    message = SimpleNamespace(from_user=SimpleNamespace(id=heavy_user), answer=AsyncMock())
+    async with async_session_factory() as session:
+        with budget() as cold: await cmd_balance(message, session)
+        with budget() as warm: await cmd_balance(message, session)
+    assert message.answer.await_count == 2
+    assert (cold.queries, cold.rows) == (1, 1), cold
+    assert cold.bytes <= STATUS_BYTES, cold
+    assert warm.queries == 0, warm
+
+
+async def test_budget_counts_loaded_history(heavy_user, budget):
+    """ Проверка самого измерения: загрузка истории должна быть видна в бюджете. """
+    async with async_session_factory() as session:
+        with budget() as b: payments = await crud.get_user_payments(session, heavy_user, limit=HISTORY)
+    assert len(payments) == HISTORY
+    assert (b.queries, b.rows) == (1, HISTORY), b
+    assert b.bytes > HISTORY * 200, b
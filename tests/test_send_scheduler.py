@@ -0,0 +1,194 @@
+"""
+SendScheduler (user-044) на виртуальном времени: time.monotonic и asyncio.sleep модуля подменены часами,
+драйвер часов будит спящих по очереди, когда цикл затих. Запросы к Telegram - фейковый make_request с журналом.
+"""
+import asyncio
+import heapq
+import itertools
+from types import SimpleNamespace
+from typing import List, Optional, Tuple
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import GetMe, SendMessage
+
+import utils.send_scheduler as send_scheduler_module
+from utils.http_metrics import counters
+from utils.send_scheduler import SendPriority, SendScheduler, bulk_sends
+
+BOT = SimpleNamespace(id=1)
+
+
+class FakeClock:
+    """ Виртуальное время: спящие ждут в куче, драйвер дает готовым задачам дойти до следующего ожидания и будит ближайшего. """
+    SETTLE = 20 # Итераций цикла перед сдвигом часов
+
+    def __init__(self):
+        self.now = 1000.0
+        self._sleepers: List[Tuple[float, int, asyncio.Future]] = []
+        self._seq = itertools.count(); self._driver: Optional[asyncio.Task] = None
+
+    def monotonic(self) -> float: return self.now
+
+    async def sleep(self, delay: float):
+        if delay <= 0: await asyncio.sleep(0); return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers, (self.now + delay, next(self._seq), future))
+        if self._driver is None: self._driver = asyncio.create_task(self._drive())
+        await future
+
+    async def _drive(self):
+        try:
+            while self._sleepers:
+                for _ in range(self.SETTLE): await asyncio.sleep(0)
+                wake_at, _, future = heapq.heappop(self._sleepers)
+                self.now = max(self.now, wake_at)
+                if not future.done(): future.set_result(None)
+        finally: self._driver = None
+
+
+class FakeAsyncio:
+    """ asyncio модуля send_scheduler: все как есть, кроме sleep. """
+    def __init__(self, clock: FakeClock): self.sleep = clock.sleep
+
+    def __getattr__(self, name): return getattr(asyncio, name)
+
+
+class FakeTelegram:
+    """ make_request: журнал (chat_id, text, время); flood - сколько первых вызовов ответить 429. """
+    def __init__(self, clock: FakeClock, flood: int = 0, retry_after: int = 5):
+        self.clock = clock; self.flood = flood; self.retry_after = retry_after
+        self.calls: List[Tuple[Optional[int], Optional[str], float]] = []
+
+    async def __call__(self, bot, method):
+        self.calls.append((getattr(method, "chat_id", None), getattr(method, "text", None), self.clock.now))
+        if self.flood: self.flood -= 1; raise TelegramRetryAfter(method, "Too Many Requests", self.retry_after)
+        return True
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    fake = FakeClock()
+    monkeypatch.setattr(send_scheduler_module, "time", SimpleNamespace(monotonic=fake.monotonic))
+    monkeypatch.setattr(send_scheduler_module, "asyncio", FakeAsyncio(fake))
+    return fake
+
+
+def make_scheduler(rate: float = 10.0, min_rate: float = 1.0, recovery: float = 10.0, chat_interval: float = 1.0,
+                   chat_burst: int = 100, max_retries: int = 3, flood_window: float = 10.0, sweep_interval: float = 60.0) -> SendScheduler:
+    return SendScheduler(rate=rate, min_rate=min_rate, recovery=recovery, chat_interval=chat_interval, chat_burst=chat_burst,
+                         max_retries=max_retries, flood_window=flood_window, sweep_interval=sweep_interval)
+
+
+async def send(scheduler: SendScheduler, telegram: FakeTelegram, chat_id: int, text: str, priority=SendPriority.INTERACTIVE):
+    if priority == SendPriority.BULK:
+        with bulk_sends(): return await scheduler(telegram, BOT, SendMessage(chat_id=chat_id, text=text))
+    return await scheduler(telegram, BOT, SendMessage(chat_id=chat_id, text=text))
+
+
+async def test_interactive_waiters_overtake_bulk(clock):
+    scheduler = make_scheduler(rate=1.0); telegram = FakeTelegram(clock)
+    await send(scheduler, telegram, 1, "first") # Единственный токен израсходован
+    tasks = [asyncio.create_task(send(scheduler, telegram, chat_id, text, priority)) for chat_id, text, priority in (
+        (2, "bulk-1", SendPriority.BULK), (3, "bulk-2", SendPriority.BULK),
+        (4, "reply-1", SendPriority.INTERACTIVE), (5, "reply-2", SendPriority.INTERACTIVE))]
+    await asyncio.gather(*tasks)
+    start = telegram.calls[0][2]
+    assert [(text, t - start) for _, text, t in telegram.calls[1:]] == [
+        ("reply-1", 1.0), ("reply-2", 2.0), ("bulk-1", 3.0), ("bulk-2", 4.0)] # Очередь по приоритету, внутри - FIFO, 1 токен/с
+    assert scheduler.depth == {SendPriority.INTERACTIVE: 0, SendPriority.BULK: 0}
+    assert {key[1] for key in scheduler.stats} == {SendPriority.INTERACTIVE, SendPriority.BULK}
+
+
+async def test_single_flood_pauses_only_that_chat(clock):
+    scheduler = make_scheduler(rate=10.0); telegram = FakeTelegram(clock, flood=1, retry_after=5)
+    floods = counters['telegram_flood_waits_total']; global_floods = counters['telegram_global_flood_waits_total']
+    start = clock.now
+    await asyncio.gather(send(scheduler, telegram, 1, "flooded"), send(scheduler, telegram, 2, "other"),
+                         send(scheduler, telegram, 3, "third"))
+    times = {text: t - start for _, text, t in telegram.calls[1:]}
+    assert times == {"flooded": 5.0, "other": 0.0, "third": 0.0} # Повтор - после retry_after, остальные чаты не ждут
+    assert scheduler.rate == 10.0 and scheduler._paused_until <= start # Общий темп и пауза не тронуты
+    assert counters['telegram_flood_waits_total'] == floods + 1 and counters['telegram_global_flood_waits_total'] == global_floods
+
+
+async def test_flooded_chat_queue_waits_for_pause(clock):
+    scheduler = make_scheduler(rate=10.0); telegram = FakeTelegram(clock, flood=1, retry_after=5)
+    start = clock.now
+    await send(scheduler, telegram, 1, "flooded")
+    await asyncio.gather(send(scheduler, telegram, 1, "next"), send(scheduler, telegram, 2, "other"))
+    times = {text: t - start for _, text, t in telegram.calls[1:]}
+    assert times["other"] == 5.0 # Отправлен сразу после ожидания первого запроса (последовательный вызов)
+    assert times["next"] == 6.0 # Тот же чат: за повтором, через chat_interval
+
+
+async def test_cross_chat_floods_pause_all_and_halve_rate(clock):
+    scheduler = make_scheduler(rate=10.0, min_rate=1.0, recovery=10.0, flood_window=10.0)
+    telegram = FakeTelegram(clock, flood=2, retry_after=5)
+    global_floods = counters['telegram_global_flood_waits_total']
+    start = clock.now
+    await asyncio.gather(send(scheduler, telegram, 1, "a"), send(scheduler, telegram, 2, "b"))
+    await send(scheduler, telegram, 3, "c")
+    retries = {text: t - start for _, text, t in telegram.calls[2:]}
+    assert retries == {"a": 5.0, "b": 5.0, "c": 5.0} # Второй 429 (другой чат) - пауза для всех
+    assert scheduler.rate == 5.0 and counters['telegram_global_flood_waits_total'] == global_floods + 1
+    clock.now += 2.5; scheduler._refill(clock.now)
+    assert scheduler.rate == pytest.approx(7.5) # Линейно: max_rate / recovery в секунду
+    clock.now += 10; scheduler._refill(clock.now)
+    assert scheduler.rate == 10.0
+
+
+async def test_flood_outside_window_stays_per_chat(clock):
+    scheduler = make_scheduler(rate=10.0, flood_window=10.0); telegram = FakeTelegram(clock, flood=1, retry_after=1)
+    await send(scheduler, telegram, 1, "a")
+    clock.now += 20; telegram.flood = 1
+    await send(scheduler, telegram, 2, "b")
+    assert scheduler.rate == 10.0
+
+
+async def test_flood_retries_exhausted(clock):
+    scheduler = make_scheduler(rate=10.0, min_rate=3.0, max_retries=2); telegram = FakeTelegram(clock, flood=10, retry_after=1)
+    with pytest.raises(TelegramRetryAfter): await send(scheduler, telegram, 1, "hello")
+    assert len(telegram.calls) == 3 # Первая попытка + max_retries
+    assert scheduler.rate == 3.0 # Первый 429 - только чат; повторные: 10 -> 5 -> не ниже min_rate
+    assert scheduler.depth[SendPriority.INTERACTIVE] == 0
+
+
+async def test_cancelled_waiter_is_skipped(clock):
+    scheduler = make_scheduler(rate=1.0); telegram = FakeTelegram(clock)
+    await send(scheduler, telegram, 1, "first"); start = clock.now
+    cancelled = asyncio.create_task(send(scheduler, telegram, 2, "cancelled"))
+    waiting = asyncio.create_task(send(scheduler, telegram, 3, "waiting"))
+    while len(scheduler._waiters) < 2: await asyncio.sleep(0)
+    cancelled.cancel()
+    await waiting
+    with pytest.raises(asyncio.CancelledError): await cancelled
+    assert [(text, t - start) for _, text, t in telegram.calls[1:]] == [("waiting", 1.0)] # Токен не потрачен на отмененного
+    assert scheduler._tokens < 1 and not scheduler._waiters
+    assert scheduler.depth[SendPriority.INTERACTIVE] == 0
+
+
+async def test_requests_without_chat_bypass_limits(clock):
+    scheduler = make_scheduler(rate=1.0); telegram = FakeTelegram(clock)
+    await send(scheduler, telegram, 1, "first"); start = clock.now
+    for _ in range(3): await scheduler(telegram, BOT, GetMe())
+    assert [t - start for chat_id, _, t in telegram.calls[1:]] == [0.0, 0.0, 0.0]
+    assert len(scheduler.stats) == 1 # В статистику - только ограничиваемые запросы
+
+
+async def test_chat_bucket_spaces_messages(clock):
+    scheduler = make_scheduler(rate=100.0, chat_interval=1.0, chat_burst=2); telegram = FakeTelegram(clock)
+    start = clock.now
+    await asyncio.gather(*(send(scheduler, telegram, 7, f"m{i}") for i in range(4)))
+    assert sorted(t - start for _, _, t in telegram.calls) == [0.0, 0.0, 1.0, 2.0] # burst подряд, дальше раз в interval
+
+
+async def test_sweep_drops_idle_chat_buckets(clock):
+    scheduler = make_scheduler(chat_interval=1.0, chat_burst=2, sweep_interval=10.0); start = clock.now
+    assert scheduler._reserve_chat(1, start) == 0.0 and scheduler._reserve_chat(2, start) == 0.0
+    delays = [scheduler._reserve_chat(3, start + 9) for _ in range(4)]
+    assert delays == [0.0, 0.0, 1.0, 2.0] # Очередь в чат 3: токены ушли в минус
+    scheduler._reserve_chat(4, start + 10) # Срок очистки наступил
+    assert set(scheduler._chats) == {3, 4} # 1 и 2 полны и простаивают; у 3 еще очередь
+    scheduler._reserve_chat(5, start + 20)
+    assert set(scheduler._chats) == {5}
@@ -0,0 +1,109 @@
+"""
+Провал платной задачи очереди (user-035): ошибка расчета или текст-ошибка OpenAI вместо результата -
+задача FAILED, кредит возвращается, пользователь получает ровно одно сообщение об ошибке (notify_job_failed).
+Статус заявки - командой /job_<номер>, только своей.
+"""
+import re
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import handlers.astrology as astrology
+import handlers.common # noqa: F401 - регистрирует notify_job_failed
+import handlers.other_services # noqa: F401 - регистрирует задачи текстовых услуг
+from core.config import SERVICE_DREAM, SERVICE_FORECAST, settings
+from database import crud
+from database.database import async_session_factory
+from database.models import JobStatus, ServiceJob
+from services import user_service
+from services.job_queue import JOB_STATUS_COMMAND, job_queue
+
+USER_ID = 2001
+CREDITS = 5
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    fake = MagicMock()
+    for method in ("send_message", "send_photo", "send_chat_action", "edit_message_text"): setattr(fake, method, AsyncMock())
+    monkeypatch.setattr(job_queue, "_bot", fake)
+    return fake
+
+
+@pytest.fixture
+async def paid_user(db):
+    async with async_session_factory() as session:
+        await crud.create_or_update_user(session, USER_ID, "user", "Test", None, "ru")
+        await crud.update_user_credits(session, USER_ID, CREDITS)
+    return USER_ID
+
+
+async def run_paid_job(service_id: str, payload) -> ServiceJob:
+    """ Как хендлер: списание, постановка в очередь; затем выполнение воркером. """
+    async with async_session_factory() as session:
+        assert await user_service.use_service_credit(session, USER_ID, service_id)
+        job_id = await job_queue.enqueue(session, USER_ID, USER_ID, service_id, payload)
+        [job] = await crud.claim_service_jobs(session, 1)
+    assert job.id == job_id
+    await job_queue._run(job)
+    async with async_session_factory() as session: return await session.get(ServiceJob, job_id)
+
+
+def sent_texts(bot) -> list:
+    return [call.args[1] for call in bot.send_message.await_args_list]
+
+
+async def assert_failed_once_and_refunded(bot, job: ServiceJob):
+    assert job.status == JobStatus.FAILED
+    [text] = sent_texts(bot) # Одно сообщение - от notify_job_failed
+    assert f"заявка №{job.id}" in text and "Кредит возвращен" in text
+    async with async_session_factory() as session: assert await crud.get_user_credits(session, USER_ID) == CREDITS
+
+
+async def test_calculation_error_sends_single_message(paid_user, bot, monkeypatch):
+    monkeypatch.setattr(astrology, "get_kr_instance_from_data", AsyncMock(return_value=None))
+    job = await run_paid_job(SERVICE_FORECAST, {"user_name": "Test"})
+    await assert_failed_once_and_refunded(bot, job)
+
+
+async def test_openai_error_text_fails_astro_job(paid_user, bot, monkeypatch):
+    monkeypatch.setattr(astrology, "get_kr_instance_from_data", AsyncMock(return_value=object()))
+    monkeypatch.setattr(astrology.astrology_service, "get_yearly_forecast_interpretation",
+                        AsyncMock(return_value="Ошибка: Превышено время ожидания ИИ (60 сек)."))
+    job = await run_paid_job(SERVICE_FORECAST, {"user_name": "Test"})
+    await assert_failed_once_and_refunded(bot, job)
+
+
+async def test_openai_error_text_fails_text_service_job(paid_user, bot, monkeypatch):
+    monkeypatch.setitem(handlers.other_services.TEXT_SERVICES, SERVICE_DREAM, AsyncMock(return_value="Ошибка: Слишком много запросов к ИИ. Подождите."))
+    job = await run_paid_job(SERVICE_DREAM, {"text": "сон", "message_id": 1})
+    await assert_failed_once_and_refunded(bot, job)
+    bot.edit_message_text.assert_not_awaited() # Текст ошибки не выдается за результат
+
+
+async def test_successful_job_keeps_credit(paid_user, bot, monkeypatch):
+    monkeypatch.setattr(astrology, "get_kr_instance_from_data", AsyncMock(return_value=object()))
+    monkeypatch.setattr(astrology.astrology_service, "get_yearly_forecast_interpretation", AsyncMock(return_value="Прогноз на год"))
+    job = await run_paid_job(SERVICE_FORECAST, {"user_name": "Test"})
+    assert job.status == JobStatus.DONE
+    assert sent_texts(bot)[0] == "Прогноз на год"
+    async with async_session_factory() as session: assert await crud.get_user_credits(session, USER_ID) == CREDITS - settings.service_cost
+
+
+async def job_status_reply(session, user_id: int, text: str) -> str:
+    message = SimpleNamespace(from_user=SimpleNamespace(id=user_id), text=text, answer=AsyncMock())
+    await handlers.common.cmd_job_status(message, session, re.match(rf"^/{JOB_STATUS_COMMAND}(\d+)(?:@\w+)?$", text))
+    return message.answer.await_args.args[0]
+
+
+async def test_job_status_command_shows_own_jobs_only(paid_user, bot, monkeypatch):
+    monkeypatch.setattr(astrology, "get_kr_instance_from_data", AsyncMock(return_value=None))
+    failed = await run_paid_job(SERVICE_FORECAST, {"user_name": "Test"})
+    async with async_session_factory() as session:
+        queued_id = await job_queue.enqueue(session, USER_ID, USER_ID, SERVICE_DREAM, {"text": "сон", "message_id": 1})
+        assert "в очереди" in await job_status_reply(session, USER_ID, f"/job_{queued_id}")
+        reply = await job_status_reply(session, USER_ID, f"/job_{failed.id}@astro_bot")
+        assert f"№{failed.id}" in reply and "не выполнена" in reply and "Кредит возвращен" in reply
+        assert await job_status_reply(session, USER_ID + 1, f"/job_{queued_id}") == "Заявка не найдена." # Чужая
+        assert await job_status_reply(session, USER_ID, "/job_999999") == "Заявка не найдена."
@@ -0,0 +1,121 @@
+"""
+UserStatusCache (user-042): put() с версией, снятой до сброса (invalidate/clear), не должен вернуть в кэш
+устаревшую запись. Плюс TTL и LRU; последний тест - та же гонка через crud.get_user_status и реальное списание.
+"""
+from types import SimpleNamespace
+
+import pytest
+
+import database.user_cache as user_cache_module
+from database import crud
+from database.database import async_session_factory
+from database.models import CreditReason
+from database.user_cache import UserStatusCache, user_cache
+
+
+@pytest.fixture
+def clock(monkeypatch) -> SimpleNamespace:
+    fake = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(user_cache_module, "time", SimpleNamespace(monotonic=lambda: fake.now))
+    return fake
+
+
+def test_put_after_invalidate_with_older_version_is_ignored():
+    cache = UserStatusCache(ttl=60, max_size=10)
+    version = cache.version # Чтение из БД началось
+    cache._invalidate_local(1) # Commit другой задачи
+    cache.put(1, "stale", version) # Старое чтение закончилось
+    assert cache.get(1) is None
+    cache.put(1, "fresh", cache.version) # Чтение после сброса
+    assert cache.get(1) == "fresh"
+
+
+def test_invalidate_of_other_user_does_not_block_put():
+    cache = UserStatusCache(ttl=60, max_size=10)
+    version = cache.version
+    cache._invalidate_local(2)
+    cache.put(1, "status", version)
+    assert cache.get(1) == "status"
+
+
+def test_interleaved_reads_and_invalidations():
+    cache = UserStatusCache(ttl=60, max_size=10)
+    first_read = cache.version
+    cache._invalidate_local(1)
+    second_read = cache.version
+    cache._invalidate_local(1)
+    third_read = cache.version
+    cache.put(1, "second", second_read) # Началось между сбросами - старше последнего
+    assert cache.get(1) is None
+    cache.put(1, "third", third_read)
+    cache.put(1, "first", first_read) # Самое старое чтение закончилось последним
+    assert cache.get(1) == "third"
+
+
+def test_invalidate_drops_cached_entry():
+    cache = UserStatusCache(ttl=60, max_size=10)
+    cache.put(1, "status", cache.version)
+    cache._invalidate_local(1)
+    assert cache.get(1) is None
+
+
+def test_clear_sets_floor_for_reads_started_before():
+    cache = UserStatusCache(ttl=60, max_size=10)
+    version = cache.version
+    cache.clear() # Переподписка на сбросы: пропущенные сообщения неизвестны
+    cache.put(1, "stale", version) # Пользователь 1 не в _invalidated, защищает _floor
+    assert cache.get(1) is None and not cache._invalidated
+    cache.put(1, "fresh", cache.version)
+    assert cache.get(1) == "fresh"
+
+
+def test_invalidated_versions_are_bounded_without_losing_guard():
+    cache = UserStatusCache(ttl=60, max_size=3)
+    version = cache.version
+    for user_id in range(1, 6): cache._invalidate_local(user_id)
+    assert list(cache._invalidated) == [3, 4, 5]
+    cache.put(5, "stale", version)
+    assert cache.get(5) is None
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = UserStatusCache(ttl=10, max_size=10)
+    cache.put(1, "status", cache.version)
+    clock.now += 9.9
+    assert cache.get(1) == "status"
+    clock.now += 0.2
+    assert cache.get(1) is None
+
+
+def test_lru_evicts_least_recently_used():
+    cache = UserStatusCache(ttl=60, max_size=2)
+    cache.put(1, "one", cache.version); cache.put(2, "two", cache.version)
+    assert cache.get(1) == "one" # 1 стал самым свежим
+    cache.put(3, "three", cache.version)
+    assert cache.get(2) is None and cache.get(1) == "one" and cache.get(3) == "three"
+
+
+def test_disabled_cache_stores_nothing():
+    cache = UserStatusCache(ttl=0, max_size=10)
+    cache.put(1, "status", cache.version)
+    assert cache.get(1) is None
+
+
+async def test_get_user_status_racing_credit_update(db):
+    async with async_session_factory() as session:
+        await crud.create_or_update_user(session, 1, "user", "Test", None, "ru")
+        await crud.update_user_credits(session, 1, 10, CreditReason.ADMIN)
+    user_cache.clear()
+    async with async_session_factory() as reader, async_session_factory() as writer:
+        execute = reader.execute
+        async def execute_then_update(*args, **kwargs):
+            result = await execute(*args, **kwargs) # Строка прочитана с 10 кредитами...
+            assert await crud.update_user_credits(writer, 1, -3, CreditReason.SERVICE) == 7 # ...и списание успело до put()
+            return result
+        reader.execute = execute_then_update
+        stale = await crud.get_user_status(reader, 1)
+        reader.execute = execute
+        assert stale.credits == 10
+        assert user_cache.get(1) is None # Устаревшее чтение не попало в кэш
+        assert (await crud.get_user_status(reader, 1)).credits == 7
+        assert user_cache.get(1).credits == 7
@@ -0,0 +1,117 @@
+"""
+YooKassaClient._request против мока ЮKassa (user-047): повторы 202/429/5xx и транспортных ошибок
+с тем же Idempotence-Key, соответствие статусов исключениям, переиспользование соединений пула.
+"""
+import base64
+from types import SimpleNamespace
+from typing import List
+
+import pytest
+
+import services.yookassa_client as yookassa_module
+from services.yookassa_client import (
+    BadRequestError, ForbiddenError, InternalServerError, NotFoundError, TooManyRequestsError, UnauthorizedError,
+    YooKassaClient, YooKassaError
+)
+from tests.yookassa_mock import MockYooKassa, Scripted
+
+PAYMENT_DATA = {"amount": {"value": "99.00", "currency": "RUB"}, "confirmation": {"type": "redirect", "return_url": "https://t.me/"},
+                "capture": True, "metadata": {"user_id": "1"}}
+OK_PAYMENT = {"id": "p-1", "status": "pending", "paid": False, "amount": {"value": "99.00", "currency": "RUB"}}
+
+
+@pytest.fixture
+async def mock():
+    server = MockYooKassa(); await server.start()
+    yield server
+    await server.close()
+
+
+@pytest.fixture
+def delays(monkeypatch) -> List[float]:
+    """ Паузы между повторами записываются, а не выдерживаются. """
+    recorded: List[float] = []
+    async def fake_sleep(delay): recorded.append(delay)
+    monkeypatch.setattr(yookassa_module, "asyncio", SimpleNamespace(sleep=fake_sleep))
+    return recorded
+
+
+@pytest.fixture
+async def client(mock):
+    yookassa = YooKassaClient("shop-1", "secret", mock.base_url, timeout=2.0, max_connections=4, max_retries=2)
+    yield yookassa
+    await yookassa.close()
+
+
+async def test_create_payment_sends_key_and_auth(mock, client):
+    payment = await client.create_payment(PAYMENT_DATA, "key-1")
+    assert payment.status == "pending" and payment.amount_value == "99.00" and payment.metadata == {"user_id": "1"}
+    assert payment.confirmation_url.endswith(payment.id)
+    [request] = mock.requests
+    assert request.idempotence_key == "key-1" and request.body == PAYMENT_DATA
+    assert request.authorization == "Basic " + base64.b64encode(b"shop-1:secret").decode()
+    assert (await client.get_payment(payment.id)).id == payment.id
+
+
+async def test_202_waits_retry_after_and_repeats_with_same_key(mock, client, delays):
+    mock.script(Scripted(202, {"type": "processing", "retry_after": 300}))
+    payment = await client.create_payment(PAYMENT_DATA, "key-202")
+    assert delays == [0.3] # retry_after - в миллисекундах
+    assert [r.idempotence_key for r in mock.requests] == ["key-202", "key-202"]
+    assert len(mock.payments) == 1 and payment.id in mock.payments
+
+
+async def test_429_and_5xx_back_off_with_same_key(mock, client, delays):
+    mock.script(Scripted(429, {"type": "error", "code": "too_many_requests"}), Scripted(503, None))
+    payment = await client.create_payment(PAYMENT_DATA, "key-retry")
+    assert delays == [0.5, 1.0] # Экспоненциальная пауза
+    assert [r.idempotence_key for r in mock.requests] == ["key-retry"] * 3
+    assert len(mock.payments) == 1 and payment.id in mock.payments
+
+
+async def test_retries_exhausted_raise_last_error(mock, client, delays):
+    mock.script(*[Scripted(500, {"type": "error", "code": "internal_server_error", "description": "boom"})] * 3)
+    with pytest.raises(InternalServerError) as error:
+        await client.create_payment(PAYMENT_DATA, "key-500")
+    assert (error.value.status, error.value.code, error.value.description) == (500, "internal_server_error", "boom")
+    assert len(mock.requests) == 3 and delays == [0.5, 1.0]
+
+
+async def test_transport_error_is_retried_with_same_key(mock, delays):
+    client = YooKassaClient("shop-1", "secret", mock.base_url, timeout=0.2, max_connections=4, max_retries=1)
+    try:
+        mock.script(Scripted(200, OK_PAYMENT, delay=0.5)) # Ответ позже таймаута клиента
+        payment = await client.create_payment(PAYMENT_DATA, "key-timeout")
+        mock.script(*[Scripted(200, OK_PAYMENT, delay=0.5)] * 2)
+        with pytest.raises(YooKassaError) as error: await client.create_payment(PAYMENT_DATA, "key-lost")
+    finally: await client.close()
+    assert payment.id in mock.payments # Повтор после таймаута создал платеж
+    assert [r.idempotence_key for r in mock.requests] == ["key-timeout"] * 2 + ["key-lost"] * 2
+    assert error.value.status == 0 and error.value.code == "ReadTimeout"
+    assert delays == [0.5, 0.5]
+
+
+@pytest.mark.parametrize("status, body, expected", [
+    (400, {"type": "error", "code": "invalid_request", "description": "bad amount"}, BadRequestError),
+    (401, {"type": "error", "code": "invalid_credentials"}, UnauthorizedError),
+    (403, {"type": "error", "code": "forbidden"}, ForbiddenError),
+    (404, {"type": "error", "code": "not_found"}, NotFoundError),
+    (429, {"type": "error", "code": "too_many_requests"}, TooManyRequestsError),
+    (500, {"type": "error", "code": "internal_server_error"}, InternalServerError),
+    (502, None, InternalServerError), # Не JSON (ответ прокси)
+    (418, {"type": "error", "code": "teapot"}, YooKassaError),
+])
+async def test_status_maps_to_exception(mock, status, body, expected):
+    client = YooKassaClient("shop-1", "secret", mock.base_url, timeout=2.0, max_connections=4, max_retries=0)
+    mock.script(Scripted(status, body))
+    try:
+        with pytest.raises(YooKassaError) as error: await client.get_payment("p-1")
+    finally: await client.close()
+    assert type(error.value) is expected and error.value.status == status
+    assert error.value.code == (body or {}).get("code", "")
+    if body is None: assert error.value.description # reason phrase
+
+
+async def test_requests_reuse_pooled_connection(mock, client):
+    for i in range(20): await client.create_payment(PAYMENT_DATA, f"key-{i}")
+    assert len(mock.requests) == 20 and len(mock.connections) == 1
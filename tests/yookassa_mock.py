@@ -0,0 +1,80 @@
+"""
+Мок API ЮKassa v3 на aiohttp: тесты YooKassaClient и бенчмарк bench/yookassa_latency.py.
+Платежи хранятся в памяти (повтор POST с тем же Idempotence-Key возвращает тот же платеж, как в ЮKassa);
+script() задает ответы следующих запросов по очереди - для проверки повторов и ошибок.
+"""
+import asyncio
+import itertools
+import socket
+from collections import deque
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from aiohttp import web
+
+
+class RecordedRequest(NamedTuple):
+    method: str; path: str; idempotence_key: Optional[str]; authorization: Optional[str]; body: Optional[Dict[str, Any]]
+
+
+class Scripted(NamedTuple):
+    status: int; body: Any = None; delay: float = 0.0 # body=None - ответ без JSON (text/plain)
+
+
+class MockYooKassa:
+    def __init__(self):
+        self.requests: List[RecordedRequest] = []
+        self.connections: Set[Tuple[str, int]] = set() # peername клиента - сколько соединений открыл пул
+        self.payments: Dict[str, Dict[str, Any]] = {}
+        self._by_key: Dict[str, str] = {}
+        self._script: Deque[Scripted] = deque()
+        self._ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url = ""
+
+    def script(self, *responses: Scripted):
+        self._script.extend(responses)
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post("/v3/payments", self._create)
+        app.router.add_get("/v3/payments/{payment_id}", self._get)
+        self._runner = web.AppRunner(app, access_log=None); await self._runner.setup()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM); sock.bind(("127.0.0.1", 0)) # Свободный порт
+        await web.SockSite(self._runner, sock).start()
+        port = sock.getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}/v3"
+        return self.base_url
+
+    async def close(self):
+        if self._runner: await self._runner.cleanup(); self._runner = None
+
+    async def _record(self, request: web.Request) -> Optional[web.Response]:
+        self.connections.add(request.transport.get_extra_info("peername"))
+        body = await request.json() if request.can_read_body else None
+        self.requests.append(RecordedRequest(request.method, request.path, request.headers.get("Idempotence-Key"),
+                                             request.headers.get("Authorization"), body))
+        if not self._script: return None
+        scripted = self._script.popleft()
+        if scripted.delay: await asyncio.sleep(scripted.delay)
+        if scripted.body is None: return web.Response(status=scripted.status, text="upstream error")
+        return web.json_response(scripted.body, status=scripted.status)
+
+    async def _create(self, request: web.Request) -> web.Response:
+        scripted = await self._record(request)
+        if scripted is not None: return scripted
+        key = request.headers.get("Idempotence-Key"); body = self.requests[-1].body
+        if key in self._by_key: return web.json_response(self.payments[self._by_key[key]])
+        payment_id = f"mock-{next(self._ids):08d}"
+        self.payments[payment_id] = {
+            "id": payment_id, "status": "pending", "paid": False, "amount": body["amount"],
+            "confirmation": {"type": "redirect", "confirmation_url": f"https://yoomoney.example/checkout/{payment_id}"},
+            "metadata": body.get("metadata", {}) }
+        self._by_key[key] = payment_id
+        return web.json_response(self.payments[payment_id])
+
+    async def _get(self, request: web.Request) -> web.Response:
+        scripted = await self._record(request)
+        if scripted is not None: return scripted
+        payment = self.payments.get(request.match_info["payment_id"])
+        if payment is None: return web.json_response({"type": "error", "code": "not_found", "description": "Payment not found"}, status=404)
+        return web.json_response(payment)
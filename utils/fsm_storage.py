@@ -0,0 +1,105 @@
+import json
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from sqlalchemy import select, delete, case
+
+from core.config import settings
+from database.database import insert_for
+
+logger = logging.getLogger(__name__)
+
+# Компактная сериализация: без пробелов, кириллица как есть
+json_dumps = partial(json.dumps, separators=(',', ':'), ensure_ascii=False)
+
+
+class SQLStorage(BaseStorage):
+    """
+    FSM storage на основной БД: одна строка (state + data) на ключ, запись - одним UPSERT.
+    update_data читает и пишет в одной транзакции. Просроченные (брошенные) сценарии не читаются
+    и удаляются не чаще раза в purge_interval секунд.
+    """
+    def __init__(self, session_factory, ttl: int, purge_interval: float = 600.0):
+        from database.models import FsmRecord # Импорт здесь, чтобы избежать циклов
+        self.model = FsmRecord
+        self.session_factory = session_factory
+        self.ttl = timedelta(seconds=ttl)
+        self.purge_interval = purge_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True, with_business_connection_id=True)
+        self._next_purge = 0.0
+
+    def _key(self, key: StorageKey) -> str: return self.key_builder.build(key)
+
+    async def _read(self, session, key: StorageKey) -> Optional[Any]:
+        result = await session.execute(
+            select(self.model.state, self.model.data)
+            .where(self.model.key == self._key(key), self.model.expires_at > datetime.now(timezone.utc)) )
+        return result.first()
+
+    async def _write(self, session, key: StorageKey, **values: Any):
+        now = datetime.now(timezone.utc); values['expires_at'] = now + self.ttl
+        insert = insert_for(session.bind.dialect.name)
+        stmt = insert(self.model).values(key=self._key(key), **values)
+        # Вторую колонку (state/data) просроченной строки не "воскрешаем"
+        set_ = {col: case((self.model.expires_at <= now, None), else_=getattr(self.model, col))
+                for col in ('state', 'data') if col not in values}
+        set_.update(values)
+        await session.execute(stmt.on_conflict_do_update(index_elements=[self.model.key], set_=set_))
+        if time.monotonic() >= self._next_purge:
+            self._next_purge = time.monotonic() + self.purge_interval
+            await session.execute(delete(self.model).where(self.model.expires_at <= now))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        async with self.session_factory() as session:
+            await self._write(session, key, state=state.state if isinstance(state, State) else state)
+            await session.commit()
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        async with self.session_factory() as session: row = await self._read(session, key)
+        return row.state if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        async with self.session_factory() as session:
+            await self._write(session, key, data=json_dumps(data) if data else None)
+            await session.commit()
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        async with self.session_factory() as session: row = await self._read(session, key)
+        return json.loads(row.data) if row and row.data else {}
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        async with self.session_factory() as session:
+            row = await self._read(session, key)
+            current = json.loads(row.data) if row and row.data else {}
+            current.update(data)
+            await self._write(session, key, data=json_dumps(current) if current else None)
+            await session.commit()
+        return current.copy()
+
+    async def close(self) -> None: pass # Движок закрывается в on_shutdown
+
+
+def create_fsm_storage() -> BaseStorage:
+    """
+    memory - в процессе (один воркер); redis - aiogram RedisStorage (REDIS_URL, пакет redis);
+    sql - таблица fsm_storage в основной БД. Для redis и sql состояние переживает рестарт и видно всем воркерам.
+    """
+    backend = settings.fsm_storage
+    if backend == 'redis':
+        try: from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError: raise RuntimeError("FSM_STORAGE=redis требует пакет 'redis'")
+        if not settings.redis_url: raise RuntimeError("FSM_STORAGE=redis требует REDIS_URL")
+        return RedisStorage.from_url(
+            settings.redis_url, state_ttl=settings.fsm_ttl_seconds, data_ttl=settings.fsm_ttl_seconds,
+            key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True, with_business_connection_id=True), json_dumps=json_dumps )
+    if backend == 'sql':
+        from database.database import async_session_factory
+        return SQLStorage(async_session_factory, ttl=settings.fsm_ttl_seconds)
+    if backend != 'memory': logger.warning(f"Unknown FSM_STORAGE '{backend}', using memory.")
+    return MemoryStorage()
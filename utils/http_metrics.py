@@ -0,0 +1,78 @@
+import os
+import time
+import logging
+from bisect import bisect_left
+from collections import Counter
+from typing import Callable, Dict, List, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограммы задержек (сек)
+LATENCY_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class RouteLatency:
+    """ Счетчики задержки по маршрутам в рамках процесса: count, sum, max и гистограмма. """
+    __slots__ = ('count', 'total', 'max', 'buckets')
+    def __init__(self):
+        self.count = 0; self.total = 0.0; self.max = 0.0
+        self.buckets: List[int] = [0] * (len(LATENCY_BUCKETS) + 1) # Последний - +Inf
+
+    def observe(self, seconds: float):
+        self.count += 1; self.total += seconds
+        if seconds > self.max: self.max = seconds
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+route_stats: Dict[Tuple[str, str, int], RouteLatency] = {} # (method, route, status) -> stats
+counters: Counter = Counter() # Прочие счетчики процесса (name -> value), отдаются в metrics_handler
+collectors: List[Callable[[str], List[str]]] = [] # Доп. метрики модулей: (метка pid) -> строки Prometheus
+
+
+def _route_name(request: web.Request) -> str:
+    """ Шаблон маршрута, а не фактический путь (секрет в пути Telegram не попадает в метрики). """
+    route = request.match_info.route
+    if route.name: return route.name
+    return route.resource.canonical if route.resource else 'unmatched'
+
+def latency_middleware(slow_threshold: float):
+    @web.middleware
+    async def middleware(request: web.Request, handler):
+        started = time.perf_counter(); status = 500
+        try:
+            response = await handler(request); status = response.status
+            return response
+        except web.HTTPException as e: status = e.status; raise
+        finally:
+            elapsed = time.perf_counter() - started; route = _route_name(request)
+            key = (request.method, route, status)
+            stats = route_stats.get(key) or route_stats.setdefault(key, RouteLatency())
+            stats.observe(elapsed)
+            if elapsed >= slow_threshold: logger.warning(f"Slow request {request.method} {route} -> {status}: {elapsed:.3f}s")
+    return middleware
+
+def histogram_lines(name: str, labels: str, stats: RouteLatency) -> List[str]:
+    """ Гистограмма (накопительные бакеты), sum и count в формате Prometheus. """
+    lines = []; cumulative = 0
+    for bound, n in zip(LATENCY_BUCKETS + (float('inf'),), stats.buckets):
+        cumulative += n; le = '+Inf' if bound == float('inf') else bound
+        lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+    lines.append(f'{name}_sum{{{labels}}} {stats.total:.6f}')
+    lines.append(f'{name}_count{{{labels}}} {stats.count}')
+    return lines
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """ Метрики в текстовом формате Prometheus. Каждый воркер отдает свои (метка pid). """
+    pid = os.getpid(); lines = [
+        "# TYPE http_request_duration_seconds histogram",
+        "# TYPE http_request_duration_max_seconds gauge", ]
+    for (method, route, status), s in sorted(route_stats.items()):
+        labels = f'pid="{pid}",method="{method}",route="{route}",status="{status}"'
+        lines += histogram_lines("http_request_duration_seconds", labels, s)
+        lines.append(f'http_request_duration_max_seconds{{{labels}}} {s.max:.6f}')
+    for name, value in sorted(counters.items()):
+        lines.append(f"# TYPE {name} counter"); lines.append(f'{name}{{pid="{pid}"}} {value}')
+    for collect in collectors:
+        try: lines += collect(f'pid="{pid}"')
+        except Exception as e: logger.warning(f"Metrics collector {collect!r} failed: {e}")
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
@@ -1,8 +1,16 @@
+import atexit
+import copy
+import itertools
+import json
 import logging
 import sys
+import queue
 import asyncio # Добавлен импорт
-from logging.handlers import RotatingFileHandler
-from typing import TYPE_CHECKING, Optional, Any
+import threading
+from contextvars import ContextVar, Token
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from typing import TYPE_CHECKING, Optional, Any, Dict, List, NamedTuple
 
 # Используем Pydantic settings
 from core.config import settings
@@ -11,85 +19,253 @@ if TYPE_CHECKING:
     from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
     from database.models import LogLevel, Log
 
+# --- Контекст запроса ---
+class LogContext(NamedTuple):
+    user_id: Optional[int] = None
+    handler_name: Optional[str] = None
+    update_id: Optional[int] = None
+    trace_id: Optional[str] = None
+
+_log_context: ContextVar[LogContext] = ContextVar('log_context', default=LogContext())
+
+def bind_log_context(**fields: Any) -> Token:
+    """ Дополняет контекст текущей задачи (user_id, handler_name, update_id, trace_id). Вернуть токен в reset_log_context. """
+    return _log_context.set(_log_context.get()._replace(**fields))
+
+def reset_log_context(token: Token): _log_context.reset(token)
+
+def get_log_context() -> LogContext: return _log_context.get()
+
+class ContextFilter(logging.Filter):
+    """ Переносит контекст запроса в LogRecord. Значения из extra=... имеют приоритет. Вешается на обработчики. """
+    def filter(self, record: logging.LogRecord) -> bool:
+        ctx = _log_context.get()
+        if not hasattr(record, 'user_id'): record.user_id = ctx.user_id if ctx.user_id is not None else 'N/A'
+        if not hasattr(record, 'handler_name'): record.handler_name = ctx.handler_name or 'N/A'
+        if not hasattr(record, 'update_id'): record.update_id = ctx.update_id
+        if not hasattr(record, 'trace_id'): record.trace_id = ctx.trace_id or '-'
+        return True
+
+_context_filter = ContextFilter()
+
+
 # --- Database Log Handler ---
 class DatabaseLogHandler(logging.Handler):
-    """ Обработчик для записи логов в базу данных SQLAlchemy. """
-    def __init__(self, session_factory: 'async_sessionmaker[AsyncSession]'):
+    """
+    Пакетная запись логов в БД. emit() только кладет запись в ограниченный буфер (потокобезопасно),
+    фоновая задача в event loop сбрасывает его одним INSERT каждые batch_size записей или flush_interval секунд.
+    При переполнении запись отбрасывается (счетчик dropped); потоки executor'а могут подождать block_timeout.
+    """
+    def __init__(self, session_factory: 'async_sessionmaker[AsyncSession]', batch_size: int = 100,
+                 flush_interval: float = 1.0, max_buffer: int = 10000, block_timeout: float = 0.0):
         super().__init__()
         self.session_factory = session_factory
+        self.batch_size = batch_size; self.flush_interval = flush_interval; self.block_timeout = block_timeout
+        self.dropped = 0 # Сколько записей потеряно из-за переполнения буфера
+        self._dropped_lock = threading.Lock()
+        self._reported_dropped = 0
+        self._buffer: queue.Queue = queue.Queue(maxsize=max_buffer)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
         self.setLevel(logging.DEBUG) # Уровень по умолчанию, фильтруем в логгере
 
-    async def emit_async(self, record: logging.LogRecord):
-        """ Асинхронная отправка записи в БД. """
-        # Импортируем модели здесь, чтобы избежать циклов
-        from database.models import Log, LogLevel
+    def start(self):
+        """ Запускает фоновую запись в текущем event loop (вызывать из on_startup). """
+        if self._task and not self._task.done(): return
+        self._loop = asyncio.get_running_loop(); self._loop_thread_id = threading.get_ident()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._writer(), name="db-log-writer")
 
-        log_level_name = record.levelname.upper()
-        if log_level_name not in LogLevel.__members__: return # Не логируем неизвестные уровни в БД
+    async def stop(self):
+        """ Останавливает фоновую задачу и сбрасывает остаток буфера (вызывать из on_shutdown). """
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+        await self._flush()
 
-        log_level = LogLevel[log_level_name]
+    def _to_row(self, record: logging.LogRecord) -> Optional[Dict[str, Any]]:
+        # Импортируем модели здесь, чтобы избежать циклов
+        from database.models import LogLevel
+        log_level_name = record.levelname.upper()
+        if log_level_name not in LogLevel.__members__: return None # Не логируем неизвестные уровни в БД
         user_id = getattr(record, 'user_id', None)
         handler_name = getattr(record, 'handler_name', None)
-        exc_text = None
-        if record.exc_info: exc_text = logging.Formatter().formatException(record.exc_info)
-
-        log_entry = Log(
-            level=log_level, message=self.format(record), user_id=user_id,
-            handler=handler_name, exception_info=exc_text
-        )
-        try:
-            async with self.session_factory() as session:
-                 # Используем begin_nested, чтобы ошибка записи лога не откатила основную транзакцию
-                 async with session.begin_nested():
-                      session.add(log_entry)
-                 await session.commit() # Коммитим только запись лога
-        except Exception as e:
-            print(f"CRITICAL: Failed write log to DB: {e}", file=sys.stderr)
-            print(f"Original Log Record: {record.__dict__}", file=sys.stderr)
+        exc_text = logging.Formatter().formatException(record.exc_info) if record.exc_info else None
+        return {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc), # Время события, а не записи пачки
+            "level": LogLevel[log_level_name], "message": self.format(record),
+            "user_id": user_id if isinstance(user_id, int) else None, # ContextFilter ставит 'N/A'
+            "handler": handler_name if handler_name not in (None, 'N/A') else None, "exception_info": exc_text,
+        }
 
     def emit(self, record: logging.LogRecord):
-        """ Синхронный вызов для совместимости, запускает async задачу. """
+        """ Кладет запись в буфер. Не блокирует event loop и не создает задач. """
+        try: row = self._to_row(record)
+        except Exception: self.handleError(record); return
+        if row is None: return
+        on_loop_thread = threading.get_ident() == self._loop_thread_id
         try:
-            loop = asyncio.get_running_loop()
-            # Используем call_soon_threadsafe, если emit вызывается из другого потока
-            # loop.call_soon_threadsafe(asyncio.create_task, self.emit_async(record))
-            # Если вызывается из того же потока asyncio:
-            loop.create_task(self.emit_async(record))
-        except RuntimeError: pass # Игнорируем, если нет запущенного цикла
+            if on_loop_thread or self.block_timeout <= 0: self._buffer.put_nowait(row)
+            else: self._buffer.put(row, timeout=self.block_timeout) # Backpressure для потоков
+        except queue.Full:
+            with self._dropped_lock: self.dropped += 1
+            return
+        if self._buffer.qsize() >= self.batch_size: self._notify(on_loop_thread)
+
+    def _notify(self, on_loop_thread: bool):
+        if not self._wakeup or not self._loop: return
+        if on_loop_thread: self._wakeup.set(); return
+        try: self._loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError: pass # Цикл уже закрыт
+
+    async def _writer(self):
+        while True:
+            try: await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError: pass
+            self._wakeup.clear()
+            await self._flush()
+
+    def _drain(self) -> List[Dict[str, Any]]:
+        batch = []
+        while len(batch) < self.batch_size:
+            try: batch.append(self._buffer.get_nowait())
+            except queue.Empty: break
+        return batch
+
+    async def _flush(self):
+        from sqlalchemy import insert
+        from sqlalchemy.exc import IntegrityError
+        from database.models import Log
+        if self.dropped > self._reported_dropped:
+            print(f"WARNING: DB log buffer overflow, dropped {self.dropped - self._reported_dropped} records (total {self.dropped}).", file=sys.stderr)
+            self._reported_dropped = self.dropped
+        while batch := self._drain():
+            try:
+                async with self.session_factory() as session:
+                    try: await session.execute(insert(Log), batch); await session.commit()
+                    except IntegrityError: # user_id еще нет в users (например, до /start) - пишем без привязки
+                        await session.rollback()
+                        await session.execute(insert(Log), [{**row, "user_id": None} for row in batch]); await session.commit()
+            except Exception as e:
+                print(f"CRITICAL: Failed write {len(batch)} log records to DB: {e}", file=sys.stderr)
+
+
+db_log_handler: Optional[DatabaseLogHandler] = None # Создается в setup_logging при LOG_TO_DB
+
+def start_db_log_writer():
+    if db_log_handler: db_log_handler.start()
+
+async def stop_db_log_writer():
+    if db_log_handler: await db_log_handler.stop()
+
+
+# --- Форматтеры и фильтры ---
+def _none_if_na(value: Any, na: str = 'N/A') -> Any: return None if value == na else value
+
+class JsonFormatter(logging.Formatter):
+    """ Структурированный JSON (одна строка на запись) для сборщиков логов. """
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname, "logger": record.name, "message": record.getMessage(),
+            "user_id": _none_if_na(getattr(record, 'user_id', None)), "handler": _none_if_na(getattr(record, 'handler_name', None)),
+            "update_id": getattr(record, 'update_id', None), "trace_id": _none_if_na(getattr(record, 'trace_id', None), '-'),
+            "func": record.funcName, "line": record.lineno,
+        }
+        if record.exc_info and not record.exc_text: record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text: data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """ Пропускает каждую N-ю DEBUG/INFO запись "шумных" логгеров (aiogram, httpx). WARNING и выше - всегда. """
+    def __init__(self, prefixes: List[str], rate: float):
+        super().__init__()
+        self.prefixes = tuple(p.strip() for p in prefixes if p.strip()); self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self._counters: Dict[str, itertools.count] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or self.every == 1 or not record.name.startswith(self.prefixes): return True
+        if self.every == 0: return False
+        counter = self._counters.get(record.name) or self._counters.setdefault(record.name, itertools.count())
+        return next(counter) % self.every == 0 # next() атомарен под GIL
+
+class _PreparedQueueHandler(QueueHandler):
+    """ Как QueueHandler, но форматирование целиком остается за обработчиками слушателя (в т.ч. JSON). """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text: record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message; record.args = None; record.exc_info = None # exc_info не сериализуемо/не нужно потоку
+        return record
+
+
+_log_listener: Optional[QueueListener] = None # Поток, в котором работают консоль и файл
+
+def stop_log_listener():
+    """ Дописывает очередь в консоль/файл и останавливает поток логирования. """
+    global _log_listener
+    if _log_listener: _log_listener.stop(); _log_listener = None
 
 
 # --- Настройка Логгера ---
 def setup_logging(session_factory: Optional['async_sessionmaker[AsyncSession]'] = None):
-    """ Настраивает систему логирования на основе Pydantic settings. """
+    """
+    Настраивает систему логирования на основе Pydantic settings.
+    Консоль и файл (включая ротацию) работают в отдельном потоке QueueListener; в event loop остается
+    только постановка записи в очередь. Запись в БД идет через собственный пакетный буфер.
+    """
+    global db_log_handler, _log_listener
     log_level_numeric = getattr(logging, settings.log_level, logging.INFO)
-    formatter = logging.Formatter(settings.log_format)
+    formatter = JsonFormatter() if settings.log_json else logging.Formatter(settings.log_format)
+    # Свой SamplingFilter на каждый обработчик: счетчик общего фильтра продвигался бы дважды на запись
+    new_sampling_filter = lambda: SamplingFilter(settings.log_noisy_loggers.split(','), settings.log_noisy_sample_rate)
 
+    stop_log_listener()
     root_logger = logging.getLogger()
     root_logger.setLevel(log_level_numeric)
     for handler in root_logger.handlers[:]: root_logger.removeHandler(handler)
 
+    sinks: List[logging.Handler] = []
     # Консоль
     console_handler = logging.StreamHandler(sys.stderr)
     console_handler.setFormatter(formatter)
     console_handler.setLevel(log_level_numeric)
-    root_logger.addHandler(console_handler)
+    sinks.append(console_handler)
 
     # Файл
+    file_error = None
     if settings.log_file:
         try:
             file_handler = RotatingFileHandler(settings.log_file, maxBytes=5*1024*1024, backupCount=5, encoding='utf-8')
             file_handler.setFormatter(formatter)
             file_handler.setLevel(logging.INFO) # В файл пишем INFO и выше
-            root_logger.addHandler(file_handler)
-        except Exception as e: root_logger.error(f"Failed setup file logger ({settings.log_file}): {e}")
+            sinks.append(file_handler)
+        except Exception as e: file_error = e
+
+    queue_handler = _PreparedQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(new_sampling_filter())
+    queue_handler.addFilter(_context_filter) # Фильтр обработчика выполняется в потоке/задаче автора записи
+    root_logger.addHandler(queue_handler)
+    _log_listener = QueueListener(queue_handler.queue, *sinks, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(stop_log_listener)
+    if file_error: root_logger.error(f"Failed setup file logger ({settings.log_file}): {file_error}")
 
     # БД
     db_logging_enabled = settings.log_to_db and session_factory
     if db_logging_enabled:
-        db_handler = DatabaseLogHandler(session_factory)
-        db_handler.setLevel(logging.INFO) # В БД пишем INFO и выше
-        db_handler.setFormatter(formatter)
-        root_logger.addHandler(db_handler)
+        db_log_handler = DatabaseLogHandler(
+            session_factory, batch_size=settings.log_db_batch_size,
+            flush_interval=settings.log_db_flush_interval, max_buffer=settings.log_db_buffer_size )
+        db_log_handler.setLevel(logging.INFO) # В БД пишем INFO и выше
+        db_log_handler.setFormatter(logging.Formatter(settings.log_format))
+        db_log_handler.addFilter(new_sampling_filter())
+        db_log_handler.addFilter(_context_filter)
+        root_logger.addHandler(db_log_handler)
 
     # Уровни логов библиотек
     logging.getLogger('aiogram').setLevel(logging.INFO)
@@ -103,4 +279,4 @@ def setup_logging(session_factory: Optional['async_sessionmaker[AsyncSession]']
     logging.getLogger('geopy').setLevel(logging.INFO)
     logging.getLogger('asyncio').setLevel(logging.WARNING) # Уменьшаем болтливость asyncio
 
-    root_logger.info(f"Logging setup complete. Level: {settings.log_level}. File: {settings.log_file}. DB Log: {db_logging_enabled}")
\ No newline at end of file
+    root_logger.info(f"Logging setup complete. Level: {settings.log_level}. File: {settings.log_file}. DB Log: {db_logging_enabled}. JSON: {settings.log_json}")
\ No newline at end of file
@@ -0,0 +1,103 @@
+import time
+import logging
+from typing import Dict, List, NamedTuple, Optional
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+class RateLimit(NamedTuple):
+    """ Token bucket: в среднем не чаще 1 события в interval сек, подряд - не больше burst. """
+    interval: float
+    burst: int = 1
+
+    @property
+    def ttl(self) -> float: return self.interval * self.burst # За это время пустое ведро наполняется целиком
+
+
+# --- In-memory backend ---
+class MemoryRateLimiter:
+    """
+    Ведра хранятся в dict[user_id] -> [tokens, last_ts] отдельно для каждого класса лимита.
+    Полное ведро эквивалентно отсутствующему, поэтому раз в sweep_interval удаляются ведра,
+    простоявшие дольше ttl. Без await внутри - на событие одна арифметика и пара обращений к dict.
+    """
+    def __init__(self, limits: Dict[str, RateLimit], sweep_interval: float = 60.0):
+        self.limits = limits
+        self.sweep_interval = sweep_interval
+        self._buckets: Dict[str, Dict[int, List[float]]] = {name: {} for name in limits}
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def hit_nowait(self, key: str, user_id: int) -> bool:
+        """ Списывает токен. True - событие разрешено. """
+        if key not in self.limits: key = 'default'
+        limit = self.limits[key]; buckets = self._buckets[key]
+        now = time.monotonic()
+        if now >= self._next_sweep: self._sweep(now)
+        bucket = buckets.get(user_id)
+        if bucket is None: buckets[user_id] = [limit.burst - 1, now]; return True
+        tokens = min(limit.burst, bucket[0] + (now - bucket[1]) / limit.interval)
+        bucket[1] = now
+        if tokens < 1: bucket[0] = tokens; return False
+        bucket[0] = tokens - 1
+        return True
+
+    async def hit(self, key: str, user_id: int) -> bool: return self.hit_nowait(key, user_id)
+
+    def _sweep(self, now: float):
+        self._next_sweep = now + self.sweep_interval
+        for name, buckets in self._buckets.items():
+            ttl = self.limits[name].ttl
+            stale = [uid for uid, (_, ts) in buckets.items() if now - ts >= ttl]
+            for uid in stale: del buckets[uid]
+
+    def __len__(self) -> int: return sum(len(b) for b in self._buckets.values())
+
+
+# --- Redis backend (несколько реплик бота) ---
+_REDIS_TOKEN_BUCKET = """
+local now = tonumber(ARGV[1]); local interval = tonumber(ARGV[2]); local burst = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 't', 'ts')
+local tokens = tonumber(state[1]); local ts = tonumber(state[2])
+if tokens == nil then tokens = burst; ts = now end
+tokens = math.min(burst, tokens + (now - ts) / interval)
+local allowed = 0
+if tokens >= 1 then tokens = tokens - 1; allowed = 1 end
+redis.call('HSET', KEYS[1], 't', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(interval * burst * 1000))
+return allowed
+"""
+
+class RedisRateLimiter:
+    """ Те же ведра в Redis: атомарный Lua-скрипт, ключ живет ttl и удаляется самим Redis. """
+    def __init__(self, redis, limits: Dict[str, RateLimit], prefix: str = "throttle"):
+        self.redis = redis
+        self.limits = limits
+        self.prefix = prefix
+        self._script = redis.register_script(_REDIS_TOKEN_BUCKET)
+
+    async def hit(self, key: str, user_id: int) -> bool:
+        limit = self.limits.get(key) or self.limits['default']
+        try: allowed = await self._script(keys=[f"{self.prefix}:{key}:{user_id}"], args=[time.time(), limit.interval, limit.burst])
+        except Exception as e: logger.warning(f"Redis rate limiter unavailable, allowing event: {e}"); return True # Fail-open
+        return bool(allowed)
+
+
+def default_limits() -> Dict[str, RateLimit]:
+    """ Классы лимитов из настроек. Класс хендлера задается флагом flags={"throttling_key": "paid"}. """
+    interval = settings.throttling_rate_limit
+    return {
+        # Всплеск = сколько событий укладывается в окно rate_period (при дефолтах 0.7/1.0 - одно)
+        'default': RateLimit(interval, max(1, int(settings.throttling_rate_period / interval))),
+        'paid': RateLimit(settings.throttling_paid_rate_limit, 2), # Запас на повторный ввод (например, города)
+    }
+
+def create_rate_limiter(limits: Optional[Dict[str, RateLimit]] = None):
+    """ memory - в процессе; redis - общий для всех реплик (REDIS_URL, пакет redis). """
+    limits = limits or default_limits()
+    if settings.throttling_backend == 'redis':
+        try: from redis.asyncio import Redis
+        except ImportError: raise RuntimeError("THROTTLING_BACKEND=redis требует пакет 'redis'")
+        if not settings.redis_url: raise RuntimeError("THROTTLING_BACKEND=redis требует REDIS_URL")
+        return RedisRateLimiter(Redis.from_url(settings.redis_url), limits)
+    return MemoryRateLimiter(limits)
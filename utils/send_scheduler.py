@@ -0,0 +1,163 @@
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from core.config import settings
+from utils.http_metrics import RouteLatency, collectors, counters, histogram_lines
+
+logger = logging.getLogger(__name__)
+
+class SendPriority(IntEnum):
+    """ Меньше - важнее: ответы пользователю обгоняют массовые отправки в очереди на токен. """
+    INTERACTIVE = 0
+    BULK = 1
+
+send_priority: ContextVar[SendPriority] = ContextVar("send_priority", default=SendPriority.INTERACTIVE)
+
+@contextmanager
+def bulk_sends():
+    """ Запросы к Telegram внутри блока (и в задачах, созданных в нем) идут с низким приоритетом. """
+    token = send_priority.set(SendPriority.BULK)
+    try: yield
+    finally: send_priority.reset(token)
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Единый планировщик исходящих запросов к Bot API: подключается к bot.session, поэтому через него проходят
+    ответы хендлеров, результаты очереди услуг, уведомления, гороскопы и рассылки.
+    - Лимит на чат (запросы с chat_id): ведро interval/burst, как в MemoryRateLimiter, но с ожиданием.
+    - Общий лимит процесса: ведро rate запросов/с; ожидающие получают токены по приоритету, затем по очереди.
+    - 429 (RetryAfter): одиночный - пауза только этого чата на retry_after (лимит чата или группы не должен
+      тормозить остальных). Повторный в пределах flood_window после паузы (другой чат или тот же снова) - лимит
+      бота: пауза всей отправки, темп падает вдвое (не ниже min_rate) и линейно возвращается к максимуму
+      за recovery сек. Запрос повторяется до max_retries раз.
+    Запросы без chat_id (answerCallbackQuery, getFile, setWebhook...) проходят без ожидания.
+    Лимиты - на процесс: массовые отправки идут только из главного воркера.
+    """
+    def __init__(self, rate: float, min_rate: float, recovery: float, chat_interval: float, chat_burst: int,
+                 max_retries: int, flood_window: float = 10.0, sweep_interval: float = 60.0):
+        self.max_rate = self.rate = rate; self.min_rate = min(min_rate, rate); self.recovery = recovery
+        self.chat_interval = chat_interval; self.chat_burst = chat_burst
+        self.max_retries = max_retries; self.flood_window = flood_window; self.sweep_interval = sweep_interval
+        self._last_flood: Tuple[Optional[int], float] = (None, float('-inf')) # (chat_id, конец его паузы)
+        self._tokens = float(max(1, int(rate))); self._ts = time.monotonic(); self._paused_until = 0.0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = [] # heap (priority, seq, future)
+        self._seq = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._chats: Dict[int, List[float]] = {} # chat_id -> [tokens, ts]; tokens < 0 - очередь в чат
+        self._next_sweep = time.monotonic() + sweep_interval
+        self.depth: Dict[SendPriority, int] = {p: 0 for p in SendPriority} # Ждут лимита (чат или общий)
+        self.stats: Dict[Tuple[str, SendPriority], RouteLatency] = {} # (method, priority) -> ожидание + запрос
+
+    # --- Лимит на чат ---
+    def _reserve_chat(self, chat_id, now: float) -> float:
+        """ Списывает токен чата, возвращает сколько ждать своей очереди в этот чат. """
+        if now >= self._next_sweep: self._sweep(now)
+        bucket = self._chats.get(chat_id)
+        if bucket is None: self._chats[chat_id] = [self.chat_burst - 1, now]; return 0.0
+        tokens = min(self.chat_burst, bucket[0] + (now - bucket[1]) / self.chat_interval) - 1
+        bucket[0] = tokens; bucket[1] = now
+        return -tokens * self.chat_interval if tokens < 0 else 0.0
+
+    def _sweep(self, now: float):
+        self._next_sweep = now + self.sweep_interval; full = self.chat_interval * self.chat_burst
+        stale = [chat_id for chat_id, (tokens, ts) in self._chats.items() if now - ts >= full - tokens * self.chat_interval]
+        for chat_id in stale: del self._chats[chat_id]
+
+    # --- Общий лимит ---
+    def _refill(self, now: float):
+        if self.rate < self.max_rate and now > self._paused_until: # Восстановление темпа после 429
+            self.rate = min(self.max_rate, self.rate + (now - max(self._ts, self._paused_until)) * self.max_rate / self.recovery)
+        self._tokens = min(max(1, int(self.rate)), self._tokens + (now - self._ts) * self.rate); self._ts = now
+
+    async def _acquire(self, priority: SendPriority):
+        now = time.monotonic()
+        if not self._waiters and now >= self._paused_until:
+            self._refill(now)
+            if self._tokens >= 1: self._tokens -= 1; return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._dispatcher is None: self._dispatcher = asyncio.create_task(self._dispatch(), name="telegram-send-dispatcher")
+        await future # Отмененное ожидание диспетчер пропустит
+
+    async def _dispatch(self):
+        try:
+            while self._waiters:
+                now = time.monotonic(); self._refill(now)
+                delay = max(self._paused_until - now, (1 - self._tokens) / self.rate if self._tokens < 1 else 0.0)
+                if delay > 0: await asyncio.sleep(delay); continue
+                _, _, future = heapq.heappop(self._waiters)
+                if future.done(): continue
+                self._tokens -= 1; future.set_result(None)
+        finally: self._dispatcher = None
+
+    def _on_flood(self, chat_id: int, retry_after: float):
+        now = time.monotonic(); counters['telegram_flood_waits_total'] += 1
+        last_chat, last_until = self._last_flood
+        if chat_id == last_chat and now < last_until: return # Запрос ушел до паузы этого чата - пауза уже идет
+        self._last_flood = (chat_id, now + retry_after)
+        self._chats[chat_id] = [1.0, now + retry_after] # Один токен чата - после паузы (см. _reserve_chat)
+        if now >= last_until + self.flood_window:
+            logger.warning(f"[SendScheduler] Flood control for chat {chat_id}: pause {retry_after}s."); return
+        self._refill(now) # Второй 429 подряд - упираемся в общий лимит бота
+        self._paused_until = max(self._paused_until, now + retry_after); self._tokens = 0.0
+        self.rate = max(self.min_rate, self.rate / 2)
+        counters['telegram_global_flood_waits_total'] += 1
+        logger.warning(f"[SendScheduler] Flood control (repeated): pause {retry_after}s, rate lowered to {self.rate:.1f}/s.")
+
+    # --- Middleware ---
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot: Bot, method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None: return await make_request(bot, method)
+        priority = send_priority.get(); started = time.monotonic()
+        self.depth[priority] += 1
+        try:
+            delay = self._reserve_chat(chat_id, started)
+            if delay > 0: await asyncio.sleep(delay)
+            await self._acquire(priority)
+        finally: self.depth[priority] -= 1
+        try:
+            for attempt in itertools.count():
+                try: return await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    self._on_flood(chat_id, e.retry_after)
+                    if attempt >= self.max_retries: raise
+                    self.depth[priority] += 1
+                    try:
+                        delay = self._reserve_chat(chat_id, time.monotonic()) # Пауза чата (и очередь в него)
+                        if delay > 0: await asyncio.sleep(delay)
+                        await self._acquire(priority)
+                    finally: self.depth[priority] -= 1
+        finally:
+            key = (type(method).__name__, priority)
+            stats = self.stats.get(key) or self.stats.setdefault(key, RouteLatency())
+            stats.observe(time.monotonic() - started)
+
+    def metrics(self, pid_label: str) -> List[str]:
+        lines = ["# TYPE telegram_send_queue_depth gauge"]
+        lines += [f'telegram_send_queue_depth{{{pid_label},priority="{p.name.lower()}"}} {n}' for p, n in self.depth.items()]
+        lines += ["# TYPE telegram_send_rate gauge", f'telegram_send_rate{{{pid_label}}} {self.rate:.2f}',
+                  "# TYPE telegram_send_duration_seconds histogram"]
+        for (method, priority), s in sorted(self.stats.items()):
+            lines += histogram_lines("telegram_send_duration_seconds", f'{pid_label},method="{method}",priority="{priority.name.lower()}"', s)
+        return lines
+
+
+send_scheduler = SendScheduler(
+    rate=settings.telegram_send_rate, min_rate=settings.telegram_send_min_rate, recovery=settings.telegram_send_recovery_seconds,
+    chat_interval=settings.telegram_chat_interval, chat_burst=settings.telegram_chat_burst, max_retries=settings.telegram_send_max_retries,
+    flood_window=settings.telegram_flood_window_seconds )
+collectors.append(send_scheduler.metrics)